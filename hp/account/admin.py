@@ -36,6 +36,7 @@ from .models import Confirmation
 from .models import GpgKey
 from .models import User
 from .models import UserLogEntry
+from .tasks import refresh_keys
 from .tasks import resend_confirmations
 from .tasks import send_confirmation_task
 
@@ -192,15 +193,12 @@ class GpgKeyAdmin(DjangoObjectActions, admin.ModelAdmin):
 
     @takes_instance_or_queryset
     def refresh(self, request, queryset):
-        for obj in queryset:
-            try:
-                obj.refresh()
-            except Exception as e:
-                log.exception(e)
-                messages.error(request, _('Error importing %(fingerprint)s: %(error)s') % {
-                    'fingerprint': obj.fingerprint,
-                    'error': e,
-                })
+        errors = refresh_keys(list(queryset))
+        for fingerprint, error in sorted(errors.items()):
+            messages.error(request, _('Error importing %(fingerprint)s: %(error)s') % {
+                'fingerprint': fingerprint,
+                'error': error,
+            })
     refresh.label = _('Refresh')
     refresh.short_description = _('Refresh keys from keyserver')
 
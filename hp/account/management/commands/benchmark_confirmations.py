@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test import override_settings
+from django.utils import translation
+
+from core.stats import LatencyHistogram
+
+from ...constants import PURPOSE_RESET_PASSWORD
+from ...models import Confirmation
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmark rendering and sending confirmation emails. No emails are actually sent."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--count', type=int, default=1000, metavar='N',
+            help='Number of confirmations to send (default: %(default)s).')
+        parser.add_argument(
+            '--plain', action='store_true', default=False,
+            help='Also send the same number of unencrypted confirmations for comparison.')
+        parser.add_argument(
+            '--render', action='store_true', default=False,
+            help='Only render emails (does not require a GPG key).')
+        parser.add_argument(
+            '--language', default='en', help='Language used for emails (default: %(default)s).')
+        parser.add_argument(
+            'user', help="The user to send confirmations to, needs a valid GPG key unless --render is given.")
+
+    def send(self, conf):
+        conf.send()
+
+    def render(self, conf):
+        with translation.override(conf.language):
+            conf.user.render_mail_template(conf.template_base, conf.get_mail_context(),
+                                           conf.SUBJECTS[conf.purpose])
+
+    def run(self, label, func, user, count, language, payload):
+        hist = LatencyHistogram(keep_samples=True)
+        start = time.monotonic()
+
+        for i in range(count):
+            conf = Confirmation(user=user, to=user.email, purpose=PURPOSE_RESET_PASSWORD, language=language,
+                                payload=payload)
+            conf_start = time.monotonic()
+            func(conf)
+            hist.observe((time.monotonic() - conf_start) * 1000)
+
+        total = time.monotonic() - start
+        self.stdout.write('%s: %s emails in %.2fs (%.1f/s), mean %.1fms, p50 %s, p95 %s, p99 %s' % (
+            label, count, total, count / total, hist.mean, hist.format_percentile(50),
+            hist.format_percentile(95), hist.format_percentile(99)))
+
+    def handle(self, user, count, plain, render, language, **options):
+        try:
+            user = User.objects.get(username=user)
+        except User.DoesNotExist:
+            raise CommandError('%s: User does not exist.' % user)
+
+        payload = {'hostname': user.domain, 'base_url': 'https://%s' % user.domain}
+        if render:
+            self.run('Rendered', self.render, user, count, language, payload)
+            return
+
+        if not user.gpg_keys.valid().exists():
+            raise CommandError('%s: User has no valid GPG keys.' % user)
+
+        # Use the locmem backend so that no emails are sent and encrypt in this process, so that we
+        # measure how long it takes.
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', GPG_QUEUE=None):
+            self.run('Encrypted', self.send, user, count, language, payload)
+
+            if plain:
+                self.run('Plain', self.send, user, count, language, dict(payload, gpg_recv_pub=False))
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.4 on 2026-10-19 09:44
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_upload_usage(apps, schema_editor):
+    Upload = apps.get_model('xmpp_http_upload', 'Upload')
+    UploadUsage = apps.get_model('account', 'UploadUsage')
+
+    usage = Upload.objects.order_by().values('jid').annotate(uploads=Count('pk'), size=Sum('size'))
+    UploadUsage.objects.bulk_create([UploadUsage(**u) for u in usage], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0019_user_last_activity_index'),
+        ('xmpp_http_upload', '0004_auto_20170309_2201'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jid', models.CharField(max_length=256, unique=True)),
+                ('uploads', models.IntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_upload_usage, migrations.RunPython.noop),
+    ]
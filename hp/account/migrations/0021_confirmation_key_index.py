@@ -0,0 +1,19 @@
+# Generated by Django 3.0.4 on 2026-10-19 09:49
+
+import account.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0020_uploadusage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='confirmation',
+            name='key',
+            field=models.CharField(db_index=True, default=account.models.default_key, max_length=40),
+        ),
+    ]
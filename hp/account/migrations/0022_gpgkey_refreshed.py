@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-19 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0021_confirmation_key_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gpgkey',
+            name='refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -13,8 +13,10 @@
 # You should have received a copy of the GNU General Public License along with this project. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 import logging
+import threading
 from contextlib import contextmanager
 
 from django.conf import settings
@@ -22,6 +24,7 @@ from django.contrib.auth.models import PermissionsMixin
 from django.contrib.messages import constants as messages
 from django.core.mail import EmailMultiAlternatives
 from django.db import models
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.template import Context
@@ -35,15 +38,18 @@ from django.utils.crypto import salted_hmac
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import gettext_noop
 
-from gpgliblib.django import GpgEmailMessage
 from gpgliblib.django import gpg_backend
 from jsonfield import JSONField
 from xmpp_backends.base import UserNotFound
 from xmpp_backends.django import xmpp_backend
 from xmpp_backends.django.models import XmppBackendUser
+from xmpp_http_upload.models import Upload
 
 from antispam.models import BlockedEmail
 from antispam.models import BlockedIpAddress
+from core.gpg import TimedGpgEmailMessage
+from core.gpg import get_keyring_pool
+from core.mail import Mailer
 from core.models import Address
 from core.models import BaseModel
 from core.models import CachedMessage
@@ -59,10 +65,15 @@ from .managers import UserLogEntryManager
 from .managers import UserManager
 from .querysets import ConfirmationQuerySet
 from .querysets import GpgKeyQuerySet
+from .querysets import UploadUsageQuerySet
 from .querysets import UserLogEntryQuerySet
 from .querysets import UserQuerySet
+from .utils import get_username_filter
+from .utils import make_confirmation_token
 
 log = logging.getLogger(__name__)
+_subject_templates = {}
+_upload_usage = threading.local()
 _gpg_key_delimiter = b"""-----END PGP PUBLIC KEY BLOCK-----
 -----BEGIN PGP PUBLIC KEY BLOCK-----"""
 
@@ -81,6 +92,19 @@ def default_payload():
     return {}
 
 
+def get_subject_template(subject):
+    """Get the compiled template for an email subject.
+
+    Templates are cached by subject and the currently active language, so the same subject is only
+    compiled once per process.
+    """
+    key = (str(subject), translation.get_language())
+    template = _subject_templates.get(key)
+    if template is None:
+        template = _subject_templates[key] = Template(key[0])
+    return template
+
+
 class User(XmppBackendUser, PermissionsMixin):
     # NOTE: MySQL only allows a 255 character limit
     username = models.CharField(max_length=255, unique=True, verbose_name=_('Username'))
@@ -105,7 +129,7 @@ class User(XmppBackendUser, PermissionsMixin):
     blocked = models.BooleanField(default=False)
 
     # When the user last logged in.
-    last_activity = models.DateTimeField(default=timezone.now)
+    last_activity = models.DateTimeField(default=timezone.now, db_index=True)
 
     # The default language of this user. This is set when the user is created or manually sets his
     # language on the homepage. The value is only used in situations where there is no direct
@@ -173,12 +197,14 @@ class User(XmppBackendUser, PermissionsMixin):
             pass
 
     @contextmanager
-    def gpg_keyring(self, init=True, hostname=None, **kwargs):
-        """Context manager that yields a temporary GPG keyring.
+    def gpg_keyring(self, init=True, hostname=None, extra_keys=None, **kwargs):
+        """Context manager that yields a GPG keyring.
 
         To avoid any locking issues and to isolate the GPG keys for users, every operation that
-        interacts with gpg (and thus uses the keyring) is with a separate, temporary keyring that
-        is created specifically for the operations.
+        interacts with gpg (and thus uses the keyring) uses a separate keyring. If ``init=True``
+        and the :ref:`setting-gpg_keyring_cache_dir` setting is set, the keyring is taken from a
+        persistent pool, so keys are only imported the first time a keyring with the same keys is
+        used. Otherwise a temporary keyring is created specifically for the operations.
 
         Example::
 
@@ -190,24 +216,48 @@ class User(XmppBackendUser, PermissionsMixin):
         ----------
 
         init : bool, optional
-            If ``False``, do not import existing (valid) keys into the keyring.
+            If ``False``, do not import existing (valid) keys into the keyring and always use a
+            temporary keyring. Use this if you import keys that should not be cached.
         hostname : str, optional
             If set, also import the private key for the given host configured in the ``XMPP_HOSTS``
             setting.
+        extra_keys : dict, optional
+            Additional public keys to import, with the fingerprint as key and the key as value.
         """
-        if hostname is not None:
-            host_fp, host_key, host_pub = load_private_key(hostname)
-
-        with gpg_backend.temp_keyring(**kwargs) as backend:
-            if init is True:  # import existing valid gpg keys
-                for key in self.gpg_keys.valid():
-                    backend.import_key(key.key.encode('utf-8'))
+        def import_keys(backend, keys):
+            for key in keys:
+                backend.import_key(key.key.encode('utf-8'))
 
             if hostname is not None:
+                host_fp, host_key, host_pub = load_private_key(hostname)
                 backend.import_private_key(host_key)
                 backend.import_key(host_pub)
 
-            yield backend
+            for key in (extra_keys or {}).values():
+                backend.import_key(key)
+
+        pool = get_keyring_pool()
+        if init is True and pool is not None:
+            keys = list(self.gpg_keys.valid().values_list('pk', 'fingerprint', 'updated'))
+            parts = ['user:%s:%s' % (fp, updated.isoformat()) for pk, fp, updated in keys]
+
+            # Renewed keys keep their fingerprint, so the key contents are part of the pool key as well.
+            parts += ['extra:%s:%s' % (fp, hashlib.sha256(key).hexdigest())
+                      for fp, key in (extra_keys or {}).items()]
+            if hostname is not None:
+                host_fp, host_key, host_pub = load_private_key(hostname)
+                host_hash = hashlib.sha256(host_key + host_pub).hexdigest()
+                parts.append('host:%s:%s:%s' % (hostname, host_fp, host_hash))
+
+            def init_keyring(backend):
+                import_keys(backend, GpgKey.objects.filter(pk__in=[k[0] for k in keys]))
+
+            with pool.keyring(gpg_backend, parts, init_keyring, **kwargs) as backend:
+                yield backend
+        else:
+            with gpg_backend.temp_keyring(**kwargs) as backend:
+                import_keys(backend, self.gpg_keys.valid() if init is True else [])
+                yield backend
 
     def add_gpg_key(self, keys, fingerprint, address):
         if isinstance(keys, str):
@@ -244,7 +294,7 @@ class User(XmppBackendUser, PermissionsMixin):
             self.log(message, address=address, **payload)
             self.message(messages.INFO, message, **payload)
 
-    def send_mail(self, subject, message, html_message, host=None, to=None, gpg_key=None):
+    def send_mail(self, subject, message, html_message, host=None, to=None, gpg_key=None, mailer=None):
         """Send an email to the user.
 
         Parameters
@@ -267,6 +317,9 @@ class User(XmppBackendUser, PermissionsMixin):
         gpg_key : bytes or False, optional
             A bytestring to use as a GPG key instead of any key set for the user. Pass ``False`` to
             send a plaintext email even if the user has GPG keys defined.
+        mailer : :py:class:`~core.mail.Mailer`, optional
+            Send the email using the given mailer, e.g. to reuse a connection to the mail server
+            when sending many emails.
 
         Raises
         ------
@@ -282,29 +335,54 @@ class User(XmppBackendUser, PermissionsMixin):
 
         if host is None:
             host = settings.XMPP_HOSTS[self.domain]
+        if mailer is None:
+            mailer = Mailer()
+
+        if gpg_key is not False and (gpg_key or self.gpg_keys.valid().exists()):
+            if settings.GPG_QUEUE:
+                # Signing and encryption is slow, so it is done by dedicated workers.
+                from .tasks import send_gpg_mail_task
+
+                task_kwargs = {'gpg_key': gpg_key.decode('utf-8') if gpg_key else None}
+                send_gpg_mail_task.apply_async(
+                    (self.pk, subject, message, html_message, host['NAME'], to), task_kwargs,
+                    queue=settings.GPG_QUEUE)
+            else:
+                self.send_gpg_mail(subject, message, html_message, host, to, gpg_key=gpg_key,
+                                   mailer=mailer)
+        else:
+            msg = EmailMultiAlternatives(subject, message, host['DEFAULT_FROM_EMAIL'], [to])
+            msg.attach_alternative(html_message, 'text/html')
+            mailer.send(msg)
 
-        frm = host['DEFAULT_FROM_EMAIL']
-        keys = list(self.gpg_keys.valid().values_list('fingerprint', flat=True))
-
-        if gpg_key is not False and (keys or gpg_key):
-            sign_fp = host.get('GPG_FINGERPRINT')
-
-            with self.gpg_keyring(default_trust=True, hostname=host['NAME']) as backend:
-                if gpg_key:
-                    log.info('Imported custom keys.')
-                    keys = backend.import_key(gpg_key)
+    def send_gpg_mail(self, subject, message, html_message, host, to, gpg_key=None, mailer=None):
+        """Send a signed and encrypted email to the user.
 
-                msg = GpgEmailMessage(subject, message, frm, [to],
-                                      gpg_backend=backend, gpg_recipients=keys, gpg_signer=sign_fp)
-                msg.attach_alternative(html_message, 'text/html')
-                msg.send()
-        else:
-            msg = EmailMultiAlternatives(subject, message, frm, [to])
+        This function is usually called by :py:func:`~account.models.User.send_mail`, please see
+        there for a description of parameters.
+        """
+        keys = list(self.gpg_keys.valid().values_list('fingerprint', flat=True))
+        sign_fp = host.get('GPG_FINGERPRINT')
+
+        # A custom key is not imported into a cached keyring, as it would then be reused for
+        # operations that don't expect it.
+        init = not gpg_key
+        with self.gpg_keyring(init=init, default_trust=True, hostname=host['NAME']) as backend:
+            if gpg_key:
+                log.info('Imported custom keys.')
+                keys = backend.import_key(gpg_key)
+
+            msg = TimedGpgEmailMessage(subject, message, host['DEFAULT_FROM_EMAIL'], [to],
+                                       gpg_backend=backend, gpg_recipients=keys, gpg_signer=sign_fp)
             msg.attach_alternative(html_message, 'text/html')
-            msg.send()
+            msg.prepare()
+
+        if mailer is None:
+            mailer = Mailer()
+        mailer.send(msg)
 
     def send_mail_template(self, template_base, context, subject, host=None, to=None,
-                           gpg_key=None):
+                           gpg_key=None, mailer=None):
         """Render mail from template and send to user.
 
         Parameters
@@ -324,11 +402,22 @@ class User(XmppBackendUser, PermissionsMixin):
             Passed to :py:class:`~account.models.User.send_mail`.
         gpg_key
             Passed to :py:class:`~account.models.User.send_mail`.
+        mailer
+            Passed to :py:class:`~account.models.User.send_mail`.
         """
-        subject = Template(subject).render(Context(context))
+        subject, txt, html = self.render_mail_template(template_base, context, subject)
+        self.send_mail(subject, txt, html, host=host, to=to, gpg_key=gpg_key, mailer=mailer)
+
+    def render_mail_template(self, template_base, context, subject):
+        """Render subject, plain text and html version of an email.
+
+        Please see :py:func:`~account.models.User.send_mail_template` for a description of
+        parameters.
+        """
+        subject = get_subject_template(subject).render(Context(context))
         txt = render_to_string('%s.txt' % template_base, context).strip()
         html = render_to_string('%s.html' % template_base, context).strip()
-        self.send_mail(subject, txt, html, host=host, to=to, gpg_key=gpg_key)
+        return subject, txt, html
 
     def __str__(self):
         return self.username
@@ -353,7 +442,8 @@ class Confirmation(BaseModel):
     # NOTE: *Not* necessarily the same as the email address of the user (a new address might have been added).
     to = models.EmailField(blank=True, verbose_name=_('Recipient'))
 
-    key = models.CharField(max_length=40, default=default_key)
+    # NOTE: Only used for confirmations sent before signed tokens were introduced, see the token property.
+    key = models.CharField(max_length=40, default=default_key, db_index=True)
     expires = models.DateTimeField(default=default_expires)
     purpose = models.CharField(max_length=16)
     payload = JSONField(default=default_payload)
@@ -371,17 +461,26 @@ class Confirmation(BaseModel):
         PURPOSE_SET_EMAIL: _('Confirm new email address for your {{ user.domain }} account'),
     }
 
+    @property
+    def token(self):
+        """The signed token used in the confirmation URL.
+
+        Unsaved confirmations (e.g. when benchmarking emails) have no primary key, so the key is used instead.
+        """
+        if self.pk is None:
+            return self.key
+        return make_confirmation_token(self.pk, self.purpose, int(self.expires.timestamp()))
+
     @property
     def urlpath(self):
-        return reverse('account:%s_confirm' % self.purpose, kwargs={'key': self.key})
+        return reverse('account:%s_confirm' % self.purpose, kwargs={'key': self.token})
 
-    def send(self):
-        template_base = 'account/confirm/%s' % self.purpose
-        subject = str(self.SUBJECTS[self.purpose])
-        hostname = self.payload['hostname']
-        host = settings.XMPP_HOSTS[hostname]
+    @property
+    def template_base(self):
+        return 'account/confirm/%s' % self.purpose
 
-        context = {
+    def get_mail_context(self):
+        return {
             'domain': self.user.domain,
             'expires': self.expires,
             'jid': self.user.get_username(),
@@ -390,6 +489,11 @@ class Confirmation(BaseModel):
             'uri': '%s%s' % (self.payload['base_url'], self.urlpath),
         }
 
+    def send(self, mailer=None):
+        hostname = self.payload['hostname']
+        host = settings.XMPP_HOSTS[hostname]
+        context = self.get_mail_context()
+
         # gpg_recv_pub is set when the user sets a new email address. It is `False` when the user
         # sets a new email address and no new GPG key (-> no longer use GPG). In all other actions,
         # the key is not present and gpg_key will thus be `None`.
@@ -398,8 +502,9 @@ class Confirmation(BaseModel):
             gpg_key = gpg_key.encode()
 
         with translation.override(self.language):
-            self.user.send_mail_template(template_base, context, subject, host=host, to=self.to,
-                                         gpg_key=gpg_key)
+            subject = self.SUBJECTS[self.purpose]
+            self.user.send_mail_template(self.template_base, context, subject, host=host, to=self.to,
+                                         gpg_key=gpg_key, mailer=mailer)
 
 
 class UserLogEntry(BaseModel):
@@ -440,6 +545,10 @@ class GpgKey(BaseModel):
     expires = models.DateTimeField(null=True, blank=True)
     revoked = models.BooleanField(default=False)
 
+    # when the key was last fetched from the keyserver, even if that failed. ``updated`` is only modified if
+    # the key actually changed, as it is part of the key used for cached keyrings.
+    refreshed = models.DateTimeField(null=True, blank=True)
+
     def refresh(self):
         refetched = gpg_backend.fetch_key('0x%s' % self.fingerprint, keyserver=settings.GPG_KEYSERVER)
 
@@ -448,6 +557,7 @@ class GpgKey(BaseModel):
             self.key = refetched.decode('utf-8')
             self.revoked = key.revoked
             self.expires = timezone.make_aware(key.expires)
+        self.refreshed = timezone.now()
         self.save()
 
     class Meta:
@@ -459,7 +569,58 @@ class GpgKey(BaseModel):
         return self.fingerprint
 
 
+class UploadUsage(models.Model):
+    """Number and total size of XEP-0363 uploads of a JID.
+
+    The values are updated by signal handlers whenever an upload is created or deleted, so they don't have to
+    be computed from all uploads of a user.
+    """
+
+    objects = UploadUsageQuerySet.as_manager()
+
+    jid = models.CharField(max_length=256, unique=True)
+    uploads = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.jid
+
+
+@contextmanager
+def defer_upload_usage():
+    """Do not update :py:class:`~account.models.UploadUsage` when uploads are deleted in this thread.
+
+    Use this when deleting many uploads at once, the caller is responsible for updating the usage instead.
+    """
+    _upload_usage.deferred = True
+    try:
+        yield
+    finally:
+        _upload_usage.deferred = False
+
+
+@receiver(post_save, sender=Upload)
+def add_upload_usage(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UploadUsage.objects.add(instance.jid, 1, instance.size)
+
+
+@receiver(post_delete, sender=Upload)
+def remove_upload_usage(sender, instance, **kwargs):
+    if getattr(_upload_usage, 'deferred', False):
+        return
+    UploadUsage.objects.add(instance.jid, -1, -instance.size)
+
+
 @receiver(post_save, sender=User)
 def create_notifications(sender, instance, created, **kwargs):
     if created:
         Notifications.objects.create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def add_to_username_filter(sender, instance, created, **kwargs):
+    if created:
+        username_filter = get_username_filter(instance.domain)
+        if username_filter is not None:
+            username_filter.add(instance.username.lower())
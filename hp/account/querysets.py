@@ -13,12 +13,21 @@
 # You should have received a copy of the GNU General Public License along with this project. If not, see
 # <http://www.gnu.org/licenses/>.
 
+from datetime import datetime
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
+from .utils import LEGACY_KEY_RE
+from .utils import parse_confirmation_token
+
 
 class UserQuerySet(models.QuerySet):
     def has_email(self):
@@ -86,6 +95,24 @@ class UserQuerySet(models.QuerySet):
 
         return self.filter(last_activity__lte=now - settings.ACCOUNT_EXPIRES_NOTIFICATION_DAYS)
 
+    def expiration_notice_pending(self, now=None):
+        """Match expiring users that want to be notified but were not notified yet.
+
+        Only users with a confirmed email address and that are not yet past the expiry date are
+        matched.
+        """
+        if settings.ACCOUNT_EXPIRES_DAYS is None:
+            return self.none()
+
+        if now is None:
+            now = timezone.now()
+
+        return self.expiring(now=now).confirmed().filter(
+            last_activity__gt=now - settings.ACCOUNT_EXPIRES_DAYS,
+            notifications__account_expires=True,
+            notifications__account_expires_notified=False,
+        )
+
 
 class GpgKeyQuerySet(models.QuerySet):
     def valid(self, now=None):
@@ -98,11 +125,47 @@ class GpgKeyQuerySet(models.QuerySet):
             now = timezone.now()
         return self.filter(expires__lt=now)
 
+    def refresh_pending(self, now=None):
+        """Keys that should be refreshed from the keyserver, least recently refreshed first.
+
+        Revoked keys are never refreshed, keys that expire soon are refreshed daily and all other keys after
+        the ``GPG_KEY_REFRESH_AGE`` setting.
+        """
+        if now is None:
+            now = timezone.now()
+
+        # Keys that were never refreshed were fetched from the keyserver when they were last updated
+        qs = self.filter(revoked=False).annotate(last_refresh=Coalesce('refreshed', 'updated'))
+        expiring = Q(expires__lt=now + settings.GPG_KEY_REFRESH_EXPIRES,
+                     last_refresh__lt=now - timedelta(days=1))
+        old = Q(last_refresh__lt=now - settings.GPG_KEY_REFRESH_AGE)
+        return qs.filter(expiring | old).order_by('last_refresh')
+
 
 class ConfirmationQuerySet(models.QuerySet):
     def purpose(self, purpose):
         return self.filter(purpose=purpose)
 
+    def token(self, token, purpose):
+        """Filter by the key used in a confirmation URL.
+
+        Signed tokens (see :py:func:`~account.utils.make_confirmation_token`) are verified before the database
+        is accessed, invalid or expired tokens return an empty queryset that never queries the database.
+        Valid tokens are looked up by primary key. Keys stored in the database by older versions are still
+        looked up by key.
+        """
+        if LEGACY_KEY_RE.match(token):
+            return self.filter(purpose=purpose, key=token)
+
+        parsed = parse_confirmation_token(token, purpose)
+        if parsed is None:
+            return self.none()
+
+        pk, expires = parsed
+        expires = datetime.fromtimestamp(expires, tz=timezone.utc)
+        return self.filter(pk=pk, purpose=purpose, expires__gte=expires,
+                           expires__lt=expires + timedelta(seconds=1))
+
     def valid(self, now=None):
         if now is None:
             now = timezone.now()
@@ -123,3 +186,17 @@ class UserLogEntryQuerySet(models.QuerySet):
             delta = settings.USER_LOGENTRY_EXPIRES
 
         return self.filter(created__lt=now - delta)
+
+
+class UploadUsageQuerySet(models.QuerySet):
+    def add(self, jid, uploads, size):
+        """Atomically add uploads and bytes (both may be negative) to the usage of a JID."""
+
+        if self.filter(jid=jid).update(uploads=F('uploads') + uploads, size=F('size') + size):
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(jid=jid, uploads=uploads, size=size)
+        except IntegrityError:  # created concurrently by somebody else
+            self.filter(jid=jid).update(uploads=F('uploads') + uploads, size=F('size') + size)
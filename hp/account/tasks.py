@@ -13,9 +13,14 @@
 # You should have received a copy of the GNU General Public License along with this project. If
 # not, see <http://www.gnu.org/licenses/>.
 
+import os
 import socket
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import timedelta
+from functools import partial
 from urllib.error import URLError
 
 import pytz
@@ -26,23 +31,40 @@ from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.messages import constants as messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
 from django.urls import reverse
+from django.utils import timezone
 from django.utils import translation
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_noop
 
 from gpgliblib.base import UnknownGpgliblibError
 from gpgliblib.django import gpg_backend
+from xmpp_backends.base import BackendConnectionError
 from xmpp_backends.base import UserNotFound
 from xmpp_backends.django import xmpp_backend
+from xmpp_http_upload.models import Upload
 
+from core.bloom import BloomFilter
+from core.gpg import KeyFetcher
+from core.mail import Mailer
 from core.models import Address
 from core.tasks import activate_language
 from core.utils import format_timedelta
+from stats.constants import STAT_UPLOADS_DELETED
+from stats.constants import STAT_UPLOADS_FREED
+from stats.models import stat
 
 from .constants import PURPOSE_SET_EMAIL
 from .models import Confirmation
+from .models import GpgKey
+from .models import Notifications
+from .models import UploadUsage
 from .models import UserLogEntry
+from .models import defer_upload_usage
+from .utils import get_username_filter
 
 User = get_user_model()
 log = get_task_logger(__name__)
@@ -146,7 +168,8 @@ def send_confirmation_task(self, user_pk, to, purpose, language, address=None, *
 
     conf = Confirmation.objects.create(user=user, purpose=purpose, language=language, to=to,
                                        address=address, payload=payload)
-    conf.send()
+    with Mailer() as mailer:
+        conf.send(mailer=mailer)
 
 
 @shared_task(bind=True, base=FetchKeyTask)
@@ -171,7 +194,8 @@ def set_email_task(self, user_pk, to, language, address, fingerprint=None, key=N
     conf = Confirmation.objects.create(user=user, purpose=PURPOSE_SET_EMAIL, language=language,
                                        to=to, address=address, payload=payload)
     try:
-        conf.send()
+        with Mailer() as mailer:
+            conf.send(mailer=mailer)
     except UnknownGpgliblibError as e:
         log.exception(e)
 
@@ -180,6 +204,140 @@ def set_email_task(self, user_pk, to, language, address, fingerprint=None, key=N
         user.message(messages.ERROR, msg)
 
 
+@shared_task
+def send_gpg_mail_task(user_pk, subject, message, html_message, hostname, to, gpg_key=None):
+    """Send a signed and encrypted email, used by :py:func:`~account.models.User.send_mail`.
+
+    This task is sent to the queue named by the ``GPG_QUEUE`` setting.
+    """
+    user = User.objects.get(pk=user_pk)
+    host = settings.XMPP_HOSTS[hostname]
+
+    if gpg_key:
+        gpg_key = gpg_key.encode('utf-8')
+
+    try:
+        with Mailer() as mailer:
+            user.send_gpg_mail(subject, message, html_message, host, to, gpg_key=gpg_key, mailer=mailer)
+    except UnknownGpgliblibError as e:
+        if not gpg_key:
+            raise
+        log.exception(e)
+
+        msg = gettext_noop('Unexpected error importing GPG key.')
+        user.log(msg)
+        user.message(messages.ERROR, msg)
+
+
+def _last_activity_cache_keys(user_pk):
+    return 'last-activity-%s' % user_pk, 'last-activity-pending-%s' % user_pk
+
+
+def schedule_last_activity(user, timestamp, status=''):
+    """Update the last activity of the user in the XMPP backend in the background.
+
+    The update is sent by :py:func:`set_last_activity_task` after
+    ``settings.LAST_ACTIVITY_UPDATE_WINDOW``. Any further updates until then only replace the
+    values that will be sent, so the backend receives only the most recent update.
+
+    Note that this function does not update ``user.last_activity``, callers should do that
+    themselves.
+    """
+    window = int(settings.LAST_ACTIVITY_UPDATE_WINDOW.total_seconds())
+    data_key, pending_key = _last_activity_cache_keys(user.pk)
+
+    cache.set(data_key, (user.username, timestamp, status), window * 10)
+
+    # Only schedule a task if there is none already. The pending flag expires after a while in case the task
+    # is lost, otherwise the user would never be updated again.
+    if cache.add(pending_key, True, window * 2):
+        set_last_activity_task.apply_async((user.pk, ), countdown=window)
+
+
+@shared_task(bind=True)
+def set_last_activity_task(self, user_pk):
+    """Send the last activity stored by :py:func:`schedule_last_activity` to the XMPP backend."""
+
+    data_key, pending_key = _last_activity_cache_keys(user_pk)
+
+    # Remove the pending flag *before* reading the data: An update that arrives in the meantime will
+    # schedule a new task instead of being lost.
+    cache.delete(pending_key)
+    data = cache.get(data_key)
+    if data is None:
+        log.warning('%s: No last activity found in cache.', user_pk)
+        return
+
+    username, timestamp, status = data
+    node, domain = username.split('@', 1)
+
+    try:
+        xmpp_backend.set_last_activity(node, domain, status=status, timestamp=timestamp)
+    except BackendConnectionError as e:
+        window = int(settings.LAST_ACTIVITY_UPDATE_WINDOW.total_seconds())
+        if cache.add(pending_key, True, window * 2):
+            self.retry(exc=e, countdown=window)
+
+
+def _user_sessions_cache_keys(user_pk):
+    return 'user-sessions-%s' % user_pk, 'user-sessions-refresh-%s' % user_pk
+
+
+def fetch_user_sessions(user):
+    """Get the current sessions of the user from the XMPP backend and store them in the cache.
+
+    Sessions are returned (and cached) as list of dictionaries, sorted by the time the session started.
+    """
+    sessions = [{
+        'resource': s.resource,
+        'priority': s.priority,
+        'ip_address': s.ip_address,
+        'uptime': s.uptime,
+        'status': s.status,
+        'status_text': s.status_text,
+        'connection_type': s.connection_type,
+        'encrypted': s.encrypted,
+        'compressed': s.compressed,
+    } for s in xmpp_backend.user_sessions(user.node, user.domain)]
+    sessions = sorted(sessions, key=lambda s: s['uptime'])
+
+    data_key, refresh_key = _user_sessions_cache_keys(user.pk)
+    cache.set(data_key, (time.time(), sessions), int(settings.USER_SESSIONS_CACHE_STALE.total_seconds()))
+    cache.delete(refresh_key)
+    return sessions
+
+
+def get_user_sessions(user):
+    """Get the current sessions of the user, using the cache if possible.
+
+    If the cached list is older than ``settings.USER_SESSIONS_CACHE_TTL``, it is still returned, but
+    :py:func:`refresh_user_sessions_task` is scheduled to update it. If nothing is cached, the sessions are
+    fetched synchronously.
+    """
+    data_key, refresh_key = _user_sessions_cache_keys(user.pk)
+    cached = cache.get(data_key)
+    if cached is None:
+        return fetch_user_sessions(user)
+
+    fetched, sessions = cached
+    ttl = settings.USER_SESSIONS_CACHE_TTL.total_seconds()
+    if time.time() - fetched > ttl and cache.add(refresh_key, True, int(ttl)):
+        refresh_user_sessions_task.delay(user_pk=user.pk)
+    return sessions
+
+
+def invalidate_user_sessions(user):
+    """Remove the cached sessions of the user, e.g. after a session was stopped."""
+
+    cache.delete_many(_user_sessions_cache_keys(user.pk))
+
+
+@shared_task
+def refresh_user_sessions_task(user_pk):
+    user = User.objects.get(pk=user_pk)
+    fetch_user_sessions(user)
+
+
 @shared_task
 def resend_confirmations(*conf_pks):
     """Task to resend the passed confirmation keys.
@@ -189,9 +347,14 @@ def resend_confirmations(*conf_pks):
         # Resend confirmation keys with primary keys 3, 5 and 10:
         >>> resend_confirmations.delay(3, 5, 10)
     """
-    for pk in conf_pks:
-        conf = Confirmation.objects.get(pk=pk)
-        conf.send()
+    confirmations = Confirmation.objects.filter(pk__in=conf_pks).select_related('user')
+    with Mailer() as mailer:
+        for conf in confirmations:
+            conf.send(mailer=mailer)
+
+    missing = set(conf_pks) - set(conf.pk for conf in confirmations)
+    if missing:
+        log.warning('Confirmation(s) not found: %s', ', '.join(str(pk) for pk in sorted(missing)))
 
 
 @shared_task
@@ -229,7 +392,7 @@ def update_last_activity(random_update=50):
         user.save()
 
     # Update last activity of users with more then 350 days of inactivity
-    for user in User.objects.select_related('notifications').expiring():
+    for user in User.objects.expiring():
         log.debug('%s: Updating last activity.', user)
 
         try:
@@ -244,51 +407,255 @@ def update_last_activity(random_update=50):
             continue
 
         # Update last activity in the database if it is not up to date.
+        last_activity = pytz.utc.localize(last_activity)
         if last_activity != user.last_activity:
             log.debug('%s: Updated last_activity from %s to %s.', user, user.last_activity, last_activity)
-            user.last_activity = pytz.utc.localize(last_activity)
+            user.last_activity = last_activity
             user.save()
 
-        notifs = user.notifications
-
-        # On what date the user will be removed and how many days this is from now
-        when = user.last_activity.date() + settings.ACCOUNT_EXPIRES_DAYS
-        delta = when - date.today()
-
-        # If the updated last_activity still isn't more recent, the user requested a notification
-        # and has a confirmed email address, we send a mail to the user.
-        if user.is_confirmed and user.is_expiring and notifs.account_expires and \
-                notifs.account_expires_notified is False and delta > timedelta():
-            log.debug('%s: Notifying user at %s', user, user.email)
-
-            host = settings.XMPP_HOSTS[user.domain]
-            base_url = host['CANONICAL_BASE_URL'].rstrip('/')
-
-            context = {  # NOQA
-                'domain': user.domain,
-                'expires_days': settings.ACCOUNT_EXPIRES_DAYS.days,
-                'host': host,
-                'jid': user.username,
-                'login_url': '%s%s' % (base_url, reverse('account:login')),
-                'password_url': '%s%s' % (base_url, reverse('account:reset_password')),
-                'user': user,
-                'when': when,
-                'when_days': delta.days,
-            }
-
-            log.info('%s: Sending expiration notice to %s.', user, user.email)
-            with translation.override(user.default_language):
-                subject = _('Your account on {{ domain }} is about to expire')
-                user.send_mail_template('account/email/user_expires', context, subject)
-
-            notifs.account_expires_notified = True
-            notifs.save()
-        elif not user.is_expiring:
-            # The account is no longer expiring, this means it has logged on in the meantime
-            notifs.account_expires_notified = False
-            notifs.save()
+    # Notify users that are still expiring after the update
+    notify_expiring_users.delay()
 
-        user.save()
+
+@shared_task
+def notify_expiring_users():
+    """Enqueue expiration notices to all users that are about to expire.
+
+    Notices are sent in chunks of ``ACCOUNT_EXPIRES_NOTIFICATION_CHUNK_SIZE`` users, spread out so
+    that at most ``ACCOUNT_EXPIRES_NOTIFICATION_RATE`` notices are sent per minute. Users with a
+    queued notice are remembered in the cache, so running this task again does not queue them twice.
+    """
+    if settings.ACCOUNT_EXPIRES_DAYS is None:
+        return
+
+    # Users that logged in again may receive a notification the next time their account expires.
+    Notifications.objects.filter(account_expires_notified=True).exclude(
+        user__in=User.objects.expiring()).update(account_expires_notified=False)
+
+    pks = list(User.objects.expiration_notice_pending().order_by('pk').values_list('pk', flat=True))
+    queued = cache.get_many(['expiration-notice-%s' % pk for pk in pks])
+    pks = [pk for pk in pks if 'expiration-notice-%s' % pk not in queued]
+    if not pks:
+        return
+
+    chunk_size = settings.ACCOUNT_EXPIRES_NOTIFICATION_CHUNK_SIZE
+    interval = chunk_size * 60 / settings.ACCOUNT_EXPIRES_NOTIFICATION_RATE
+
+    # Remember queued users until all chunks should have been sent (plus one hour)
+    timeout = int(len(pks) / chunk_size * interval) + 3600
+    cache.set_many({'expiration-notice-%s' % pk: True for pk in pks}, timeout)
+
+    log.info('Queueing expiration notices for %s users.', len(pks))
+    for i in range(0, len(pks), chunk_size):
+        send_expiration_notices.apply_async((pks[i:i + chunk_size], ), countdown=i / chunk_size * interval)
+
+
+def send_expiration_notice(user, mailer):
+    """Send a notice that the account is about to expire to the given user."""
+
+    host = settings.XMPP_HOSTS[user.domain]
+    base_url = host['CANONICAL_BASE_URL'].rstrip('/')
+
+    # On what date the user will be removed and how many days this is from now
+    when = user.last_activity.date() + settings.ACCOUNT_EXPIRES_DAYS
+    delta = when - date.today()
+
+    context = {
+        'domain': user.domain,
+        'expires_days': settings.ACCOUNT_EXPIRES_DAYS.days,
+        'host': host,
+        'jid': user.username,
+        'login_url': '%s%s' % (base_url, reverse('account:login')),
+        'password_url': '%s%s' % (base_url, reverse('account:reset_password')),
+        'user': user,
+        'when': when,
+        'when_days': delta.days,
+    }
+
+    log.info('%s: Sending expiration notice to %s.', user, user.email)
+    with translation.override(user.default_language):
+        subject = _('Your account on {{ domain }} is about to expire')
+        user.send_mail_template('account/email/user_expires', context, subject, mailer=mailer)
+
+
+@shared_task
+def send_expiration_notices(user_pks):
+    """Send expiration notices to the given users, queued by :py:func:`~account.tasks.notify_expiring_users`.
+
+    Users that are no longer expiring or were already notified are skipped, so the task can safely be
+    executed again.
+    """
+    sent = []
+    try:
+        with Mailer() as mailer:
+            for user in User.objects.expiration_notice_pending().filter(pk__in=user_pks):
+                send_expiration_notice(user, mailer)
+                sent.append(user.pk)
+    finally:
+        Notifications.objects.filter(user_id__in=sent).update(account_expires_notified=True)
+
+
+def refresh_keys(keys, fetcher=None):
+    """Refresh the given GPG keys from the keyserver.
+
+    All keys are fetched concurrently by a :py:class:`~core.gpg.KeyFetcher` and imported into a single
+    temporary keyring. A response is only accepted if it contains exactly the requested key. Keys are then
+    saved with a single bulk update, including keys that could not be fetched (only their ``refreshed``
+    timestamp is updated), so they are not retried on every run.
+
+    Returns a dictionary mapping fingerprints to errors for keys that could not be refreshed.
+    """
+    if fetcher is None:
+        fetcher = KeyFetcher()
+
+    now = timezone.now()
+    fetched = fetcher.fetch_many([k.fingerprint for k in keys])
+    errors = {fp: e for fp, e in fetched.items() if isinstance(e, Exception)}
+    imported = {}
+
+    with gpg_backend.temp_keyring() as backend:
+        for fp, data in fetched.items():
+            if fp in errors:
+                continue
+
+            # Keys load their data lazily from the keyring, so read everything before it is removed
+            try:
+                imported_keys = backend.import_key(data)
+                fingerprints = [k.fp.upper() for k in imported_keys]
+                if fingerprints != [fp.upper()]:
+                    raise ValueError('Keyserver returned key(s) %s.' % ', '.join(fingerprints))
+                imported[fp] = (data, imported_keys[0].revoked, imported_keys[0].expires)
+            except Exception as e:
+                errors[fp] = e
+
+    for key in keys:
+        key.refreshed = now
+        if key.fingerprint not in imported:
+            continue
+
+        data, revoked, expires = imported[key.fingerprint]
+        if expires:
+            expires = timezone.make_aware(expires)
+        if (key.key, key.revoked, key.expires) != (data.decode('utf-8'), revoked, expires):
+            key.key = data.decode('utf-8')
+            key.revoked = revoked
+            key.expires = expires
+            key.updated = now
+
+    GpgKey.objects.bulk_update(keys, ['key', 'expires', 'revoked', 'updated', 'refreshed'], batch_size=100)
+
+    for fp, error in errors.items():
+        log.warning('Could not refresh GPG key %s: %s', fp, error)
+    return errors
+
+
+@shared_task
+def refresh_gpg_keys(limit=500):
+    """Periodically refresh GPG keys that expire soon or were not refreshed for some time.
+
+    At most ``limit`` keys are refreshed per run, starting with the least recently refreshed key.
+    """
+    keys = list(GpgKey.objects.refresh_pending()[:limit])
+    if not keys:
+        return
+
+    errors = refresh_keys(keys)
+    log.info('Refreshed %s GPG keys (%s errors).', len(keys), len(errors))
+
+
+def _delete_upload_file(storage, name):
+    """Delete a single uploaded file (and its directory, if empty), returns ``True`` if the file is gone."""
+
+    try:
+        storage.delete(name)
+    except Exception as e:
+        log.warning('%s: Could not delete uploaded file: %s', name, e)
+        return False
+
+    try:
+        os.rmdir(os.path.dirname(storage.path(name)))
+    except (NotImplementedError, OSError):  # not a local storage or directory not empty
+        pass
+    return True
+
+
+@shared_task
+def cleanup_uploads(chunk_size=500, workers=8):
+    """Remove expired XEP-0363 uploads and upload slots that were never used.
+
+    Expired uploads are processed in chunks ordered by primary key. Files of a chunk are deleted
+    concurrently outside of any database transaction, the rows of uploads whose files are gone are then
+    deleted in bulk and :py:class:`~account.models.UploadUsage` is updated accordingly. Rows of files that
+    could not be deleted are kept, so the file is deleted in the next run.
+    """
+    now = timezone.now()
+    put_timeout = timedelta(seconds=int(getattr(settings, 'XMPP_HTTP_UPLOAD_PUT_TIMEOUT', 360)))
+    share_timeout = timedelta(seconds=int(getattr(settings, 'XMPP_HTTP_UPLOAD_SHARE_TIMEOUT', 86400 * 30)))
+    storage = Upload._meta.get_field('file').storage
+
+    qs = Upload.objects.filter(
+        Q(file='', created__lt=now - put_timeout) | Q(created__lt=now - share_timeout)
+    ).order_by('pk')
+
+    files = freed = 0
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk = list(qs.filter(pk__gt=last_pk).values_list('pk', 'jid', 'size', 'file')[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+
+            names = [name for pk, jid, size, name in chunk if name]
+            gone = dict(zip(names, executor.map(partial(_delete_upload_file, storage), names)))
+            deleted = [(pk, jid, size, name) for pk, jid, size, name in chunk if not name or gone[name]]
+
+            usage = defaultdict(lambda: [0, 0])
+            for pk, jid, size, name in deleted:
+                usage[jid][0] -= 1
+                usage[jid][1] -= size
+
+                if name:
+                    files += 1
+                    freed += size
+
+            # UploadUsage is updated once per JID instead of once for every deleted upload.
+            with transaction.atomic(), defer_upload_usage():
+                pks = [pk for pk, jid, size, name in deleted]
+                Upload.objects.filter(pk__in=pks).delete()
+                for jid, (uploads, size) in usage.items():
+                    UploadUsage.objects.add(jid, uploads, size)
+
+    log.info('Removed %s expired uploads (%s bytes).', files, freed)
+    if files:
+        stat(STAT_UPLOADS_DELETED, files)
+        stat(STAT_UPLOADS_FREED, freed // 1024)
+    return freed
+
+
+@shared_task
+def rebuild_username_filters(error_rate=0.01):
+    """Rebuild the Bloom filters of existing usernames used by :py:class:`~account.views.UserAvailableView`.
+
+    Filters are sized for twice the current number of users, so they stay accurate as new users are added
+    until the next rebuild. Users registered while a filter is rebuilt (and might have been added to the old
+    file) are added again once the new file is in place.
+    """
+    for hostname in settings.XMPP_HOSTS:
+        username_filter = get_username_filter(hostname)
+        if username_filter is None:
+            continue
+
+        start = timezone.now()
+        qs = User.objects.host(hostname)
+        usernames = [u.lower() for u in qs.values_list('username', flat=True)]
+        BloomFilter.create(username_filter.path, usernames, capacity=max(len(usernames) * 2, 1000),
+                           error_rate=error_rate)
+
+        # Also covers users created with bulk_create(), which does not send post_save
+        for username in qs.filter(registered__gte=start).values_list('username', flat=True):
+            username_filter.add(username.lower())
+        log.info('%s: Rebuilt username filter with %s users.', hostname, len(usernames))
 
 
 @shared_task
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import doctest
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from core.tests.base import TestCase
+
+from .. import utils
+from ..constants import PURPOSE_REGISTER
+from ..constants import PURPOSE_RESET_PASSWORD
+from ..models import Confirmation
+from ..tasks import resend_confirmations
+
+User = get_user_model()
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(utils))
+    return tests
+
+
+class ConfirmationTokenTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='user@example.com', email='user@example.com')
+        self.conf = Confirmation.objects.create(user=self.user, purpose=PURPOSE_REGISTER, language='en',
+                                                to=self.user.email)
+
+    def lookup(self, token, purpose=PURPOSE_REGISTER):
+        return list(Confirmation.objects.token(token, purpose))
+
+    def test_token(self):
+        self.assertIn(self.conf.token, self.conf.urlpath)
+        self.assertEqual(self.lookup(self.conf.token), [self.conf])
+
+        # Legacy keys stored in the database still work
+        self.assertEqual(self.lookup(self.conf.key), [self.conf])
+
+    def test_invalid(self):
+        pk, expires, signature = self.conf.token.split('_')
+        invalid = [
+            'foobar',
+            '%s_%s_%s' % (pk, expires, 'a' * 40),  # wrong signature
+            '%s_%s_%s' % (pk, 'zzz', signature),  # tampered expiry
+            '%s_%s_%s' % ('zzzzzzzzzzzzzzzz', expires, signature),  # invalid base36
+        ]
+
+        with self.assertNumQueries(0):
+            for token in invalid:
+                self.assertEqual(self.lookup(token), [])
+
+            # Token for a different purpose
+            self.assertEqual(self.lookup(self.conf.token, purpose=PURPOSE_RESET_PASSWORD), [])
+
+    def test_expired(self):
+        self.conf.expires = timezone.now() - timedelta(minutes=1)
+        self.conf.save()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lookup(self.conf.token), [])
+
+    def test_deleted(self):
+        token = self.conf.token
+        self.conf.delete()
+        self.assertEqual(self.lookup(token), [])
+
+    def test_view(self):
+        client = Client()
+        response = client.get(reverse('account:register_confirm', kwargs={'key': self.conf.token}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['form'].user, self.user)
+
+        response = client.get(reverse('account:register_confirm', kwargs={'key': 'a' * 40}))
+        self.assertIsNone(response.context['form'].user)
+
+    def test_resend(self):
+        self.conf.payload = {'hostname': 'example.com', 'base_url': 'https://example.com'}
+        self.conf.save()
+
+        with self.assertLogs('account.tasks', 'WARNING') as logs:
+            resend_confirmations(self.conf.pk, self.conf.pk + 1)
+
+        self.assertEqual([m.to for m in mail.outbox], [[self.user.email]])
+        self.assertEqual(logs.output, ['WARNING:account.tasks:Confirmation(s) not found: %s' % (
+            self.conf.pk + 1)])
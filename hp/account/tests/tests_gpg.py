@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import requests
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.test import override_settings
+from django.utils import timezone
+
+from gpgliblib.base import GpgKeyNotFoundError
+
+from core.gpg import KeyFetcher
+from core.tests.base import TestCase
+
+from ..models import GpgKey
+from ..tasks import refresh_keys
+from ..tasks import send_gpg_mail_task
+
+User = get_user_model()
+
+FINGERPRINT = 'A' * 40
+
+
+@override_settings(GPG_QUEUE='gpg')
+class GpgQueueTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='user@example.com', email='user@example.com')
+        self.host = settings.XMPP_HOSTS['example.com']
+
+    def add_key(self):
+        GpgKey.objects.create(user=self.user, fingerprint=FINGERPRINT, key='dummy',
+                              expires=timezone.now() + timedelta(days=1))
+
+    def send_mail(self, **kwargs):
+        with mock.patch('celery.app.task.Task.apply_async') as mocked, \
+                mock.patch('account.models.User.send_gpg_mail') as send_gpg_mail:
+            self.user.send_mail('subject', 'text', '<p>html</p>', **kwargs)
+        send_gpg_mail.assert_not_called()
+        return mocked
+
+    def test_plain(self):
+        mocked = self.send_mail()
+        self.assertNoTasks(mocked)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # gpg_key=False always sends plain emails
+        self.add_key()
+        mocked = self.send_mail(gpg_key=False)
+        self.assertNoTasks(mocked)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_queue(self):
+        self.add_key()
+        mocked = self.send_mail()
+        self.assertEqual(len(mail.outbox), 0)
+        mocked.assert_called_once_with(
+            (self.user.pk, 'subject', 'text', '<p>html</p>', 'example.com', 'user@example.com'),
+            {'gpg_key': None}, queue='gpg')
+
+        mocked = self.send_mail(gpg_key=b'custom key')
+        mocked.assert_called_once_with(
+            (self.user.pk, 'subject', 'text', '<p>html</p>', 'example.com', 'user@example.com'),
+            {'gpg_key': 'custom key'}, queue='gpg')
+
+    def test_task(self):
+        with mock.patch('account.models.User.send_gpg_mail') as send_gpg_mail:
+            send_gpg_mail_task(self.user.pk, 'subject', 'text', '<p>html</p>', 'example.com',
+                               'user@example.com', gpg_key='custom key')
+        send_gpg_mail.assert_called_once_with('subject', 'text', '<p>html</p>', self.host,
+                                              'user@example.com', gpg_key=b'custom key', mailer=mock.ANY)
+
+
+class HkpHandler(BaseHTTPRequestHandler):
+    """A minimal HKP keyserver serving the keys in ``server.keys``."""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append((time.monotonic(), query))
+
+        search = query.get('search', [''])[0]
+        if url.path != '/pks/lookup' or query.get('op') != ['get'] or not search.startswith('0x'):
+            self.send_error(400)
+            return
+
+        key = self.server.keys.get(search[2:])
+        if key is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pgp-keys')
+        self.send_header('Content-Length', str(len(key)))
+        self.end_headers()
+        self.wfile.write(key)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFetcher(object):
+    def __init__(self, keys):
+        self.keys = keys
+
+    def fetch_many(self, fingerprints):
+        return {fp: self.keys.get(fp, requests.HTTPError('404')) for fp in fingerprints}
+
+
+class LazyKey(object):
+    """Like keys returned by the GPGME backend, data can only be loaded while the keyring exists."""
+
+    def __init__(self, keyring, data, index):
+        self.keyring = keyring
+        self.data = data
+        self.index = index
+
+    def load(self, attr):
+        if self.keyring.closed:
+            raise GpgKeyNotFoundError(self.data)
+        return self.keyring.keys[self.data][self.index][attr]
+
+    @property
+    def fp(self):
+        return self.load('fp')
+
+    @property
+    def revoked(self):
+        return self.load('revoked')
+
+    @property
+    def expires(self):
+        return self.load('expires')
+
+
+class FakeKeyring(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.closed = False
+
+    def import_key(self, data):
+        if data not in self.keys:
+            raise ValueError('Invalid key: %r' % data)
+        return [LazyKey(self, data, i) for i in range(len(self.keys[data]))]
+
+
+class FakeGpgBackend(object):
+    def __init__(self, keys):
+        self.keys = keys
+
+    @contextmanager
+    def temp_keyring(self, **kwargs):
+        keyring = FakeKeyring(self.keys)
+        try:
+            yield keyring
+        finally:
+            keyring.closed = True
+
+
+class KeyringPoolKeyTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='user@example.com', email='user@example.com')
+
+    def get_parts(self, host_key=b'private', contact_key=b'contact'):
+        pool = mock.MagicMock()
+        host = (FINGERPRINT, host_key, b'public')
+        with mock.patch('account.models.get_keyring_pool', return_value=pool), \
+                mock.patch('account.models.load_private_key', return_value=host):
+            with self.user.gpg_keyring(hostname='example.com', extra_keys={'B' * 40: contact_key}):
+                pass
+        return pool.keyring.call_args[0][1]
+
+    def test_renewed_keys(self):
+        parts = self.get_parts()
+        self.assertEqual(parts, self.get_parts())
+
+        # Renewed keys keep their fingerprint but must not reuse a keyring with the old keys
+        self.assertNotEqual(parts, self.get_parts(host_key=b'renewed'))
+        self.assertNotEqual(parts, self.get_parts(contact_key=b'renewed'))
+
+
+class KeyRefreshTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), HkpHandler)
+        self.server.keys = {
+            'A' * 40: b'key A\n',
+            'B' * 40: b'key B\n',
+        }
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.keyserver = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_fetch_many(self):
+        fetcher = KeyFetcher(self.keyserver, workers=4, delay=0)
+        keys = fetcher.fetch_many(['A' * 40, 'B' * 40, 'C' * 40, 'A' * 40])
+
+        self.assertEqual(keys['A' * 40], b'key A')
+        self.assertEqual(keys['B' * 40], b'key B')
+        self.assertIsInstance(keys['C' * 40], requests.HTTPError)
+        self.assertEqual(len(self.server.requests), 3)  # duplicates are only fetched once
+        self.assertEqual(self.server.requests[0][1]['options'], ['mr'])
+
+    def test_politeness(self):
+        fetcher = KeyFetcher(self.keyserver, workers=4, delay=0.05)
+        fingerprints = [str(i) * 40 for i in range(5)]
+        keys = fetcher.fetch_many(fingerprints)
+        self.assertEqual(len(keys), 5)
+
+        timestamps = sorted(t for t, query in self.server.requests)
+        self.assertEqual(len(timestamps), 5)
+        for first, second in zip(timestamps, timestamps[1:]):
+            self.assertGreater(second - first, 0.04)
+
+    def test_refresh_pending(self):
+        now = timezone.now()
+        user = User.objects.create(username='user@example.com', email='user@example.com')
+
+        def create(fp, expires, updated, revoked=False):
+            key = GpgKey.objects.create(user=user, fingerprint=fp * 40, key='dummy', expires=expires,
+                                        revoked=revoked)
+            GpgKey.objects.filter(pk=key.pk).update(updated=updated)  # bypass auto_now
+            return key
+
+        old = create('A', now + timedelta(days=365), now - timedelta(days=30))
+        expiring = create('B', now + timedelta(days=3), now - timedelta(days=2))
+        create('C', now + timedelta(days=365), now - timedelta(days=2))  # recently refreshed
+        create('D', now + timedelta(days=3), now - timedelta(hours=2))  # expiring, but refreshed today
+        create('E', now + timedelta(days=365), now - timedelta(days=30), revoked=True)
+
+        self.assertEqual(list(GpgKey.objects.refresh_pending(now)), [old, expiring])
+
+        # A key that was refreshed recently is not pending, even if it was not updated
+        GpgKey.objects.filter(pk=old.pk).update(refreshed=now - timedelta(days=2))
+        self.assertEqual(list(GpgKey.objects.refresh_pending(now)), [expiring])
+
+    def test_refresh_keys(self):
+        user = User.objects.create(username='user@example.com', email='user@example.com')
+        expires = timezone.now() + timedelta(days=3)
+        keys = [GpgKey.objects.create(user=user, fingerprint=fp * 40, key='key %s' % fp, expires=expires)
+                for fp in 'ABCDEFG']
+        updated = {key.fingerprint[0]: key.updated for key in keys}
+
+        fetcher = FakeFetcher({
+            'A' * 40: b'new key A',
+            'B' * 40: b'new key B',
+            'C' * 40: b'invalid',
+            'E' * 40: b'other key',  # keyserver returns a different key
+            'F' * 40: b'two keys',  # keyserver returns the requested key and another one
+            'G' * 40: b'key G',  # key did not change
+        })
+
+        def key(fp, revoked=False, expires=None):
+            return {'fp': fp * 40, 'revoked': revoked, 'expires': expires}
+
+        backend = FakeGpgBackend({
+            b'new key A': [key('A', expires=datetime(2030, 1, 1))],
+            b'new key B': [key('B', revoked=True)],
+            b'other key': [key('X')],
+            b'two keys': [key('F'), key('X')],
+            b'key G': [key('G', expires=timezone.make_naive(expires))],
+        })
+        with mock.patch('account.tasks.gpg_backend', backend), self.assertLogs('account.tasks', 'WARNING'):
+            errors = refresh_keys(keys, fetcher=fetcher)
+        self.assertEqual(set(errors), {'C' * 40, 'D' * 40, 'E' * 40, 'F' * 40})
+        self.assertIn('XXXX', str(errors['E' * 40]))
+
+        keys = {key.fingerprint[0]: key for key in GpgKey.objects.all()}
+        self.assertEqual((keys['A'].key, keys['A'].revoked), ('new key A', False))
+        self.assertEqual(keys['A'].expires, timezone.make_aware(datetime(2030, 1, 1)))
+        self.assertGreater(keys['A'].updated, updated['A'])
+        self.assertEqual((keys['B'].key, keys['B'].revoked, keys['B'].expires), ('new key B', True, None))
+
+        # Keys that could not be refreshed or did not change are only marked as refreshed, so they are not
+        # retried on every run and cached keyrings stay valid.
+        for fp in 'CDEFG':
+            self.assertEqual((keys[fp].key, keys[fp].expires), ('key %s' % fp, expires))
+            self.assertEqual(keys[fp].updated, updated[fp])
+            self.assertIsNotNone(keys[fp].refreshed)
@@ -14,11 +14,13 @@
 # not, see <http://www.gnu.org/licenses/>.
 
 from datetime import datetime
+from unittest import mock
 
 import pytz
 from freezegun import freeze_time
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import Client
 from django.urls import reverse
 
@@ -26,6 +28,8 @@ from xmpp_backends.django import xmpp_backend
 
 from core.tests.base import TestCase
 
+from ..tasks import set_last_activity_task
+
 User = get_user_model()
 NOW = datetime(2017, 4, 23, 11, 22, 33)
 NOW_UTC = pytz.utc.localize(NOW)
@@ -33,6 +37,8 @@ NOW_STR = '2017-04-23 11:22:33+00:00'
 NOW2 = datetime(2017, 4, 23, 12, 23, 34)
 NOW2_UTC = pytz.utc.localize(NOW2)
 NOW2_STR = '2017-04-23 12:23:34+00:00'
+NOW3 = datetime(2017, 4, 23, 12, 23, 50)
+NOW3_STR = '2017-04-23 12:23:50+00:00'
 
 NODE = 'user'
 DOMAIN = 'example.com'
@@ -46,6 +52,7 @@ PWD2 = 'oJsfiLCwshha'
 class LoginTestCase(TestCase):
     def setUp(self):
         super().setUp()
+        cache.clear()
 
         self.user = User.objects.create(
             username=JID, email=EMAIL, confirmed=NOW_UTC, created_in_backend=True, last_activity=NOW_UTC)
@@ -63,7 +70,8 @@ class LoginTestCase(TestCase):
                 'username_0': NODE, 'username_1': DOMAIN, 'password': PWD,
             }, follow=True)
 
-        self.assertNoTasks(mocked)
+        self.assertTaskCount(mocked, 1)
+        self.assertIsTask(mocked.call_args[0][0], set_last_activity_task)
         self.assertFalse(post.context['user'].is_anonymous)
         self.assertEqual(post.status_code, 200)
         self.assertEqual(post.resolver_match.app_names, ['account'])
@@ -71,6 +79,26 @@ class LoginTestCase(TestCase):
 
         # Last activity gets updated on login
         self.assertEqual(xmpp_backend.get_last_activity(NODE, DOMAIN), NOW2)
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_activity, NOW2_UTC)
+
+    def test_coalesce_last_activity(self):
+        # Task is not executed, so the second login falls into the same update window
+        with mock.patch('celery.app.task.Task.apply_async') as mocked:
+            with freeze_time(NOW2_STR):
+                self.client.post(self.url, {'username_0': NODE, 'username_1': DOMAIN, 'password': PWD})
+            self.client.logout()
+            with freeze_time(NOW3_STR):
+                self.client.post(self.url, {'username_0': NODE, 'username_1': DOMAIN, 'password': PWD})
+
+        self.assertTaskCount(mocked, 1)
+
+        # local last activity is updated immediately, the backend only after the task runs
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_activity, pytz.utc.localize(NOW3))
+        self.assertEqual(xmpp_backend.get_last_activity(NODE, DOMAIN), NOW)
+
+        with freeze_time(NOW3_STR):  # or the cache entry already expired
+            set_last_activity_task(self.user.pk)
+        self.assertEqual(xmpp_backend.get_last_activity(NODE, DOMAIN), NOW3)
 
     def test_failed_login(self):
         with self.mock_celery() as mocked, freeze_time(NOW2_STR):
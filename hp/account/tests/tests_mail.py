@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.utils import translation
+
+from core.tests.base import TestCase
+
+from .. import models
+from ..constants import PURPOSE_RESET_PASSWORD
+from ..models import Confirmation
+
+User = get_user_model()
+
+
+class SubjectTemplateTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        models._subject_templates.clear()
+        self.user = User.objects.create(username='user@example.com', email='user@example.com')
+
+    def send(self, language):
+        conf = Confirmation.objects.create(
+            user=self.user, to=self.user.email, purpose=PURPOSE_RESET_PASSWORD, language=language,
+            payload={'hostname': 'example.com', 'base_url': 'https://example.com'})
+        conf.send()
+        return mail.outbox[-1].subject
+
+    def test_cache(self):
+        self.assertEqual(self.send('en'), 'Reset your password on example.com')
+        self.assertEqual(self.send('en'), 'Reset your password on example.com')
+        self.assertEqual(len(models._subject_templates), 1)
+
+        # Subjects are compiled in the language of the confirmation, not the currently active language
+        with translation.override('en'):
+            self.send('de')
+        self.assertEqual([k[1] for k in sorted(models._subject_templates)], ['de', 'en'])
+
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command('benchmark_confirmations', self.user.username, '--render', '-n', '5', stdout=stdout)
+        self.assertTrue(stdout.getvalue().startswith('Rendered: 5 emails in'))
@@ -15,18 +15,23 @@
 
 from datetime import datetime
 from datetime import timedelta
+from unittest import mock
 
 import pytz
 from freezegun import freeze_time
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.cache import cache
 from django.test import override_settings
 
 from xmpp_backends.django import xmpp_backend
 
 from core.tests.base import TestCase
 
+from ..models import Notifications
+from ..tasks import notify_expiring_users
+from ..tasks import send_expiration_notices
 from ..tasks import update_last_activity
 
 User = get_user_model()
@@ -56,6 +61,10 @@ PWD2 = 'password456'
 
 
 class AccountExpiresTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
     @override_settings(ACCOUNT_EXPIRES_NOTIFICATION_DAYS=timedelta(days=355),
                        ACCOUNT_EXPIRES_DAYS=timedelta(days=365))
     def test_expiring(self):
@@ -71,7 +80,7 @@ class AccountExpiresTestCase(TestCase):
             update_last_activity()
 
         user = User.objects.get(username=JID)
-        self.assertTaskCount(mocked, 0)
+        self.assertTaskCall(mocked, notify_expiring_users)
         self.assertEqual(len(mail.outbox), 0)  # no mails where sent yet (user is not expiring)
         self.assertEqual(user.last_activity, LAST_ACTIVITY_2)  # new last activity from backend
 
@@ -81,7 +90,7 @@ class AccountExpiresTestCase(TestCase):
             self.assertFalse(user.notifications.account_expires_notified)
             update_last_activity()
 
-        self.assertTaskCount(mocked, 0)
+        self.assertTaskCount(mocked, 2)  # notify_expiring_users and send_expiration_notices
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(user.last_activity, LAST_ACTIVITY_2)  # last activity stays the same
 
@@ -97,7 +106,7 @@ class AccountExpiresTestCase(TestCase):
             update_last_activity()
 
         user = User.objects.get(username=JID)
-        self.assertTaskCount(mocked, 0)
+        self.assertTaskCall(mocked, notify_expiring_users)
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(user.last_activity, LAST_ACTIVITY_2)  # last activity stays the same
 
@@ -114,7 +123,7 @@ class AccountExpiresTestCase(TestCase):
 
         # no mail is sent
         user = User.objects.get(username=JID)
-        self.assertTaskCount(mocked, 0)
+        self.assertTaskCall(mocked, notify_expiring_users)
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(user.last_activity, NOW_3)
 
@@ -122,3 +131,39 @@ class AccountExpiresTestCase(TestCase):
             self.assertFalse(user.is_expiring)
             self.assertTrue(user.notifications.account_expires)
             self.assertFalse(user.notifications.account_expires_notified)
+
+    @override_settings(ACCOUNT_EXPIRES_NOTIFICATION_DAYS=timedelta(days=355),
+                       ACCOUNT_EXPIRES_DAYS=timedelta(days=365),
+                       ACCOUNT_EXPIRES_NOTIFICATION_CHUNK_SIZE=2, ACCOUNT_EXPIRES_NOTIFICATION_RATE=4)
+    def test_chunks(self):
+        users = [User.objects.create(username='user%s@example.com' % i, email='user%s@example.com' % i,
+                                     last_activity=LAST_ACTIVITY_2, confirmed=LAST_ACTIVITY_1)
+                 for i in range(5)]
+        pks = [u.pk for u in users]
+
+        # Users that do not want to be notified or are already notified are not queued
+        Notifications.objects.filter(user=users[3]).update(account_expires=False)
+        Notifications.objects.filter(user=users[4]).update(account_expires_notified=True)
+
+        with mock.patch('celery.app.task.Task.apply_async') as mocked, freeze_time(NOW_2_STR):
+            notify_expiring_users()
+
+        self.assertEqual(mocked.call_args_list, [
+            mock.call((pks[:2], ), countdown=0),
+            mock.call((pks[2:3], ), countdown=30),
+        ])
+
+        # Running the task again does not queue anything, users are remembered in the cache
+        with mock.patch('celery.app.task.Task.apply_async') as mocked, freeze_time(NOW_2_STR):
+            notify_expiring_users()
+        self.assertNoTasks(mocked)
+
+        # Send the first chunk twice, the second run does not send any emails
+        with freeze_time(NOW_2_STR):
+            send_expiration_notices(pks[:2])
+            send_expiration_notices(pks[:2])
+        self.assertEqual([m.to for m in mail.outbox], [[users[0].email], [users[1].email]])
+        self.assertEqual(
+            list(Notifications.objects.filter(account_expires_notified=True).order_by('pk').values_list(
+                'user_id', flat=True)),
+            [pks[0], pks[1], pks[4]])
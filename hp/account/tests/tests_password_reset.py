@@ -107,7 +107,7 @@ class RegisterSeleniumTests(SeleniumTestCase):
         self.find('#id_new_password1').send_keys(PWD2)
         self.find('#id_new_password2').send_keys(PWD2)
         self.wait_for_valid_form()
-        with freeze_time(NOW2_STR):
+        with self.mock_celery(), freeze_time(NOW2_STR):
             self.find('button[type="submit"]').click()
             self.wait_for_page_load()
 
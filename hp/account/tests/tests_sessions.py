@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client
+from django.test import override_settings
+from django.urls import reverse
+
+from xmpp_backends.django import xmpp_backend
+
+from core.tests.base import TestCase
+
+from ..tasks import refresh_user_sessions_task
+
+User = get_user_model()
+
+NODE = 'user'
+DOMAIN = 'example.com'
+JID = '%s@%s' % (NODE, DOMAIN)
+PWD = 'GVIhRx5y3uH2'
+
+
+class SessionsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        self.user = User.objects.create(username=JID, email='user@example.com', created_in_backend=True)
+        xmpp_backend.create_user(NODE, DOMAIN, PWD)
+        xmpp_backend.start_user_session(NODE, DOMAIN, 'res1')
+
+        self.url = reverse('account:sessions')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def get_resources(self):
+        with self.mock_celery() as mocked:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return mocked, [s['resource'] for s in response.context['sessions']]
+
+    def test_cached(self):
+        mocked, resources = self.get_resources()
+        self.assertEqual(resources, ['res1'])
+        self.assertNoTasks(mocked)
+
+        # New session is not yet visible, because the list is cached
+        xmpp_backend.start_user_session(NODE, DOMAIN, 'res2')
+        mocked, resources = self.get_resources()
+        self.assertEqual(resources, ['res1'])
+        self.assertNoTasks(mocked)
+
+    @override_settings(USER_SESSIONS_CACHE_TTL=timedelta(seconds=-1))
+    def test_stale(self):
+        self.get_resources()
+
+        # The stale list is displayed, but a refresh is triggered (mock_celery runs it right away).
+        xmpp_backend.start_user_session(NODE, DOMAIN, 'res2')
+        mocked, resources = self.get_resources()
+        self.assertEqual(resources, ['res1'])
+        self.assertTaskCall(mocked, refresh_user_sessions_task, user_pk=self.user.pk)
+
+        mocked, resources = self.get_resources()
+        self.assertEqual(sorted(resources), ['res1', 'res2'])
+
+    def test_stop_session(self):
+        xmpp_backend.start_user_session(NODE, DOMAIN, 'res2')
+        self.assertEqual(sorted(self.get_resources()[1]), ['res1', 'res2'])
+
+        stop_url = reverse('account:api-stop-user-session', kwargs={'resource': 'res2'})
+        response = self.client.delete(stop_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_resources()[1], ['res1'])
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import Client
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from xmpp_http_upload.models import Upload
+
+from core.tests.base import TestCase
+from stats.constants import STAT_UPLOADS_DELETED
+from stats.constants import STAT_UPLOADS_FREED
+from stats.models import Event
+
+from ..models import UploadUsage
+from ..tasks import cleanup_uploads
+
+User = get_user_model()
+
+JID = 'user@example.com'
+ACCESS = (
+    ('.*', {
+        'max_file_size': 1000,
+        'max_total_size': 10000,
+        'bytes_per_timedelta': {
+            'delta': timedelta(hours=1),
+            'bytes': 3000,
+        },
+        'uploads_per_timedelta': {
+            'delta': timedelta(days=1),
+            'uploads': 10,
+        },
+    }),
+)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_ACCESS=ACCESS)
+class HttpUploadViewTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        self.user = User.objects.create(username=JID, email='user@example.com', confirmed=timezone.now(),
+                                        created_in_backend=True)
+        self.url = reverse('account:xep0363')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def upload(self, size, age=timedelta(0), file='file.txt', jid=JID):
+        upload = Upload.objects.create(jid=jid, name='file.txt', size=size, hash='a' * 64, file=file)
+        if age:  # bypass auto_now_add
+            Upload.objects.filter(pk=upload.pk).update(created=timezone.now() - age)
+        return upload
+
+    def get_limits(self, **kwargs):
+        response = self.client.get(self.url, kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response, {row['header']: row for row in response.context['limits']}
+
+    def test_usage(self):
+        first = self.upload(100)
+        self.upload(200, file='')  # requested slot, but no file uploaded
+        self.upload(300, jid='other@example.com')
+        self.assertEqual(UploadUsage.objects.get(jid=JID).size, 300)
+        self.assertEqual(UploadUsage.objects.get(jid=JID).uploads, 2)
+
+        first.delete()
+        self.assertEqual(UploadUsage.objects.get(jid=JID).size, 200)
+        self.assertEqual(UploadUsage.objects.get(jid=JID).uploads, 1)
+
+        Upload.objects.filter(jid=JID).delete()
+        self.assertEqual(UploadUsage.objects.get(jid=JID).size, 0)
+        self.assertEqual(UploadUsage.objects.get(jid=JID).uploads, 0)
+        self.assertEqual(UploadUsage.objects.get(jid='other@example.com').size, 300)
+
+    def test_limits(self):
+        self.upload(1000)
+        self.upload(1000, age=timedelta(hours=2))
+        self.upload(1000, age=timedelta(days=2))
+
+        with CaptureQueriesContext(connection) as queries:
+            response, limits = self.get_limits()
+
+        # One query for all time-based limits, one for counting and one for listing uploads
+        upload_queries = [q for q in queries if 'xmpp_http_upload_upload' in q['sql']]
+        self.assertEqual(len(upload_queries), 3)
+        self.assertContains(response, 'file.txt')
+        self.assertTrue(response.context['can_upload'])
+        self.assertEqual(limits['Total bytes']['current'], '2.9\xa0KB')
+        self.assertEqual(limits['Bytes/one hour']['current'], '1000\xa0bytes')
+        self.assertEqual(limits['Uploads/one day']['current'], 2)
+
+        self.upload(2000)
+        response, limits = self.get_limits()
+        self.assertFalse(response.context['can_upload'])
+        self.assertTrue(limits['Bytes/one hour']['exceeded'])
+        self.assertNotIn('exceeded', limits['Total bytes'])
+
+    def test_pagination(self):
+        uploads = [self.upload(10) for i in range(60)]
+
+        response = self.client.get(self.url)
+        self.assertTrue(response.context['is_paginated'])
+        self.assertEqual(list(response.context['uploads']), uploads[::-1][:50])
+
+        response = self.client.get(self.url, {'page': 2})
+        self.assertEqual(list(response.context['uploads']), uploads[::-1][50:])
+
+
+class UploadCleanupTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.override = self.settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def upload(self, name, age, content=b'', jid=JID):
+        upload = Upload.objects.create(jid=jid, name=name, size=len(content) or 100, hash=name * 8)
+        if content:
+            upload.file.save(name, ContentFile(content))
+        Upload.objects.filter(pk=upload.pk).update(created=timezone.now() - age)
+        return upload
+
+    def test_cleanup(self):
+        expired = [self.upload(str(i), timedelta(days=40), b'x' * 2048) for i in range(5)]
+        current = self.upload('a', timedelta(days=1), b'current')
+        slot = self.upload('b', timedelta(hours=1))  # requested an hour ago, but never uploaded
+        new_slot = self.upload('c', timedelta(seconds=10))
+        self.upload('d', timedelta(days=40), b'other', jid='other@example.com')
+
+        self.assertEqual(cleanup_uploads(chunk_size=2), 5 * 2048 + 5)
+        self.assertEqual(set(Upload.objects.all()), {current, new_slot})
+        for upload in expired:
+            self.assertFalse(os.path.exists(os.path.dirname(upload.file.path)))
+        self.assertTrue(os.path.exists(current.file.path))
+
+        usage = UploadUsage.objects.get(jid=JID)
+        self.assertEqual((usage.uploads, usage.size), (2, len(b'current') + new_slot.size))
+        self.assertEqual(UploadUsage.objects.get(jid='other@example.com').size, 0)
+        self.assertFalse(Upload.objects.filter(pk=slot.pk).exists())
+
+        self.assertEqual(Event.objects.get(metric=STAT_UPLOADS_DELETED).value, 6)
+        self.assertEqual(Event.objects.get(metric=STAT_UPLOADS_FREED).value, 10)
+
+    def test_failed_delete(self):
+        self.upload('a', timedelta(days=40), b'a')
+        failed = self.upload('b', timedelta(days=40), b'b')
+
+        delete = Upload._meta.get_field('file').storage.delete
+
+        def side_effect(name):
+            if name == failed.file.name:
+                raise OSError('Permission denied')
+            return delete(name)
+
+        with mock.patch.object(Upload._meta.get_field('file').storage, 'delete', side_effect=side_effect), \
+                self.assertLogs('account.tasks', 'WARNING'):
+            self.assertEqual(cleanup_uploads(), 1)
+
+        # The row is kept, so the next run can try again
+        self.assertEqual(list(Upload.objects.all()), [failed])
+        self.assertEqual(UploadUsage.objects.get(jid=JID).uploads, 1)
+
+        self.assertEqual(cleanup_uploads(), 1)
+        self.assertFalse(Upload.objects.exists())
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.bloom import BloomFilter
+from core.tests.base import TestCase
+
+from ..tasks import rebuild_username_filters
+from ..utils import _username_filters
+from ..utils import get_username_filter
+
+User = get_user_model()
+
+
+class UsernameFilterTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = self.settings(USERNAME_FILTER_DIR=self.tmpdir.name)
+        self.override.enable()
+
+        User.objects.create(username='existing@example.com')
+        self.url = reverse('account:api-check-user')
+        self.client = Client()
+
+    def tearDown(self):
+        # Filters are cached in the module and keep their file mapped
+        for bloom_filter in _username_filters.values():
+            bloom_filter.close()
+        _username_filters.clear()
+
+        self.override.disable()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def check(self, username, domain='example.com', queries=None):
+        with CaptureQueriesContext(connection) as captured:
+            status = self.client.post(self.url, {'username': username, 'domain': domain}).status_code
+
+        if queries is not None:
+            self.assertEqual(len([q for q in captured if 'account_user' in q['sql']]), queries)
+        return status
+
+    def test_no_filter(self):
+        # The filter was not yet built, so the database is queried
+        self.assertEqual(self.check('new', queries=1), 200)
+        self.assertEqual(self.check('existing'), 409)
+
+    def test_filter(self):
+        rebuild_username_filters()
+        self.assertIn('existing@example.com', get_username_filter('example.com'))
+
+        self.assertEqual(self.check('new', queries=0), 200)
+        self.assertEqual(self.check('Existing', queries=1), 409)
+
+        # New users are added to the filter immediately
+        User.objects.create(username='new2@example.com')
+        self.assertIn('new2@example.com', get_username_filter('example.com'))
+        self.assertEqual(self.check('new2'), 409)
+
+    def test_unknown_domain(self):
+        self.assertIsNone(get_username_filter('../example.com'))
+        self.assertEqual(self.check('new', domain='../example.com'), 200)
+
+    def test_registered_during_rebuild(self):
+        create = BloomFilter.create
+
+        def side_effect(path, *args, **kwargs):
+            # Registered after the snapshot of existing users and added to the old file
+            if path == get_username_filter('example.com').path:
+                User.objects.create(username='during@example.com')
+                User.objects.bulk_create([User(username='bulk@example.com')])
+            return create(path, *args, **kwargs)
+
+        with mock.patch('account.tasks.BloomFilter.create', side_effect=side_effect):
+            rebuild_username_filters()
+
+        username_filter = get_username_filter('example.com')
+        self.assertIn('existing@example.com', username_filter)
+        self.assertIn('during@example.com', username_filter)
+        self.assertIn('bulk@example.com', username_filter)
+
+    def test_unconfigured_hosts(self):
+        # Hosts without a filter do not prevent rebuilding filters of other hosts
+        filters = [None, get_username_filter('example.com')]
+        with mock.patch('account.tasks.get_username_filter', side_effect=filters), \
+                self.settings(XMPP_HOSTS={'example.net': {}, 'example.com': {}}):
+            rebuild_username_filters()
+        self.assertIn('existing@example.com', get_username_filter('example.com'))
+        self.assertNotIn('new@example.com', get_username_filter('example.com'))  # file was created
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import time
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.utils.crypto import salted_hmac
+from django.utils.http import base36_to_int
+from django.utils.http import int_to_base36
+
+from core.bloom import BloomFilter
+
+_username_filters = {}
+
+LEGACY_KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+"""Format of keys stored in the database, used by confirmations created before signed tokens."""
+
+
+def _confirmation_hmac(pk, purpose, expires):
+    return salted_hmac('account.Confirmation', '%s:%s:%s' % (pk, purpose, expires)).hexdigest()
+
+
+def make_confirmation_token(pk, purpose, expires):
+    """Create a signed token for the confirmation with the given primary key.
+
+    The token has the form ``<pk>_<expires>_<hmac>``, where ``pk`` and ``expires`` (a UNIX timestamp) are
+    base36 encoded, so it can be verified without any database access.
+
+    >>> make_confirmation_token(1, 'register', 1600000000)[:9]
+    '1_qgljwg_'
+    """
+    return '%s_%s_%s' % (int_to_base36(pk), int_to_base36(expires), _confirmation_hmac(pk, purpose, expires))
+
+
+def parse_confirmation_token(token, purpose, now=None):
+    """Verify a token created by :py:func:`make_confirmation_token`.
+
+    Returns a tuple of the primary key and the expiry timestamp or ``None`` if the token is malformed, the
+    signature does not match or the token has expired.
+
+    >>> token = make_confirmation_token(1, 'register', 1600000000)
+    >>> parse_confirmation_token(token, 'register', now=1500000000)
+    (1, 1600000000)
+    >>> parse_confirmation_token(token, 'reset', now=1500000000) is None  # different purpose
+    True
+    >>> parse_confirmation_token(token, 'register', now=1700000000) is None  # expired
+    True
+    """
+    if now is None:
+        now = time.time()
+
+    parts = token.split('_')
+    if len(parts) != 3:
+        return None
+
+    try:
+        pk = base36_to_int(parts[0])
+        expires = base36_to_int(parts[1])
+    except ValueError:
+        return None
+
+    if expires < now or not constant_time_compare(parts[2], _confirmation_hmac(pk, purpose, expires)):
+        return None
+    return pk, expires
+
+
+def get_username_filter(domain):
+    """Get the :py:class:`~core.bloom.BloomFilter` of usernames for the given domain.
+
+    Returns ``None`` if the ``USERNAME_FILTER_DIR`` setting is ``None`` or the domain is not configured
+    in the ``XMPP_HOSTS`` setting.
+    """
+    if not settings.USERNAME_FILTER_DIR or domain not in settings.XMPP_HOSTS:
+        return None
+
+    path = os.path.join(settings.USERNAME_FILTER_DIR, '%s.bloom' % domain)
+    if _username_filters.get(domain) is None or _username_filters[domain].path != path:
+        _username_filters[domain] = BloomFilter(path)
+    return _username_filters[domain]
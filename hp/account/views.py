@@ -26,7 +26,10 @@ from django.contrib.auth import login
 from django.contrib.auth import logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.cache import cache
+from django.core.paginator import Paginator
 from django.db import transaction
+from django.db.models import Count
+from django.db.models import Q
 from django.db.models import Sum
 from django.http import HttpResponse
 from django.http import HttpResponseForbidden
@@ -99,9 +102,14 @@ from .forms import PasswordChangeForm
 from .forms import ResetPasswordForm
 from .forms import SetEmailForm
 from .models import Confirmation
+from .models import UploadUsage
 from .tasks import add_gpg_key_task
+from .tasks import get_user_sessions
+from .tasks import invalidate_user_sessions
+from .tasks import schedule_last_activity
 from .tasks import send_confirmation_task
 from .tasks import set_email_task
+from .utils import get_username_filter
 
 User = get_user_model()
 log = logging.getLogger(__name__)
@@ -243,7 +251,7 @@ class ConfirmationMixin(object):
     def key(self):
         if self._key is None:
             try:
-                self._key = self.queryset.valid().get(key=self.kwargs['key'])
+                self._key = self.queryset.valid().token(self.kwargs['key'], self.purpose).get()
             except Confirmation.DoesNotExist:
                 name, ext = os.path.splitext(self.template_name)
                 template = '%s_not_found%s' % (name, ext)
@@ -277,6 +285,7 @@ class ConfirmRegistrationView(KeyUserConfirmationMixin, FormView):
     """View for confirming a registration e-mail."""
 
     form_class = ConfirmRegistrationForm
+    purpose = PURPOSE_REGISTER
     queryset = _confirmation_qs.purpose(PURPOSE_REGISTER)
     success_url = reverse_lazy('account:detail')
     template_name = 'account/user_register_confirm.html'
@@ -341,9 +350,7 @@ class LoginView(AntiSpamMixin, AnonymousRequiredMixin, HomepageViewMixin, FormVi
         # Okay, security check complete. Log the user in.
         login(self.request, user)
         user.last_activity = now
-        xmpp_backend.set_last_activity(user.node, user.domain,
-                                       status='Logged in via homepage.',
-                                       timestamp=now)
+        schedule_last_activity(user, now, status='Logged in via homepage.')
         user.save()
         return HttpResponseRedirect(redirect_to)
 
@@ -404,6 +411,7 @@ class ResetPasswordView(AntiSpamMixin, AnonymousRequiredMixin, HomepageViewMixin
 
 class ConfirmResetPasswordView(KeyUserConfirmationMixin, FormView):
     form_class = ConfirmResetPasswordForm
+    purpose = PURPOSE_RESET_PASSWORD
     queryset = _confirmation_qs.purpose(PURPOSE_RESET_PASSWORD)
     success_url = reverse_lazy('account:detail')
     template_name = 'account/user_password_reset_confirm.html'
@@ -420,7 +428,7 @@ class ConfirmResetPasswordView(KeyUserConfirmationMixin, FormView):
         with transaction.atomic():
             xmpp_backend.set_password(username=key.user.node, domain=key.user.domain,
                                       password=form.cleaned_data['new_password1'])
-            xmpp_backend.set_last_activity(key.user.node, key.user.domain, timestamp=now)
+            schedule_last_activity(key.user, now)
 
             key.user.last_activity = now
             key.user.log(gettext_noop('Set new password.'), address)
@@ -442,7 +450,7 @@ class SessionsView(LoginRequiredMixin, AccountPageMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super(SessionsView, self).get_context_data(**kwargs)
         user = self.request.user
-        context['sessions'] = xmpp_backend.user_sessions(user.node, user.domain)
+        context['sessions'] = get_user_sessions(user)
         return context
 
 
@@ -579,13 +587,14 @@ class ConfirmSetEmailView(LoginRequiredMixin, RedirectView):
     """Confirmation view for a user setting his email address, redirects to account detail page."""
 
     pattern_name = 'account:detail'  # where to redirect to
+    purpose = PURPOSE_SET_EMAIL
     queryset = _confirmation_qs.purpose(PURPOSE_SET_EMAIL)
 
     def get_redirect_url(self, *args, **kwargs):
         request = self.request
         user = request.user
         qs = self.queryset.filter(user=user)
-        key = get_object_or_404(qs, key=kwargs['key'])
+        key = get_object_or_404(qs.token(kwargs['key'], self.purpose))
 
         user.email = key.to
         # Compute the normalized email address
@@ -616,6 +625,33 @@ class ConfirmSetEmailView(LoginRequiredMixin, RedirectView):
 class HttpUploadView(LoginRequiredMixin, AccountPageMixin, UserObjectMixin, DetailView):
     usermenu_item = 'account:xep0363'
     template_name = 'account/xep0363.html'
+    paginate_by = 50
+
+    def get_window_usage(self, qs, limit_config, now):
+        """Get the usage for all time-based limits with a single query.
+
+        Returns a dictionary with keys of the form ``"bytes_<seconds>"`` and ``"uploads_<seconds>"``. Only
+        uploads within the largest window have to be read by the database.
+        """
+        aggregates = {}
+        for key in ['bytes_per_timedelta', 'uploads_per_timedelta']:
+            if key not in limit_config:
+                continue
+
+            delta = limit_config[key]['delta']
+            window = Q(created__gt=now - delta)
+            name = '%s_%d' % (key.split('_')[0], delta.total_seconds())
+            if key == 'bytes_per_timedelta':
+                aggregates[name] = Sum('size', filter=window)
+            else:
+                aggregates[name] = Count('pk', filter=window)
+
+        if not aggregates:
+            return {}
+
+        oldest = now - max(limit_config[k]['delta'] for k in ['bytes_per_timedelta', 'uploads_per_timedelta']
+                           if k in limit_config)
+        return qs.filter(created__gt=oldest).aggregate(**aggregates)
 
     def get_context_data(self, **kwargs):
         context = super(HttpUploadView, self).get_context_data(**kwargs)
@@ -623,7 +659,13 @@ class HttpUploadView(LoginRequiredMixin, AccountPageMixin, UserObjectMixin, Deta
         qs = Upload.objects.filter(jid=user.username)
 
         # If a client requests an upload slot but never uploads the file, file field will be empty
-        context['uploads'] = qs.exclude(file='')
+        paginator = Paginator(qs.exclude(file='').order_by('-created', '-pk'), self.paginate_by)
+        page = paginator.get_page(self.request.GET.get('page'))
+        context['paginator'] = paginator
+        context['page_obj'] = page
+        context['is_paginated'] = page.has_other_pages()
+        context['uploads'] = page.object_list
+
         limit_config = get_config(user.username)
         if limit_config is False:
             context['limits'] = False
@@ -633,10 +675,12 @@ class HttpUploadView(LoginRequiredMixin, AccountPageMixin, UserObjectMixin, Deta
             context['limits'] = []
             context['can_upload'] = True
             now = timezone.now()
+            usage = self.get_window_usage(qs, limit_config, now)
 
             for key, value in limit_config.items():
                 if key == 'max_total_size':
-                    current = qs.aggregate(total=Sum('size'))['total'] or 0
+                    current = UploadUsage.objects.filter(jid=user.username).values_list('size', flat=True)
+                    current = max(current.first() or 0, 0)
                     limit = max(value - current, 0)
 
                     row = {
@@ -658,7 +702,7 @@ class HttpUploadView(LoginRequiredMixin, AccountPageMixin, UserObjectMixin, Deta
                 elif key == 'bytes_per_timedelta':
                     delta = value['delta']
                     quota = value['bytes']
-                    current = qs.filter(created__gt=now - delta).aggregate(total=Sum('size'))['total'] or 0
+                    current = usage['bytes_%d' % delta.total_seconds()] or 0
                     limit = max(quota - current, 0)
 
                     row = {
@@ -673,7 +717,7 @@ class HttpUploadView(LoginRequiredMixin, AccountPageMixin, UserObjectMixin, Deta
                 elif key == 'uploads_per_timedelta':
                     delta = value['delta']
                     quota = value['uploads']
-                    current = qs.filter(created__gt=now - delta).count()
+                    current = usage['uploads_%d' % delta.total_seconds()]
                     limit = max(quota - current, 0)
 
                     row = {
@@ -771,6 +815,7 @@ class ConfirmDeleteAccountView(LoginRequiredMixin, AccountPageMixin, FormView):
     usermenu_item = 'account:delete'
     form_class = DeleteAccountForm
     template_name = 'account/delete_confirm.html'
+    purpose = PURPOSE_DELETE
     queryset = _confirmation_qs.purpose(PURPOSE_DELETE)
 
     def form_valid(self, form):
@@ -784,7 +829,7 @@ class ConfirmDeleteAccountView(LoginRequiredMixin, AccountPageMixin, FormView):
             return self.form_invalid(form)
 
         # Verify the confirmation key
-        key = get_object_or_404(self.queryset.filter(user=user), key=self.kwargs['key'])
+        key = get_object_or_404(self.queryset.filter(user=user).token(self.kwargs['key'], self.purpose))
 
         # Log the user out, delete data
         logout(request)
@@ -812,6 +857,11 @@ class UserAvailableView(View):
         elif exists is False:
             return HttpResponse('')
 
+        # The username is definitely available if it is not in the Bloom filter
+        username_filter = get_username_filter(domain)
+        if username_filter is not None and jid not in username_filter:
+            return HttpResponse('')
+
         # Check if the user exists in the database
         if User.objects.filter(username=jid).exists():
             cache.set(cache_key, True, 30)
@@ -835,6 +885,7 @@ class StopUserSessionView(LoginRequiredMixin, View):
             user.node, user.domain, resource,
             str(_('This session was forcefully stopped via our homepage.'))
         )
+        invalidate_user_sessions(user)
         return HttpResponse('ok')
 
 
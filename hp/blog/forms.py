@@ -15,10 +15,11 @@
 
 from django import forms
 from django.template import Context
-from django.template import Template
 from django.test import RequestFactory
 from django.utils.translation import gettext_lazy as _
 
+from .utils import compile_template
+
 _meta_help = _('For search engines. Max. 160 characters, '
                '<span class="test-length">160</span> left.')
 _twitter_help = _('At most 200 characters, <span class="test-length">200</span> left.')
@@ -28,7 +29,7 @@ class BasePageAdminForm(forms.ModelForm):
     def test_render_template(self, template):
         request = RequestFactory().get('/')
         context = Context({'request': request})
-        Template('{%% load blog core icons %%}%s' % template).render(context)
+        compile_template(template).render(context)
 
     def clean_text_en(self):
         data = self.cleaned_data['text_en']
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Generate resized derivatives of uploaded images.
+
+Derivatives are generated for every width in the ``BLOG_IMAGE_WIDTHS`` setting that is smaller than
+the original image, both in the format of the original image and in every format in the
+``BLOG_IMAGE_FORMATS`` setting. File names contain a hash of the file content, so they can be cached
+forever by browsers.
+"""
+
+import hashlib
+import io
+import logging
+import os
+
+from PIL import Image as PILImage
+from PIL import ImageOps
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+DERIVATIVE_DIR = 'derivatives'
+"""Directory (in the storage of the image) where derivatives are stored."""
+
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', {'quality': 60}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', {'optimize': True}),
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 6}),
+}
+"""Supported formats, mapping the name used in settings to the Pillow format, the MIME type and options
+passed to :py:meth:`PIL.Image.Image.save`."""
+
+SOURCE_FORMATS = {
+    'JPEG': 'jpeg',
+    'PNG': 'png',
+}
+"""Formats of original images that derivatives are generated for."""
+
+
+def get_formats():
+    """Get the configured formats that can be written by the installed version of Pillow.
+
+    AVIF for example requires a Pillow plugin.
+    """
+    PILImage.init()
+
+    formats = []
+    for name in settings.BLOG_IMAGE_FORMATS:
+        if name not in FORMATS or FORMATS[name][0] not in PILImage.SAVE:
+            log.warning('%s: Image format is not supported.', name)
+            continue
+        formats.append(name)
+    return formats
+
+
+def get_name(source, width, fmt, data):
+    """Get the file name for a derivative.
+
+    >>> get_name('example/screenshot.png', 640, 'webp', b'data')
+    'derivatives/screenshot.3a6eb0790f39ac87.640w.webp'
+    """
+    base = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    return '%s/%s.%s.%sw.%s' % (DERIVATIVE_DIR, base, digest, width, fmt)
+
+
+def encode(image, fmt):
+    """Encode a Pillow image in the given format, returns the raw bytes."""
+
+    pil_format, _mime, options = FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buf = io.BytesIO()
+    image.save(buf, pil_format, **options)
+    return buf.getvalue()
+
+
+def generate(stream, source):
+    """Generate derivatives of an image.
+
+    Parameters
+    ----------
+
+    stream : file-like object
+        The original image.
+    source : str
+        The name of the original image, used for the names of derivatives.
+
+    Returns
+    -------
+
+    size : tuple or None
+        The width and height of the original image or ``None`` if the file is not an image Pillow can
+        read (e.g. an SVG file).
+    derivatives : list of tuple
+        A tuple of the name, width, height, format and data for every derivative.
+    """
+
+    try:
+        image = PILImage.open(stream)
+        image.load()
+    except (OSError, SyntaxError):  # Pillow raises SyntaxError for some broken files
+        return None, []
+
+    source_format = SOURCE_FORMATS.get(image.format)
+    if source_format is None or getattr(image, 'is_animated', False):
+        return image.size, []
+
+    # Apply the orientation from EXIF data, derivatives do not include EXIF data
+    image = ImageOps.exif_transpose(image)
+    width, height = image.size
+
+    formats = [source_format] + [f for f in get_formats() if f != source_format]
+    derivatives = []
+    for target_width in sorted(set(settings.BLOG_IMAGE_WIDTHS)):
+        if target_width >= width:
+            break
+
+        target_height = max(round(height * target_width / width), 1)
+        resized = image.resize((target_width, target_height), PILImage.LANCZOS)
+        for fmt in formats:
+            data = encode(resized, fmt)
+            derivatives.append((get_name(source, target_width, fmt, data), target_width, target_height, fmt,
+                                data))
+
+    # The original image in other formats (usually much smaller)
+    for fmt in formats[1:]:
+        data = encode(image, fmt)
+        derivatives.append((get_name(source, width, fmt, data), width, height, fmt, data))
+
+    return (width, height), derivatives
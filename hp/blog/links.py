@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Resolve links to pages and blog posts, as used by the ``{% page %}``, ``{% post %}`` and ``{% page_url %}``
+template tags.
+
+Links are resolved by a :py:class:`~blog.links.LinkResolver` attached to the current request. When a page
+is rendered, all links that can be determined when compiling the template are resolved at once, so a page
+with many links does not issue a query for every link. Resolved links are also stored in the cache, so
+further requests usually do not need any queries at all. Cached links are invalidated when a page or blog
+post is saved.
+"""
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models
+from django.template.base import Variable
+from django.template.library import SimpleNode
+from django.utils import translation
+
+LINK_TAGS = {
+    'page': 'blog.Page',
+    'page_url': 'blog.Page',
+    'post': 'blog.BlogPost',
+}
+"""Mapping of template tags in ``blog.templatetags.blog`` to the model they link to."""
+
+
+def get_cache_key(label, pk):
+    return 'blog_link_%s_%s' % (label, pk)
+
+
+def get_slug_cache_key(label, slug):
+    return 'blog_slug_%s_%s' % (label, slug)
+
+
+class Link(object):
+    """A resolved link to a page or blog post, holds the URL and title in every language."""
+
+    def __init__(self, pk, slugs, urls, titles):
+        self.pk = pk
+        self.slugs = slugs
+        self.urls = urls
+        self.titles = titles
+
+    @classmethod
+    def from_object(cls, obj):
+        slugs, urls, titles = set(), {}, {}
+        for language, _name in settings.LANGUAGES:
+            slug = getattr(obj.slug, language)
+            if slug:
+                slugs.add(slug)
+            titles[language] = getattr(obj.title, language)
+            with translation.override(language):
+                urls[language] = obj.get_absolute_url()
+
+        return cls(obj.pk, slugs, urls, titles)
+
+    @property
+    def language(self):
+        return (translation.get_language() or settings.LANGUAGE_CODE).split('-')[0]
+
+    @property
+    def url(self):
+        return self.urls[self.language]
+
+    @property
+    def title(self):
+        return self.titles[self.language]
+
+
+def get_literal(expr):
+    """Get the value of a FilterExpression if it is a literal, otherwise return ``None``."""
+    if expr.filters:
+        return None
+    if isinstance(expr.var, Variable):
+        return expr.var.literal  # None if this is a variable lookup
+    return expr.var  # a string literal
+
+
+def collect_links(nodelist):
+    """Collect links to pages and blog posts in a compiled template.
+
+    Returns a dictionary mapping model labels to a set of primary keys and slugs. Links where the page is
+    given as template variable are not included.
+    """
+    links = {}
+    for node in nodelist.get_nodes_by_type(SimpleNode):
+        label = LINK_TAGS.get(node.func.__name__)
+        if label is None or node.func.__module__ != 'blog.templatetags.blog' or not node.args:
+            continue
+
+        value = get_literal(node.args[0])
+        if isinstance(value, (int, str)):
+            links.setdefault(label, set()).add(value)
+    return links
+
+
+class LinkResolver(object):
+    """Resolves links to pages and blog posts, memoizing all results.
+
+    Use :py:func:`~blog.links.get_link_resolver` to get the resolver for the current request.
+    """
+
+    def __init__(self):
+        self.links = {}
+
+    def resolve(self, label, refs):
+        """Resolve the given primary keys and slugs for the given model.
+
+        Links are looked up in the cache first, any links not found in the cache are resolved in a single
+        query.
+        """
+        refs = {ref for ref in refs if (label, ref) not in self.links}
+        if not refs:
+            return
+
+        pks = {ref for ref in refs if isinstance(ref, int)}
+        slugs = refs - pks
+
+        # Slugs are cached as mapping to the primary key
+        slug_keys = {get_slug_cache_key(label, slug): slug for slug in slugs}
+        slug_pks = {slug_keys[k]: pk for k, pk in cache.get_many(slug_keys).items()}
+
+        link_keys = {get_cache_key(label, pk): pk for pk in pks | set(slug_pks.values())}
+        cached = {link_keys[k]: link for k, link in cache.get_many(link_keys).items()}
+
+        for pk in pks:
+            if pk in cached:
+                self.links[(label, pk)] = cached[pk]
+        for slug, pk in slug_pks.items():
+            link = cached.get(pk)
+            if link is not None and slug in link.slugs:  # slug might have changed in the meantime
+                self.links[(label, slug)] = link
+
+        missing = {ref for ref in refs if (label, ref) not in self.links}
+        if not missing:
+            return
+
+        model = apps.get_model(label)
+        query = models.Q(pk__in=[ref for ref in missing if isinstance(ref, int)])
+        missing_slugs = [ref for ref in missing if isinstance(ref, str)]
+        if missing_slugs:
+            SlugLookup = apps.get_model('blog', 'SlugLookup')
+            query |= models.Q(pk__in=SlugLookup.objects.filter(
+                content_type=ContentType.objects.get_for_model(model), slug__in=missing_slugs
+            ).values('object_id'))
+
+        to_cache = {}
+        for obj in model.objects.filter(query):
+            link = Link.from_object(obj)
+            to_cache[get_cache_key(label, link.pk)] = link
+            for slug in link.slugs:
+                to_cache[get_slug_cache_key(label, slug)] = link.pk
+
+            for ref in missing & ({link.pk} | link.slugs):
+                self.links[(label, ref)] = link
+        cache.set_many(to_cache)
+
+        # Remember links that could not be resolved, so they are not queried again
+        for ref in missing:
+            self.links.setdefault((label, ref), None)
+
+    def prefetch(self, links):
+        """Resolve links as returned by :py:func:`~blog.links.collect_links`."""
+        for label, refs in links.items():
+            self.resolve(label, refs)
+
+    def get(self, label, ref):
+        """Get the :py:class:`~blog.links.Link` for a primary key or slug or ``None`` if it does not exist."""
+        self.resolve(label, [ref])
+        return self.links[(label, ref)]
+
+
+def get_link_resolver(request):
+    """Get the resolver for the given request, returns a new resolver if ``request`` is ``None``."""
+    if request is None:
+        return LinkResolver()
+
+    if getattr(request, 'blog_links', None) is None:
+        request.blog_links = LinkResolver()
+    return request.blog_links
+
+
+def get_linking_objects(label, refs):
+    """Get all pages and blog posts with a template that links to one of ``refs`` of the given model.
+
+    Only objects that contain one of the relevant template tags are compiled, see
+    :py:func:`~blog.models.BasePage.links_to`.
+
+    Parameters
+    ----------
+
+    label : str
+        The label of the model linked to, e.g. ``"blog.Page"``.
+    refs : set
+        Primary keys and slugs of the objects linked to.
+    """
+    tags = [tag for tag, tag_label in LINK_TAGS.items() if tag_label == label]
+    regex = r'\{%%\s*(%s)\s' % '|'.join(tags)
+
+    for model in [apps.get_model('blog', 'Page'), apps.get_model('blog', 'BlogPost')]:
+        query = models.Q()
+        for field in model.TEMPLATE_FIELDS:
+            for language, _name in settings.LANGUAGES:
+                query |= models.Q(**{'%s_%s__regex' % (field, language): regex})
+
+        for obj in model.objects.filter(query):
+            if obj.links_to(label, refs):
+                yield obj
+
+
+def invalidate_link(obj):
+    cache.delete(get_cache_key(obj._meta.label, obj.pk))
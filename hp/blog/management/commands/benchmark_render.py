@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test import override_settings
+from django.utils import translation
+
+from core.stats import LatencyHistogram
+
+from ...models import BlogPost
+from ...utils import get_fallback_request
+from ...utils import template_cache
+
+
+class Command(BaseCommand):
+    help = "Benchmark rendering a blog post the same way as a page view does."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--count', type=int, default=1000, metavar='N',
+            help='Number of times to render the post (default: %(default)s).')
+        parser.add_argument(
+            '--language', default='en', help='Language used for rendering (default: %(default)s).')
+        parser.add_argument('post', type=int, help="Primary key of the blog post to render.")
+
+    def render(self, post, request):
+        # Same calls as BlogPostView and the feeds
+        post.render_from_request(request)
+        post.get_meta_summary(request)
+        post.get_twitter_summary(request)
+        post.get_opengraph_summary(request)
+        post.get_html_summary(request)
+
+    def run(self, label, post, request, count):
+        hist = LatencyHistogram(keep_samples=True)
+        start = time.monotonic()
+
+        for i in range(count):
+            render_start = time.monotonic()
+            self.render(post, request)
+            hist.observe((time.monotonic() - render_start) * 1000)
+
+        total = time.monotonic() - start
+        self.stdout.write('%s: %s views in %.2fs (%.1f/s), mean %.2fms, p50 %s, p95 %s, p99 %s' % (
+            label, count, total, count / total, hist.mean, hist.format_percentile(50),
+            hist.format_percentile(95), hist.format_percentile(99)))
+
+    def handle(self, post, count, language, **options):
+        try:
+            post = BlogPost.objects.get(pk=post)
+        except BlogPost.DoesNotExist:
+            raise CommandError('%s: Blog post does not exist.' % post)
+
+        with translation.override(language):
+            request = get_fallback_request(post.get_absolute_url())
+
+            with override_settings(BLOG_TEMPLATE_CACHE_SIZE=0):
+                self.run('Uncached', post, request, count)
+
+            template_cache.clear()
+            self.run('Cached', post, request, count)
+            self.stdout.write('Template cache: %s hits, %s misses' % (
+                template_cache.hits, template_cache.misses))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.stats import LatencyHistogram
+
+from ...models import Page
+from ...models import SearchDocument
+from ...models import SearchTerm
+from ...search import get_weights
+from ...search import search
+
+
+class Command(BaseCommand):
+    help = "Benchmark searching pages and blog posts."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--count', type=int, default=1000, metavar='N',
+            help='Number of searches to run (default: %(default)s).')
+        parser.add_argument(
+            '--language', default='en', help='Language to search in (default: %(default)s).')
+        parser.add_argument(
+            '--generate', type=int, default=0, metavar='DOCS',
+            help='Generate DOCS random documents first, they are removed again when the benchmark is done.')
+        parser.add_argument(
+            'queries', nargs='*', default=['w1', 'w3 w80', 'w20 w300 w4000', 'w7 w9999'],
+            help='Queries to run, generated documents use words "w0" to "w9999".')
+
+    def generate(self, count, language):
+        # Word frequencies in natural language roughly follow Zipf's law
+        words = ['w%s' % i for i in range(10000)]
+        weights = [1 / (i + 1) for i in range(len(words))]
+        content_type = ContentType.objects.get_for_model(Page)
+
+        start = time.monotonic()
+        for offset in range(0, count, 500):
+            documents = []
+            for i in range(offset, min(offset + 500, count)):
+                title = ' '.join(random.choices(words, weights, k=5))
+                text = ' '.join(random.choices(words, weights, k=300))
+                documents.append(SearchDocument(
+                    content_type=content_type, object_id=10 ** 9 + i, language=language, title=title,
+                    url='/p/%s/' % i, text=text))
+            SearchDocument.objects.bulk_create(documents)
+
+            documents = SearchDocument.objects.filter(object_id__gte=10 ** 9 + offset, language=language,
+                                                      object_id__lt=10 ** 9 + offset + 500)
+            SearchTerm.objects.bulk_create([
+                SearchTerm(document=doc, language=language, term=term, weight=weight)
+                for doc in documents for term, weight in get_weights(doc.title, doc.text, language).items()
+            ])
+        self.stdout.write('Generated %s documents in %.2fs.' % (count, time.monotonic() - start))
+
+    def handle(self, queries, count, language, generate, **options):
+        with transaction.atomic():
+            if generate:
+                self.generate(generate, language)
+
+            hist = LatencyHistogram(keep_samples=True)
+            start = time.monotonic()
+            for i in range(count):
+                search_start = time.monotonic()
+                for result in search(queries[i % len(queries)], language):
+                    result.snippet  # rendered by the view as well
+                hist.observe((time.monotonic() - search_start) * 1000)
+
+            total = time.monotonic() - start
+            self.stdout.write('%s searches in %.2fs (%.1f/s), mean %.2fms, p50 %s, p95 %s, p99 %s' % (
+                count, total, count / total, hist.mean, hist.format_percentile(50),
+                hist.format_percentile(95), hist.format_percentile(99)))
+
+            # Remove generated documents again
+            transaction.set_rollback(True)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...models import Image
+
+
+def update(pk):
+    """Update derivatives of a single image, returns an error message if it fails."""
+    try:
+        Image.objects.get(pk=pk).update_derivatives()
+    except Exception as e:
+        return '%s: %s' % (pk, e)
+
+
+class Command(BaseCommand):
+    help = "Generate resized derivatives of all images."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p', '--processes', type=int, default=os.cpu_count(), metavar='N',
+            help='Number of processes to use, resizing images is CPU bound (default: %(default)s).')
+
+    def handle(self, processes, **options):
+        pks = list(Image.objects.order_by('pk').values_list('pk', flat=True))
+        start = time.monotonic()
+
+        if processes > 1:
+            # Forked processes must not share the database connection of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                errors = list(executor.map(update, pks))
+        else:
+            errors = [update(pk) for pk in pks]
+
+        for error in filter(None, errors):
+            self.stderr.write(error)
+        self.stdout.write('Updated %s images in %.2fs.' % (len(pks), time.monotonic() - start))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import BaseCommand
+
+from ...models import BlogPost
+from ...models import Page
+
+
+class Command(BaseCommand):
+    help = "Update the search index for all pages and blog posts."
+
+    def handle(self, **options):
+        for model in [Page, BlogPost]:
+            for obj in model.objects.all():
+                obj.update_search_index()
@@ -0,0 +1,66 @@
+# Generated by Django 3.0.4 on 2026-10-19 10:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_slug_lookups(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    SlugLookup = apps.get_model('blog', 'SlugLookup')
+
+    lookups = []
+    conflicts = []
+    for model_name in ['page', 'blogpost']:
+        model = apps.get_model('blog', model_name)
+        content_type, _created = ContentType.objects.get_or_create(app_label='blog', model=model_name)
+        used = {}  # maps slugs to the primary key of the first object using it
+
+        for obj in model.objects.order_by('pk'):
+            slugs = {}
+            for language, _name in settings.LANGUAGES:
+                slug = getattr(obj, 'slug_%s' % language)
+                if slug:
+                    slugs.setdefault(slug, language)
+
+            for slug, language in slugs.items():
+                if slug in used:
+                    conflicts.append('%s %s: Slug "%s" (%s) is already used by %s %s.' % (
+                        model_name, obj.pk, slug, language, model_name, used[slug]))
+                    continue
+
+                used[slug] = obj.pk
+                lookups.append(SlugLookup(content_type=content_type, object_id=obj.pk, slug=slug,
+                                          language=language))
+
+    # Slugs used by different objects in different languages were allowed before, so they cannot be
+    # resolved automatically. Fail with a clear message instead of an IntegrityError.
+    if conflicts:
+        raise RuntimeError('Slugs must be unique across languages, please change these slugs and run '
+                           'the migration again:\n%s' % '\n'.join(conflicts))
+    SlugLookup.objects.bulk_create(lookups, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('blog', '0007_stored_summaries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlugLookup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.CharField(max_length=255)),
+                ('language', models.CharField(choices=[('de', 'German'), ('en', 'English')], max_length=8)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'unique_together': {('content_type', 'slug')},
+            },
+        ),
+        migrations.RunPython(populate_slug_lookups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.4 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_slug_lookup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blogpost',
+            index=models.Index(fields=['-sticky', '-created', '-id'], name='blog_blogpost_order_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.0.4 on 2026-10-19 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('blog', '0009_blogpost_order_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('language', models.CharField(choices=[('de', 'German'), ('en', 'English')], max_length=8)),
+                ('title', models.CharField(max_length=255)),
+                ('url', models.CharField(max_length=255)),
+                ('text', models.TextField(help_text='The rendered text without any HTML.')),
+                ('public_from', models.DateTimeField(db_index=True, help_text='Only show the document in results after this date.', null=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(choices=[('de', 'German'), ('en', 'English')], max_length=8)),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.FloatField()),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='blog.SearchDocument')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchterm',
+            index=models.Index(fields=['language', 'term', '-weight', 'document'], name='blog_searchterm_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchterm',
+            unique_together={('document', 'term')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchdocument',
+            unique_together={('content_type', 'object_id', 'language')},
+        ),
+    ]
@@ -13,6 +13,8 @@
 # You should have received a copy of the GNU General Public License along with this project. If
 # not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import logging
 import re
 
 import bleach
@@ -20,11 +22,24 @@ from lxml import html
 
 from django import template
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
 from django.core.files.storage import default_storage
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
+from django.utils import translation
+from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
@@ -33,17 +48,94 @@ from core.modelfields import LocalizedTextField
 from core.models import BaseModel
 from core.utils import canonical_link
 
+from . import images
+from . import search
+from .links import Link
+from .links import get_link_resolver
+from .links import get_linking_objects
+from .links import invalidate_link
+from .querysets import PUBLISHED_COUNT_CACHE_KEY
 from .querysets import BlogPostQuerySet
 from .querysets import PageQuerySet
+from .utils import compile_template
+from .utils import get_fallback_request
+from .utils import template_cache
 
 if settings.BLOG_MEDIA_ROOT:
     fs = FileSystemStorage(location=settings.BLOG_MEDIA_ROOT, base_url=settings.BLOG_MEDIA_URL)
 else:
     fs = default_storage
 
+log = logging.getLogger(__name__)
+
+
+class SlugLookup(models.Model):
+    """Lookup table for slugs of pages and blog posts in any language.
+
+    Rows are kept in sync by signal handlers whenever a page or blog post is saved, so that an object can be
+    found by its slug in any language with a single indexed lookup. If an object uses the same slug in
+    multiple languages, there is only one row with the first language using it.
+    """
+
+    slug = models.CharField(max_length=255)
+    language = models.CharField(max_length=8, choices=settings.LANGUAGES)
+    content_type = models.ForeignKey(ContentType, models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+
+    class Meta:
+        unique_together = ('content_type', 'slug')
+
+    def __str__(self):
+        return self.slug
+
+
+class SearchDocument(models.Model):
+    """The text of a page or blog post in one language, as indexed for searching.
+
+    See :py:mod:`blog.search` for more information.
+    """
+
+    content_type = models.ForeignKey(ContentType, models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    language = models.CharField(max_length=8, choices=settings.LANGUAGES)
+    title = models.CharField(max_length=255)
+    url = models.CharField(max_length=255)
+    text = models.TextField(help_text=_('The rendered text without any HTML.'))
+    public_from = models.DateTimeField(null=True, db_index=True, help_text=_(
+        'Only show the document in results after this date.'))
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'language')
+
+    def __str__(self):
+        return self.title
+
+
+class SearchTerm(models.Model):
+    """A stemmed word used in a document, with its weight for ranking search results."""
+
+    document = models.ForeignKey(SearchDocument, models.CASCADE, related_name='terms')
+    language = models.CharField(max_length=8, choices=settings.LANGUAGES)
+    term = models.CharField(max_length=64)
+    weight = models.FloatField()
+
+    class Meta:
+        unique_together = ('document', 'term')
+        indexes = [
+            # Used for champion lists, includes the document, so searching only has to read the index
+            models.Index(fields=['language', 'term', '-weight', 'document'], name='blog_searchterm_idx'),
+        ]
+
+    def __str__(self):
+        return self.term
+
 
 class BasePage(BaseModel):
     objects = PageQuerySet.as_manager()
+    search_documents = GenericRelation(SearchDocument)
+    slug_lookups = GenericRelation(SlugLookup)
 
     title = LocalizedCharField(max_length=255, help_text=_('Page title'))
     slug = LocalizedCharField(max_length=255, unique=True, help_text=_('Slug (used in URLs)'))
@@ -64,20 +156,81 @@ class BasePage(BaseModel):
     html_summary = LocalizedTextField(blank=True, null=True, verbose_name="HTML", help_text=_(
         'Any length, but must be valid HTML. Shown in RSS feeds.'))
 
-    def render_template(self, text, request, extra_context=None):
+    # Summaries computed when the object is saved, see update_summaries()
+    stored_meta_summary = LocalizedTextField(blank=True, null=True, editable=False)
+    stored_twitter_summary = LocalizedTextField(blank=True, null=True, editable=False)
+    stored_opengraph_summary = LocalizedTextField(blank=True, null=True, editable=False)
+    stored_html_summary = LocalizedTextField(blank=True, null=True, editable=False)
+
+    STORED_SUMMARIES = ('meta', 'twitter', 'opengraph', 'html')
+    TEMPLATE_FIELDS = ('text', 'meta_summary', 'twitter_summary', 'opengraph_summary')
+
+    def get_template(self, field, text=None):
+        """Get the compiled template for the given field in the current language.
+
+        Templates of saved objects are cached in :py:data:`~blog.utils.template_cache`. The ``updated``
+        timestamp is part of the cache key, so saving the object invalidates any cached templates.
+
+        Parameters
+        ----------
+
+        field : str
+            Name of the field, e.g. ``"text"``.
+        text : str, optional
+            The text to compile, the default is the value of the field in the current language.
+        """
+        if text is None:
+            text = getattr(self, field).current
+        if self.pk is None:
+            return compile_template(text)
+
+        key = (self._meta.label, self.pk, field, translation.get_language(), self.updated)
+        return template_cache.get(key, text)
+
+    def render_template(self, text, request, extra_context=None, field=None):
         if extra_context is None:
             extra_context = {}
         context = template.RequestContext(request, extra_context)
 
-        t = '{%% load blog core icons %%}%s' % text
-        return template.Template(t).render(context)
+        if field is None:
+            return self.render_compiled(compile_template(text), context)
+        return self.render_compiled(self.get_template(field, text), context)
+
+    def render_compiled(self, compiled, context):
+        """Render a template returned by :py:func:`~blog.models.BasePage.get_template`.
+
+        All links to other pages and blog posts are resolved before rendering, so that rendering does not
+        issue a query for every link.
+        """
+        request = getattr(context, 'request', None) or context.get('request')
+        get_link_resolver(request).prefetch(compiled.blog_links)
+        return compiled.render(context)
+
+    def links_to(self, label, refs):
+        """``True`` if a template of this object links to one of ``refs`` of the given model.
+
+        Only links collected by :py:func:`~blog.links.collect_links` are considered, templates that cannot be
+        compiled are ignored.
+        """
+        for language, _name in settings.LANGUAGES:
+            with translation.override(language):
+                for field in self.TEMPLATE_FIELDS:
+                    if not getattr(self, field).current:
+                        continue
+
+                    try:
+                        links = self.get_template(field).blog_links
+                    except template.TemplateSyntaxError:
+                        continue
+                    if links.get(label, set()) & refs:
+                        return True
+        return False
 
     def render(self, context, summary=False):
         if summary is True:
             return mark_safe(self.get_html_summary(context['request']))
         else:
-            t = '{%% load blog core icons %%}%s' % self.text.current
-            return template.Template(t).render(context)
+            return self.render_compiled(self.get_template('text'), context)
 
     def render_from_request(self, request, extra_context=None):
         if extra_context is None:
@@ -87,7 +240,7 @@ class BasePage(BaseModel):
         return self.render(context)
 
     def get_text_summary(self, request):
-        rendered = self.render_template(self.text.current, request)
+        rendered = self.render_template(self.text.current, request, field='text')
         text = html.fromstring(rendered).text_content()
         return re.sub('[\r\n]+', '\n', text).split('\n', 1)[0].strip(' \n').strip()
 
@@ -114,30 +267,31 @@ class BasePage(BaseModel):
             summary = new_summary
         return summary.strip()
 
-    def get_meta_summary(self, request):
+    def compute_meta_summary(self, request):
         if self.meta_summary.current:
-            return self.render_template(self.meta_summary.current, request)
+            return self.render_template(self.meta_summary.current, request, field='meta_summary')
 
         full_summary = self.get_text_summary(request)
         if len(full_summary) <= 160:
             return full_summary
         return self.crop_summary(full_summary, 160).strip()
 
-    def get_twitter_summary(self, request):
+    def compute_twitter_summary(self, request):
         if self.twitter_summary.current:
-            return self.render_template(self.twitter_summary.current, request)
+            return self.render_template(self.twitter_summary.current, request, field='twitter_summary')
         if self.meta_summary.current:
-            return self.render_template(self.meta_summary.current, request)
+            return self.render_template(self.meta_summary.current, request, field='meta_summary')
 
         full_summary = self.get_text_summary(request)
         if len(full_summary) <= 200:
             return full_summary
         return self.crop_summary(full_summary, 200).strip()
 
-    def get_opengraph_summary(self, request):
+    def compute_opengraph_summary(self, request):
         if self.opengraph_summary.current:
-            return self.render_template(self.opengraph_summary.current.strip(), request)
-        twitter_summary = self.get_twitter_summary(request)
+            return self.render_template(self.opengraph_summary.current.strip(), request,
+                                        field='opengraph_summary')
+        twitter_summary = self.compute_twitter_summary(request)
         if twitter_summary:
             return twitter_summary
 
@@ -153,7 +307,7 @@ class BasePage(BaseModel):
         }
         return bleach.clean(html, tags=tags, attributes=attrs, strip=True)
 
-    def get_html_summary(self, request):
+    def compute_html_summary(self, request):
         if self.html_summary.current:
             return self.cleanup_html(self.html_summary.current)
 
@@ -162,6 +316,182 @@ class BasePage(BaseModel):
         html = ' '.join(self.get_sentences(summary)[:3]).strip()
         return self.cleanup_html(html)
 
+    def get_stored_summary(self, kind, request):
+        """Get a summary stored by :py:func:`~blog.models.BasePage.update_summaries`.
+
+        If no summary is stored in the current language (e.g. because it is still computed by a Celery
+        task), the summary is computed for the given request. Meta, Twitter and OpenGraph summaries are
+        escaped, so all summaries are safe to include in HTML.
+        """
+        stored = getattr(self, 'stored_%s_summary' % kind).current
+        if stored is not None:
+            return mark_safe(stored)
+        return self.compute_summary(kind, request)
+
+    def compute_summary(self, kind, request):
+        """Compute the given summary (``"meta"``, ``"twitter"``, ``"opengraph"`` or ``"html"``)."""
+
+        summary = getattr(self, 'compute_%s_summary' % kind)(request)
+        if kind == 'html':
+            return summary
+        return conditional_escape(summary)
+
+    def get_meta_summary(self, request):
+        return self.get_stored_summary('meta', request)
+
+    def get_twitter_summary(self, request):
+        return self.get_stored_summary('twitter', request)
+
+    def get_opengraph_summary(self, request):
+        return self.get_stored_summary('opengraph', request)
+
+    def get_html_summary(self, request):
+        return self.get_stored_summary('html', request)
+
+    def compute_summaries(self):
+        """Compute all summaries in all languages.
+
+        Summaries are rendered with :py:func:`~blog.utils.get_fallback_request`, so template tags that
+        depend on the request behave as if an anonymous user viewed the default site. If rendering fails
+        in one language, the summaries in that language are ``None`` and will be computed when requested.
+
+        Returns a dictionary of field names and their values.
+        """
+        values = {}
+        for language, _name in settings.LANGUAGES:
+            with translation.override(language):
+                fields = {'stored_%s_summary_%s' % (kind, language): None for kind in self.STORED_SUMMARIES}
+                try:
+                    request = get_fallback_request(self.get_absolute_url())
+                    for kind in self.STORED_SUMMARIES:
+                        fields['stored_%s_summary_%s' % (kind, language)] = self.compute_summary(
+                            kind, request)
+                except Exception as e:
+                    log.exception('%s: Could not compute summaries in %s: %s', self._meta.label, language, e)
+                    fields = {k: None for k in fields}
+            values.update(fields)
+        return values
+
+    def clear_summaries(self):
+        for kind in self.STORED_SUMMARIES:
+            getattr(self, 'stored_%s_summary' % kind).all = None
+
+    def update_summaries(self):
+        """Compute all summaries and store them in the database.
+
+        The object is updated with a query, so this does not modify the ``updated`` timestamp or send
+        any signals.
+        """
+        values = self.compute_summaries()
+        type(self).objects.filter(pk=self.pk).update(**values)
+        for field, value in values.items():
+            setattr(self, field, value)
+
+    def get_slugs(self):
+        """Get a dictionary mapping slugs to the first language using it."""
+        slugs = {}
+        for language, _name in settings.LANGUAGES:
+            slug = getattr(self.slug, language)
+            if slug:
+                slugs.setdefault(slug, language)
+        return slugs
+
+    def validate_slugs(self, slugs=None):
+        """Raise ``ValidationError`` if a slug is already used by another object of the same type.
+
+        Slugs are unique for every language, but we also need them to be unique across languages.
+        """
+        if slugs is None:
+            slugs = self.get_slugs()
+
+        content_type = ContentType.objects.get_for_model(self)
+        qs = SlugLookup.objects.filter(content_type=content_type, slug__in=slugs)
+        if self.pk is not None:
+            qs = qs.exclude(object_id=self.pk)
+
+        errors = {}
+        for lookup in qs:
+            for language, _name in settings.LANGUAGES:
+                if getattr(self.slug, language) == lookup.slug:
+                    errors['slug_%s' % language] = _('This slug is already used in a different language.')
+        if errors:
+            raise ValidationError(errors)
+
+    def clean(self):
+        super().clean()
+        self.validate_slugs()
+
+    def save(self, *args, **kwargs):
+        # Signal handlers update SlugLookup rows, which fails if the object was not validated. Save in a
+        # transaction so that the object is never saved without its lookups.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def update_slug_lookups(self):
+        """Update :py:class:`~blog.models.SlugLookup` rows for this object.
+
+        Raises ``ValidationError`` if a slug is already used by another object of the same type.
+        """
+
+        slugs = self.get_slugs()
+        self.validate_slugs(slugs)
+        existing = {lookup.slug: lookup for lookup in self.slug_lookups.all()}
+
+        stale = [lookup.pk for slug, lookup in existing.items() if slug not in slugs]
+        if stale:
+            SlugLookup.objects.filter(pk__in=stale).delete()
+
+        created = []
+        for slug, language in slugs.items():
+            if slug not in existing:
+                created.append(SlugLookup(content_object=self, slug=slug, language=language))
+            elif existing[slug].language != language:
+                SlugLookup.objects.filter(pk=existing[slug].pk).update(language=language)
+        SlugLookup.objects.bulk_create(created)
+
+    def get_plain_text(self, request):
+        """Get the rendered text without any HTML."""
+        rendered = self.render_from_request(request)
+        if not rendered.strip():
+            return ''
+        return ' '.join(html.fromstring(rendered).text_content().split())
+
+    def update_search_index(self):
+        """Update the search index for this object in all languages.
+
+        Unpublished objects are removed from the index. Like summaries, texts are rendered with
+        :py:func:`~blog.utils.get_fallback_request`.
+        """
+        if not self.published:
+            self.search_documents.all().delete()
+            return
+
+        for language, _name in settings.LANGUAGES:
+            title = getattr(self.title, language) or ''
+            if not title and not getattr(self.text, language):
+                self.search_documents.filter(language=language).delete()
+                continue
+
+            with translation.override(language):
+                url = self.get_absolute_url()
+                try:
+                    text = self.get_plain_text(get_fallback_request(url))
+                except Exception as e:
+                    log.exception('%s: Could not index text in %s: %s', self._meta.label, language, e)
+                    continue
+
+            content_type = ContentType.objects.get_for_model(self)
+            with transaction.atomic():
+                document, _created = SearchDocument.objects.update_or_create(
+                    content_type=content_type, object_id=self.pk, language=language,
+                    defaults={'title': title, 'url': url, 'text': text,
+                              'public_from': getattr(self, 'publication_date', None)})
+                document.terms.all().delete()
+                SearchTerm.objects.bulk_create([
+                    SearchTerm(document=document, language=language, term=term, weight=weight)
+                    for term, weight in search.get_weights(title, text, language).items()
+                ])
+
     def get_canonical_url(self):
         """Get the full canonical URL of this object."""
         return canonical_link(self.get_absolute_url())
@@ -197,10 +527,211 @@ class BlogPost(BasePage):
     def __str__(self):
         return self.title.current
 
+    class Meta:
+        indexes = [
+            # matches BlogPostQuerySet.blog_order()
+            models.Index(fields=['-sticky', '-created', '-id'], name='blog_blogpost_order_idx'),
+        ]
+
+
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=BlogPost)
+def update_slug_lookups(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.update_slug_lookups()
+
+
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=BlogPost)
+@receiver(post_delete, sender=Page)
+@receiver(post_delete, sender=BlogPost)
+def invalidate_cached_link(sender, instance, **kwargs):
+    invalidate_link(instance)
+
+
+@receiver(post_save, sender=BlogPost)
+@receiver(post_delete, sender=BlogPost)
+def invalidate_published_count(sender, instance, **kwargs):
+    cache.delete(PUBLISHED_COUNT_CACHE_KEY)
+
+
+@receiver(pre_save, sender=Page)
+@receiver(pre_save, sender=BlogPost)
+def remember_link(sender, instance, raw=False, **kwargs):
+    """Remember how links to the object looked like before saving, see ``update_linking_summaries()``."""
+    instance._old_link = None
+    if not raw and instance.pk is not None:
+        old = sender.objects.filter(pk=instance.pk).first()
+        if old is not None:
+            instance._old_link = Link.from_object(old)
+
+
+@receiver(pre_save, sender=Page)
+@receiver(pre_save, sender=BlogPost)
+def clear_stored_summaries(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.clear_summaries()
+
+
+def is_large(instance):
+    """Large texts take long to render, so rendered data is computed by a Celery task."""
+    size = max(len(getattr(instance.text, language) or '') for language, _name in settings.LANGUAGES)
+    return size > settings.BLOG_SUMMARY_TASK_SIZE
+
+
+def update_or_queue_summaries(instance):
+    if is_large(instance):
+        from .tasks import update_summaries
+        label, pk = instance._meta.label, instance.pk
+        transaction.on_commit(lambda: update_summaries.delay(label, pk))
+    else:
+        instance.update_summaries()
+
+
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=BlogPost)
+def update_stored_summaries(sender, instance, raw=False, **kwargs):
+    if not raw:
+        update_or_queue_summaries(instance)
+
+
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=BlogPost)
+@receiver(post_delete, sender=Page)
+@receiver(post_delete, sender=BlogPost)
+def update_linking_summaries(sender, instance, signal, raw=False, **kwargs):
+    """Update stored summaries linking to an object that was created, deleted or changed its URL or title."""
+    if raw:
+        return
+
+    old = getattr(instance, '_old_link', None)
+    new = Link.from_object(instance)
+    if signal is post_save and old is not None and (old.urls, old.titles) == (new.urls, new.titles):
+        return  # saved, but links to the object did not change
+
+    # The rendered text of linking objects changed, so they are marked as updated. This also invalidates
+    # anything cached by the updated timestamp, e.g. entries in feeds.
+    now = timezone.now()
+    refs = {instance.pk} | new.slugs | (old.slugs if old is not None else set())
+    for obj in get_linking_objects(instance._meta.label, refs):
+        if (obj._meta.label, obj.pk) != (instance._meta.label, instance.pk):
+            type(obj).objects.filter(pk=obj.pk).update(updated=now)
+            obj.updated = now
+            update_or_queue_summaries(obj)
+
+
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=BlogPost)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    if is_large(instance):
+        from .tasks import update_search_index
+        label, pk = instance._meta.label, instance.pk
+        transaction.on_commit(lambda: update_search_index.delay(label, pk))
+    else:
+        instance.update_search_index()
+
 
 class Image(BaseModel):
     name = models.CharField(max_length=32)
     image = models.ImageField(storage=fs)
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+
+    # Used for images that are downloaded periodically (see blog.tasks.download_xmpp_net_badges)
+    etag = models.CharField(max_length=255, blank=True, editable=False)
+    last_modified = models.CharField(max_length=64, blank=True, editable=False)
+    sha256 = models.CharField(max_length=64, blank=True, editable=False)
 
     def __str__(self):
         return self.name
+
+    def get_sha256(self):
+        """Get the SHA-256 hash of the file, computed from the file if it wasn't stored."""
+
+        if not self.sha256 and self.image:
+            try:
+                with self.image.open('rb') as stream:
+                    self.sha256 = hashlib.sha256(stream.read()).hexdigest()
+            except FileNotFoundError:
+                pass
+        return self.sha256
+
+    def update_derivatives(self):
+        """Generate resized derivatives of this image and remove outdated ones.
+
+        See :py:mod:`blog.images` for details. Derivatives that did not change are kept as they are.
+        """
+        with self.image.open('rb') as stream:
+            size, generated = images.generate(stream, self.image.name)
+
+        existing = {derivative.file.name: derivative for derivative in self.derivatives.all()}
+        names = set()
+        for name, width, height, fmt, data in generated:
+            if name in existing:
+                names.add(name)
+                continue
+
+            if not self.image.storage.exists(name):
+                name = self.image.storage.save(name, ContentFile(data))
+            names.add(name)
+            ImageDerivative.objects.create(image=self, file=name, width=width, height=height, format=fmt)
+
+        for name, derivative in existing.items():
+            if name not in names:
+                derivative.delete()
+
+        self.width, self.height = size or (None, None)
+        Image.objects.filter(pk=self.pk).update(width=self.width, height=self.height)
+
+    def get_srcsets(self):
+        """Get candidates for the ``srcset`` attribute in every format of the derivatives.
+
+        Returns a tuple of the candidates in the format of the original image and a list of MIME types and
+        candidates for all other formats. Candidates are lists of URLs and widths, ordered by width.
+        """
+        srcsets = {}
+        for derivative in sorted(self.derivatives.all(), key=lambda d: d.width):
+            srcsets.setdefault(derivative.format, []).append((derivative.file.url, derivative.width))
+
+        fallback = []
+        sources = []
+        for fmt, candidates in srcsets.items():
+            if candidates[-1][1] < self.width:
+                # Only the original image is not re-encoded in its own format
+                fallback = candidates + [(self.image.url, self.width)]
+            else:
+                sources.append((images.FORMATS[fmt][1], candidates))
+        return fallback, sources
+
+
+class ImageDerivative(models.Model):
+    """A resized and/or re-encoded version of an :py:class:`~blog.models.Image`."""
+
+    image = models.ForeignKey(Image, models.CASCADE, related_name='derivatives')
+    file = models.FileField(storage=fs, max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=8)
+
+    def __str__(self):
+        return self.file.name
+
+
+@receiver(post_save, sender=Image)
+def update_image_derivatives(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    from .tasks import update_image_derivatives
+    pk = instance.pk
+    transaction.on_commit(lambda: update_image_derivatives.delay(pk))
+
+
+@receiver(post_delete, sender=ImageDerivative)
+def delete_image_derivative(sender, instance, **kwargs):
+    # Identical images share the same derivatives, as file names are content-hashed
+    if not ImageDerivative.objects.filter(file=instance.file.name).exists():
+        instance.file.delete(save=False)
@@ -13,23 +13,19 @@
 # You should have received a copy of the GNU General Public License along with this project. If not, see
 # <http://www.gnu.org/licenses/>.
 
-from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db import models
 from django.utils import timezone
 
+PUBLISHED_COUNT_CACHE_KEY = 'blog_published_count'
+
 
 class BasePageQuerySet(models.QuerySet):
     def slug(self, slug):
         """Filters for a given slug in any language."""
 
-        query = None
-        for lang, _name in settings.LANGUAGES:
-            if query is None:
-                query = models.Q(**{'slug_%s' % lang: slug})
-            else:
-                query |= models.Q(**{'slug_%s' % lang: slug})
-
-        return self.filter(query)
+        return self.filter(slug_lookups__slug=slug)
 
     def pk_or_slug(self, val):
         """Get an object either by primary key or slug in any language."""
@@ -50,5 +46,41 @@ class BlogPostQuerySet(BasePageQuerySet):
 
         return self.filter(published=True, publication_date__lt=now)
 
+    def published_count(self):
+        """Get the number of published blog posts.
+
+        The number is cached until a blog post is saved or deleted or the next blog post scheduled for the
+        future is published.
+        """
+        count = cache.get(PUBLISHED_COUNT_CACHE_KEY)
+        if count is not None:
+            return count
+
+        now = timezone.now()
+        count = self.published(now=now).count()
+
+        timeout = DEFAULT_TIMEOUT
+        scheduled = self.filter(published=True, publication_date__gte=now).aggregate(
+            next=models.Min('publication_date'))['next']
+        if scheduled is not None:
+            timeout = max(int((scheduled - now).total_seconds()), 1)
+
+        cache.set(PUBLISHED_COUNT_CACHE_KEY, count, timeout)
+        return count
+
     def blog_order(self):
-        return self.order_by('-sticky', '-created')
+        return self.order_by('-sticky', '-created', '-pk')
+
+    def after(self, sticky, created, pk):
+        """Filter for blog posts after the given position, as ordered by :py:func:`blog_order`."""
+        query = models.Q(sticky__lt=sticky)
+        query |= models.Q(sticky=sticky, created__lt=created)
+        query |= models.Q(sticky=sticky, created=created, pk__lt=pk)
+        return self.filter(query)
+
+    def before(self, sticky, created, pk):
+        """Filter for blog posts before the given position, as ordered by :py:func:`blog_order`."""
+        query = models.Q(sticky__gt=sticky)
+        query |= models.Q(sticky=sticky, created__gt=created)
+        query |= models.Q(sticky=sticky, created=created, pk__gt=pk)
+        return self.filter(query)
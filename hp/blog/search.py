@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Full-text search for pages and blog posts.
+
+The rendered text of every page and blog post is stored in an inverted index in the database
+(:py:class:`~blog.models.SearchDocument` and :py:class:`~blog.models.SearchTerm`), so searching does not
+require an external search server. Words are reduced to their stem with a light, language-specific stemmer,
+so e.g. "servers" also finds "server".
+"""
+
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language as get_active_language
+
+WORD_RE = re.compile(r'\w+')
+
+TITLE_WEIGHT = 5
+"""A word in the title counts as much as this many occurences in the text."""
+
+CHAMPION_LIST_SIZE = 200
+"""Number of documents with the highest weight considered for every search term."""
+
+MAX_QUERY_TERMS = 10
+"""Maximum number of (different) words in a query."""
+
+STOPWORDS = {
+    'de': {
+        'aber', 'als', 'am', 'an', 'auch', 'auf', 'aus', 'bei', 'bin', 'bis', 'bist', 'das', 'dass', 'dem',
+        'den', 'der', 'des', 'die', 'du', 'ein', 'eine', 'einem', 'einen', 'einer', 'eines', 'er', 'es',
+        'für', 'hat', 'ich', 'ihr', 'im', 'in', 'ist', 'mit', 'nach', 'nicht', 'noch', 'oder', 'sich', 'sie',
+        'sind', 'so', 'um', 'und', 'von', 'vom', 'vor', 'war', 'was', 'wie', 'wir', 'wird', 'zu', 'zum',
+        'zur',
+    },
+    'en': {
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'for', 'from', 'has', 'have',
+        'how', 'i', 'if', 'in', 'is', 'it', 'its', 'my', 'no', 'not', 'of', 'on', 'or', 'so', 'that', 'the',
+        'this', 'to', 'was', 'we', 'what', 'when', 'which', 'will', 'with', 'you', 'your',
+    },
+}
+
+
+def stem_en(word):
+    """A light stemmer for English, removing common inflectional suffixes.
+
+    >>> [stem_en(w) for w in ['servers', 'connecting', 'connected', 'running', 'passes', 'boxes', 'status']]
+    ['server', 'connect', 'connect', 'run', 'pass', 'box', 'status']
+    >>> [stem_en(w) for w in ['libraries', 'quickly', 'is', 'news']]
+    ['library', 'quick', 'is', 'news']
+    """
+    if len(word) <= 3:
+        return word
+
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith(('xes', 'ches', 'shes')):
+        return word[:-2]
+
+    for suffix in ('ing', 'ed', 'ly'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            # "running" -> "runn" -> "run"
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            return word
+
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is', 'ws')):
+        return word[:-1]
+    return word
+
+
+def stem_de(word):
+    """A light stemmer for German, based on the CISTEM algorithm.
+
+    >>> [stem_de(w) for w in ['Verbindungen', 'verbindung', 'Servern', 'server', 'Häuser', 'Haus']]
+    ['verbindung', 'verbindung', 'serv', 'serv', 'hau', 'hau']
+    """
+    word = word.lower().replace('ä', 'a').replace('ö', 'o').replace('ü', 'u').replace('ß', 'ss')
+    while len(word) > 3:
+        if len(word) > 5 and word[-2:] in ('em', 'er', 'nd'):
+            word = word[:-2]
+        elif word[-1] in 'ens':
+            word = word[:-1]
+        else:
+            break
+    return word
+
+
+STEMMERS = {
+    'de': stem_de,
+    'en': stem_en,
+}
+
+
+def get_language(language):
+    """Get the base language, e.g. ``"en"`` for ``"en-us"``."""
+    return (language or get_active_language() or settings.LANGUAGE_CODE).split('-')[0]
+
+
+@lru_cache(maxsize=20000)
+def stem(word, language):
+    """Stem a single (lower case) word, returns ``None`` for stopwords."""
+    if len(word) < 2 or word in STOPWORDS.get(language, ()):
+        return None
+
+    stemmer = STEMMERS.get(language)
+    if stemmer is not None:
+        word = stemmer(word)
+    return word[:64]
+
+
+def get_terms(text, language):
+    """Get the stemmed words in ``text``.
+
+    >>> get_terms('The servers are running, the server is not running.', 'en')
+    ['server', 'run', 'server', 'run']
+    """
+    terms = [stem(word, language) for word in WORD_RE.findall(text.lower())]
+    return [term for term in terms if term]
+
+
+def get_weights(title, text, language):
+    """Get the weight of every term in a document."""
+
+    counts = Counter(get_terms(text, language))
+    for term in get_terms(title, language):
+        counts[term] += TITLE_WEIGHT
+    return {term: 1 + math.log(count) for term, count in counts.items()}
+
+
+def highlight(text, terms, language, length=240):
+    """Get a snippet of ``text`` with all words matching any of the given terms highlighted.
+
+    The snippet starts shortly before the first matching word.
+
+    >>> highlight('Connect to the server <here>. Many servers are running.', {'server'}, 'en')
+    'Connect to the <mark>server</mark> &lt;here&gt;. Many <mark>servers</mark> are running.'
+    """
+    words = list(WORD_RE.finditer(text))
+    first = next((m for m in words if stem(m.group().lower(), language) in terms), None)
+
+    start = 0
+    if first is not None and first.start() > length // 3:
+        # Start at a word boundary shortly before the first match
+        start = max((m.start() for m in words if m.start() <= first.start() - length // 4), default=0)
+    end = start + length
+
+    parts = ['…' if start > 0 else '']
+    pos = start
+    for match in words:
+        if match.start() < start:
+            continue
+        if match.end() > end:
+            break
+        if stem(match.group().lower(), language) in terms:
+            parts += [escape(text[pos:match.start()]), '<mark>%s</mark>' % escape(match.group())]
+            pos = match.end()
+
+    parts.append(escape(text[pos:end]))
+    if end < len(text):
+        parts.append('…')
+    return mark_safe(''.join(parts).strip())
+
+
+class SearchResult(object):
+    def __init__(self, document, score, terms):
+        self.document = document
+        self.score = score
+        self.terms = terms
+
+    @property
+    def title(self):
+        return self.document.title
+
+    @property
+    def url(self):
+        return self.document.url
+
+    @property
+    def snippet(self):
+        return highlight(self.document.text, self.terms, self.document.language)
+
+
+def search(query, language=None, limit=10, now=None):
+    """Search pages and blog posts.
+
+    Documents matching more words of the query are ranked first, documents that match the same number of
+    words are ranked by the sum of term weights multiplied by the inverse document frequency of each word.
+
+    Parameters
+    ----------
+
+    query : str
+        The search query, words are combined with "OR".
+    language : str, optional
+        The language to search in, the default is the currently active language.
+    limit : int, optional
+        Maximum number of results.
+    now : datetime, optional
+        Blog posts published after this time are not included.
+
+    Returns
+    -------
+
+    list of :py:class:`~blog.search.SearchResult`
+    """
+    from .models import SearchDocument
+    from .models import SearchTerm
+
+    if now is None:
+        now = timezone.now()
+    language = get_language(language)
+
+    terms = list(dict.fromkeys(get_terms(query, language)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    postings = SearchTerm.objects.filter(language=language)
+    frequencies = dict(postings.filter(term__in=terms).order_by().values('term').annotate(
+        df=models.Count('pk')).values_list('term', 'df'))
+    if not frequencies:
+        return []
+
+    # Only rank documents from the champion list of every term (the documents with the highest weight for
+    # that term). Rare terms have fewer documents than that, so results are only approximated for very
+    # common terms, which have a low inverse document frequency anyway.
+    candidates = set()
+    for term in frequencies:
+        candidates.update(postings.filter(term=term).order_by('-weight').values_list(
+            'document', flat=True)[:CHAMPION_LIST_SIZE])
+
+    # Exclude blog posts scheduled for the future. There are usually none or very few.
+    candidates -= set(SearchDocument.objects.filter(public_from__gt=now).values_list('pk', flat=True))
+
+    total = SearchDocument.objects.filter(language=language).count()
+    score = models.Sum(models.Case(*[
+        models.When(term=term, then=models.F('weight') * models.Value(math.log(1 + total / df)))
+        for term, df in frequencies.items()
+    ], output_field=models.FloatField()))
+
+    ranked = list(postings.filter(term__in=frequencies, document__in=candidates).order_by().values(
+        'document').annotate(matched=models.Count('pk'), score=score).order_by('-matched', '-score')[:limit])
+
+    documents = SearchDocument.objects.in_bulk([row['document'] for row in ranked])
+    return [SearchResult(documents[row['document']], row['score'], set(terms)) for row in ranked]
@@ -13,50 +13,157 @@
 # You should have received a copy of the GNU General Public License along with this project. If
 # not, see <http://www.gnu.org/licenses/>.
 
-import tempfile
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 import requests
+import requests.adapters
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
+from django.apps import apps
 from django.conf import settings
-from django.core import files
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.base import ContentFile
 
 from .models import Image
 
 log = get_task_logger(__name__)
 
 
+def fetch_badge(session, url, host, image, timeout):
+    headers = {}
+    if image.etag:
+        headers['If-None-Match'] = image.etag
+    if image.last_modified:
+        headers['If-Modified-Since'] = image.last_modified
+    return session.get(url, params={'domain': host}, headers=headers, timeout=timeout)
+
+
+def save_badge(image, response):
+    """Save a downloaded badge, returns ``True`` if the file was changed."""
+
+    content = response.content
+    sha256 = hashlib.sha256(content).hexdigest()
+    image.etag = response.headers.get('ETag', '')
+    image.last_modified = response.headers.get('Last-Modified', '')
+
+    if image.pk is not None and sha256 == image.get_sha256():
+        # Don't touch the file, so it can stay cached by clients
+        Image.objects.filter(pk=image.pk).update(
+            etag=image.etag, last_modified=image.last_modified, sha256=sha256)
+        return False
+
+    old_name = image.image.name if image.pk is not None else None
+    image.sha256 = sha256
+    image.image.save(image.name, ContentFile(content))
+    if old_name and old_name != image.image.name:
+        image.image.storage.delete(old_name)
+    return True
+
+
 @shared_task
-def download_xmpp_net_badges():
+def download_xmpp_net_badges(workers=8, timeout=10):
+    """Download badges for all hosts in the ``XMPP_HOSTS`` setting.
+
+    Badges are downloaded concurrently using conditional requests, so the observatory only sends a badge
+    if it changed. Images are only saved if the content of the badge actually changed.
+
+    Returns the number of badges that changed.
+    """
     if not settings.OBSERVATORY_URL:
         log.debug('Not downloading badges because OBSERVATORY_URL setting is not set.')
-        return
+        return 0
 
     url = urljoin(settings.OBSERVATORY_URL, 'badge.php')
 
+    images = {}
     for host in settings.XMPP_HOSTS:
         filename = 'badge_%s.svg' % host.replace('.', '_')
         try:
-            image = Image.objects.get(name=filename)
+            images[host] = Image.objects.get(name=filename)
         except Image.DoesNotExist:
-            image = Image(name=filename)
+            images[host] = Image(name=filename)
 
-        try:
-            response = requests.get(url, params={'domain': host}, stream=True)
-        except Exception as e:
-            log.exception(e)
-            continue
-
-        if response.status_code != requests.codes.ok:
-            log.error('Could not download badge for %s.', host)
-            continue
-
-        with tempfile.NamedTemporaryFile() as stream:
-            for block in response.iter_content(1024 * 8):
-                if not block:
-                    break
-                stream.write(block)
-
-            image.image.save(filename, files.File(stream))
+    changed = 0
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        futures = {host: executor.submit(fetch_badge, session, url, host, image, timeout)
+                   for host, image in images.items()}
+
+        # Files are saved in this thread, so that worker threads don't need database connections
+        for host, future in futures.items():
+            try:
+                response = future.result()
+            except requests.exceptions.RequestException as e:
+                log.error('Could not download badge for %s: %s', host, e)
+                continue
+
+            if response.status_code == requests.codes.not_modified:
+                log.debug('Badge for %s was not modified.', host)
+                continue
+            elif response.status_code != requests.codes.ok:
+                log.error('Could not download badge for %s: HTTP %s', host, response.status_code)
+                continue
+
+            if save_badge(images[host], response):
+                changed += 1
+
+    return changed
+
+
+@shared_task
+def update_summaries(model, pk):
+    """Compute and store summaries of a page or blog post.
+
+    See :py:func:`~blog.models.BasePage.update_summaries` for details.
+
+    Parameters
+    ----------
+
+    model : str
+        The label of the model, e.g. ``"blog.BlogPost"``.
+    pk : int
+        The primary key of the object.
+    """
+    try:
+        obj = apps.get_model(model).objects.get(pk=pk)
+    except ObjectDoesNotExist:
+        log.warning('%s %s: Object was deleted before summaries were computed.', model, pk)
+        return
+
+    obj.update_summaries()
+
+
+@shared_task
+def update_search_index(model, pk):
+    """Update the search index for a page or blog post.
+
+    See :py:func:`~blog.models.BasePage.update_search_index` for details.
+    """
+    try:
+        obj = apps.get_model(model).objects.get(pk=pk)
+    except ObjectDoesNotExist:
+        log.warning('%s %s: Object was deleted before it was indexed.', model, pk)
+        return
+
+    obj.update_search_index()
+
+
+@shared_task
+def update_image_derivatives(pk):
+    """Generate resized derivatives of an image.
+
+    See :py:func:`~blog.models.Image.update_derivatives` for details.
+    """
+    try:
+        image = Image.objects.get(pk=pk)
+    except Image.DoesNotExist:
+        log.warning('Image %s: Image was deleted before derivatives were generated.', pk)
+        return
+
+    image.update_derivatives()
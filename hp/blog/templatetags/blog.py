@@ -16,18 +16,27 @@
 import logging
 
 from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+from django.utils.html import format_html_join
 
 from core.utils import format_link
 
-from ..models import BlogPost
+from ..links import get_link_resolver
+from ..models import Image
 from ..models import Page
 
 log = logging.getLogger(__name__)
 register = template.Library()
 
 
-@register.simple_tag()
-def page_url(pk_or_slug, quiet=True):
+def get_link(context, label, pk_or_slug):
+    """Get the :py:class:`~blog.links.Link` for the given primary key or slug."""
+    return get_link_resolver(context.get('request')).get(label, pk_or_slug)
+
+
+@register.simple_tag(takes_context=True)
+def page_url(context, pk_or_slug, quiet=True):
     """Returns the URL to the given primary key or slug.
 
     Parameters
@@ -41,14 +50,13 @@ def page_url(pk_or_slug, quiet=True):
         Otherwise, the ``DoesNotExist`` exception is propagated.
     """
 
-    try:
-        page = Page.objects.pk_or_slug(pk_or_slug)
-    except Page.DoesNotExist:
+    link = get_link(context, 'blog.Page', pk_or_slug)
+    if link is None:
         if quiet is False:
-            raise
+            raise Page.DoesNotExist('%s: Page does not exist.' % pk_or_slug)
         return ''
 
-    return page.get_absolute_url()
+    return link.url
 
 
 @register.simple_tag(takes_context=True)
@@ -80,9 +88,8 @@ def page(context, pk, text=None, anchor=None, **attrs):
         Any other keyword arguments will be used as HTML attributes in the link.
     """
 
-    try:
-        page = Page.objects.pk_or_slug(pk)
-    except Page.DoesNotExist:
+    link = get_link(context, 'blog.Page', pk)
+    if link is None:
         log.error('%s: Page %s does not exist.', context['request'].path, pk)
         return text or ''
 
@@ -93,8 +100,8 @@ def page(context, pk, text=None, anchor=None, **attrs):
         text = attrs['title']
         del attrs['title']
 
-    text = text or page.title.current
-    url = page.get_absolute_url()
+    text = text or link.title
+    url = link.url
     if anchor is not None:
         url = '%s#%s' % (url, anchor)
 
@@ -109,9 +116,8 @@ def post(context, pk, text=None, anchor=None, **attrs):
     links to blog posts.
     """
 
-    try:
-        post = BlogPost.objects.pk_or_slug(pk)
-    except BlogPost.DoesNotExist:
+    link = get_link(context, 'blog.BlogPost', pk)
+    if link is None:
         log.error('%s: BlogPost %s does not exist.', context['request'].path, pk)
         return text or ''
 
@@ -122,9 +128,59 @@ def post(context, pk, text=None, anchor=None, **attrs):
         text = attrs['title']
         del attrs['title']
 
-    text = text or post.title.current
-    url = post.get_absolute_url()
+    text = text or link.title
+    url = link.url
     if anchor is not None:
         url = '%s#%s' % (url, anchor)
 
     return format_link(url, text, **attrs)
+
+
+def format_srcset(candidates):
+    return ', '.join('%s %sw' % (url, width) for url, width in candidates)
+
+
+@register.simple_tag
+def image(name, alt='', sizes='100vw', **attrs):
+    """Display an image with resized derivatives for smaller screens.
+
+    The image is looked up by its name. If derivatives were generated (see
+    :py:func:`~blog.models.Image.update_derivatives`), the tag returns a ``<picture>`` element with a
+    ``srcset`` attribute for every format, so browsers can choose the most suitable file.
+
+    Example::
+
+        {% image "screenshot.png" alt="Screenshot" sizes="(min-width: 992px) 690px, 100vw" %}
+
+    Parameters
+    ----------
+
+    name : str
+        The name of the image.
+    alt : str, optional
+        The alternative text of the image.
+    sizes : str, optional
+        The ``sizes`` attribute, the default assumes that the image is displayed with the full width of
+        the screen.
+    **attrs
+        Any other keyword arguments will be used as HTML attributes of the ``<img>`` tag.
+    """
+
+    obj = Image.objects.filter(name=name).prefetch_related('derivatives').order_by('-pk').first()
+    if obj is None:
+        log.error('%s: Image does not exist.', name)
+        return ''
+
+    attrs = dict({'alt': alt, 'width': obj.width, 'height': obj.height}, **attrs)
+    attrs = {k: v for k, v in attrs.items() if v is not None}
+    fallback, sources = obj.get_srcsets()
+    if not fallback and not sources:
+        return format_html('<img src="{}"{}>', obj.image.url, flatatt(attrs))
+
+    if fallback:
+        attrs.update({'srcset': format_srcset(fallback), 'sizes': sizes})
+    return format_html(
+        '<picture>{}<img src="{}"{}></picture>',
+        format_html_join('', '<source type="{}" srcset="{}" sizes="{}">',
+                         ((mime, format_srcset(candidates), sizes) for mime, candidates in sources)),
+        obj.image.url, flatatt(attrs))
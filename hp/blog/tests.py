@@ -13,9 +13,67 @@
 # You should have received a copy of the GNU General Public License along with this project. If not, see
 # <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+import doctest
+import hashlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
 
+from PIL import Image as PILImage
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.template import Context
+from django.template import Template
+from django.test import Client
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils import translation
+
+from core.tests.base import TestCase
+
+from . import images
+from . import search
+from . import utils
+from .models import BlogPost
+from .models import Image
+from .models import ImageDerivative
 from .models import Page
+from .models import SearchDocument
+from .models import SlugLookup
+from .search import search as search_index
+from .tasks import download_xmpp_net_badges
+from .tasks import update_image_derivatives
+from .tasks import update_search_index
+from .tasks import update_summaries
+from .utils import compile_template
+from .utils import get_fallback_request
+from .utils import template_cache
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(images))
+    tests.addTests(doctest.DocTestSuite(search))
+    tests.addTests(doctest.DocTestSuite(utils))
+    return tests
 
 
 class BasePageTests(TestCase):
@@ -29,3 +87,727 @@ class BasePageTests(TestCase):
 
         self.assertEqual(b.cleanup_html('test <table><tr><td>foo</td></tr></table>'),
                          'test foo')
+
+
+class TemplateCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.post = BlogPost.objects.create(
+            title_en='Title', title_de='Titel', slug_en='title', slug_de='titel',
+            text_en='<p>English {{ request.path }}.</p>', text_de='<p>Deutsch {{ request.path }}.</p>',
+            meta_summary_en='Meta summary.')
+        self.request = get_fallback_request('/foo/')
+        template_cache.clear()
+
+    def test_cache(self):
+        with translation.override('en'):
+            template = self.post.get_template('text')
+            self.assertIs(self.post.get_template('text'), template)
+            self.assertEqual(self.post.render_template(self.post.text.current, self.request, field='text'),
+                             '<p>English /foo/.</p>')
+            self.assertEqual(self.post.get_meta_summary(self.request), 'Meta summary.')  # stored summary
+
+        with translation.override('de'):
+            self.assertIsNot(self.post.get_template('text'), template)
+            self.assertEqual(self.post.render_template(self.post.text.current, self.request, field='text'),
+                             '<p>Deutsch /foo/.</p>')
+
+        self.assertEqual(len(template_cache), 2)
+        self.assertEqual(template_cache.hits, 3)
+
+        # Saving the post invalidates cached templates
+        self.post.text_en = '<p>Changed.</p>'
+        with translation.override('en'):
+            self.assertEqual(self.post.render_template(self.post.text.current, self.request, field='text'),
+                             '<p>Changed.</p>')
+            self.post.save()
+            self.assertIsNot(self.post.get_template('text'), template)
+
+    def test_unsaved(self):
+        post = BlogPost(text_en='<p>Unsaved.</p>')
+        with translation.override('en'):
+            self.assertEqual(post.render_template(post.text.current, self.request, field='text'),
+                             '<p>Unsaved.</p>')
+        self.assertEqual(len(template_cache), 0)
+
+    @override_settings(BLOG_TEMPLATE_CACHE_SIZE=2)
+    def test_eviction(self):
+        with translation.override('en'):
+            text = self.post.get_template('text')
+            self.post.get_template('meta_summary')
+            self.assertIs(self.post.get_template('text'), text)  # text is now the most recently used
+            self.post.get_template('twitter_summary', 'Twitter summary.')
+
+            self.assertEqual(len(template_cache), 2)
+            self.assertIs(self.post.get_template('text'), text)
+            self.assertEqual(template_cache.misses, 3)
+
+    @override_settings(BLOG_TEMPLATE_CACHE_SIZE=0)
+    def test_disabled(self):
+        with translation.override('en'):
+            self.assertIsNot(self.post.get_template('text'), self.post.get_template('text'))
+        self.assertEqual(len(template_cache), 0)
+
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command('benchmark_render', str(self.post.pk), count=3, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('Uncached: 3 views', output)
+        self.assertIn('Cached: 3 views', output)
+
+
+class StoredSummaryTests(TestCase):
+    def create(self, **kwargs):
+        return BlogPost.objects.create(
+            title_en='Title', title_de='Titel', slug_en='title', slug_de='titel',
+            text_en='<p>First sentence &amp; more. Second sentence on {{ site.BRAND }}. Third. Fourth.</p>',
+            text_de='<p>Erster Satz.</p>', **kwargs)
+
+    def test_stored(self):
+        post = self.create(meta_summary_en='Tom & Jerry.')
+        post = BlogPost.objects.get(pk=post.pk)
+        self.assertEqual(post.stored_meta_summary_en, 'Tom & Jerry.')
+        self.assertEqual(post.stored_twitter_summary_en, 'Tom & Jerry.')
+        self.assertEqual(post.stored_meta_summary_de, 'Erster Satz.')
+
+        request = get_fallback_request()
+        with translation.override('en'):
+            self.assertEqual(post.stored_html_summary_en, post.compute_html_summary(request))
+
+        with translation.override('en'), \
+                mock.patch.object(BlogPost, 'render_template', side_effect=Exception('rendered')):
+            self.assertEqual(post.get_meta_summary(request), 'Tom & Jerry.')
+            self.assertEqual(post.get_opengraph_summary(request), 'Tom & Jerry.')
+            self.assertIn('Second sentence', post.get_html_summary(request))
+
+        # Summaries derived from the text are escaped
+        post.meta_summary_en = ''
+        post.save()
+        self.assertEqual(post.stored_meta_summary_en,
+                         'First sentence &amp; more. Second sentence on example.com. Third. Fourth.')
+
+    def test_render_error(self):
+        with self.assertLogs('blog.models', 'ERROR'):
+            post = self.create(twitter_summary_de='{% page "does-not-exist" %}{% foo %}')
+
+        post = BlogPost.objects.get(pk=post.pk)
+        self.assertIsNone(post.stored_meta_summary_de)
+        self.assertIsNotNone(post.stored_meta_summary_en)
+
+    @override_settings(BLOG_SUMMARY_TASK_SIZE=10)
+    def test_task(self):
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                self.mock_celery() as mocked:
+            post = self.create()
+
+        # The search index is updated in a task as well
+        self.assertTaskCount(mocked, 2)
+        called_task, args, kwargs = mocked.call_args_list[0][0]
+        self.assertIsTask(called_task, update_summaries)
+        self.assertEqual(args, ('blog.BlogPost', post.pk))
+        post = BlogPost.objects.get(pk=post.pk)
+        self.assertEqual(post.stored_meta_summary_de, 'Erster Satz.')
+
+        # Stored summaries are cleared when saving, computed on request until the task is done
+        with mock.patch('django.db.transaction.on_commit'):
+            post.text_de = '<p>Zweiter Satz.</p>'
+            post.save()
+        post = BlogPost.objects.get(pk=post.pk)
+        self.assertIsNone(post.stored_meta_summary_de)
+        with translation.override('de'):
+            self.assertEqual(post.get_meta_summary(get_fallback_request()), 'Zweiter Satz.')
+
+    def test_command(self):
+        post = self.create()
+        BlogPost.objects.update(stored_meta_summary_en=None)
+        call_command('update_summaries')
+        self.assertIsNotNone(BlogPost.objects.get(pk=post.pk).stored_meta_summary_en)
+
+    def test_linked(self):
+        page = Page.objects.create(title_en='Page', title_de='Seite', slug_en='page', slug_de='seite',
+                                   text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        by_pk = self.create(meta_summary_en='See {%% page %s %%}.' % page.pk)
+        by_slug = BlogPost.objects.create(
+            title_en='Other', title_de='Anderer', slug_en='other', slug_de='anderer',
+            text_en='<p>See {% page "page" %}.</p>', text_de='<p>Text.</p>')
+
+        def stored(post, kind='meta'):
+            return getattr(BlogPost.objects.get(pk=post.pk), 'stored_%s_summary_en' % kind)
+
+        self.assertEqual(stored(by_pk), 'See <a href="/p/page/">Page</a>.')
+
+        # Saving without changing the title or URL does not recompute linking summaries
+        with mock.patch.object(BlogPost, 'update_summaries') as update_summaries:
+            page.text_en = '<p>New text.</p>'
+            page.save()
+        update_summaries.assert_not_called()
+
+        page.title_en = 'New title'
+        page.save()
+        self.assertEqual(stored(by_pk), 'See <a href="/p/page/">New title</a>.')
+        self.assertIn('<a href="/p/page/">New title</a>', stored(by_slug, 'html'))
+
+        # The link by slug is now broken and no longer in the stored summary
+        page.slug_en = 'new-slug'
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            page.save()
+        self.assertEqual(stored(by_pk), 'See <a href="/p/new-slug/">New title</a>.')
+        self.assertNotIn('New title', stored(by_slug, 'html'))
+
+        # Linked blog post is created later
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            later = BlogPost.objects.create(title_en='Later', title_de='Später', slug_en='later',
+                                            slug_de='spaeter', meta_summary_en='See {% post "new" %}.',
+                                            text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        self.assertEqual(stored(later), 'See .')
+        new = BlogPost.objects.create(title_en='New', title_de='Neu', slug_en='new', slug_de='neu',
+                                      text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        self.assertEqual(stored(later), 'See <a href="%s">New</a>.' % new.get_absolute_url())
+
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            page.delete()
+        self.assertEqual(stored(by_pk), 'See .')
+
+
+class LinkTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.pages = [Page.objects.create(title_en='Page %s' % i, title_de='Seite %s' % i,
+                                          slug_en='page-%s' % i, slug_de='seite-%s' % i,
+                                          text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+                      for i in range(25)]
+        self.post = BlogPost.objects.create(title_en='Post', title_de='Eintrag', slug_en='post',
+                                            slug_de='eintrag', text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+
+        links = ['{%% page %s %%}' % p.pk for p in self.pages]
+        links += ['{%% page "page-%s" %%}' % i for i in range(25)]
+        links += ['{% post "post" %}', '{% page 0 %}', '{% page_url "page-0" %}', '{% page page_pk %}']
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):  # when computing summaries
+            self.faq = Page.objects.create(title_en='FAQ', title_de='FAQ', slug_en='faq', slug_de='faq',
+                                           text_en=' '.join(links), text_de='<p>FAQ.</p>')
+        cache.clear()
+
+    def render(self, page):
+        with translation.override('en'), CaptureQueriesContext(connection) as queries:
+            text = page.render_from_request(get_fallback_request(), {'page_pk': self.pages[1].pk})
+        return text, [q for q in queries if 'blog_page' in q['sql'] or 'blog_blogpost' in q['sql']]
+
+    def test_collect_links(self):
+        compiled = compile_template('{% page 1 %}{% page "foo" text="bar" %}{% post 3 %}{% page var %}')
+        self.assertEqual(compiled.blog_links, {'blog.Page': {1, 'foo'}, 'blog.BlogPost': {3}})
+
+    def test_render(self):
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            text, queries = self.render(self.faq)
+
+        # One query per model, the link given as variable was already resolved
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(text.count('href="/p/page-0/"'), 2)
+        self.assertIn('>Page 24</a>', text)
+        self.assertIn('<a href="/b/post/">Post</a>', text)
+        self.assertIn('/p/page-0/ ', text)
+
+        # Links are cached, so a new request doesn't need any queries (except for the missing page)
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            text2, queries = self.render(self.faq)
+        self.assertEqual(text, text2)
+        self.assertEqual(len(queries), 1)
+
+    def test_invalidation(self):
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            self.render(self.faq)  # populates the cache
+
+        self.pages[0].slug_en = 'changed'
+        self.pages[0].title_en = 'Changed'
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):  # summaries of the FAQ are updated
+            self.pages[0].save()
+
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            text, queries = self.render(self.faq)
+        self.assertIn('<a href="/p/changed/">Changed</a>', text)
+        self.assertNotIn('page-0', text)  # {% page_url "page-0" %} no longer exists
+
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            self.pages[0].delete()
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            text, queries = self.render(self.faq)
+        self.assertNotIn('/p/changed/', text)
+
+
+class SlugLookupTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.page = Page.objects.create(title_en='Title', title_de='Titel', slug_en='title', slug_de='titel',
+                                        text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+
+    def assertLookups(self, obj, expected):
+        lookups = SlugLookup.objects.filter(content_type=ContentType.objects.get_for_model(obj),
+                                            object_id=obj.pk)
+        self.assertEqual({(lookup.slug, lookup.language) for lookup in lookups}, expected)
+
+    def test_sync(self):
+        self.assertLookups(self.page, {('titel', 'de'), ('title', 'en')})
+        self.assertEqual(Page.objects.slug('titel').get(), self.page)
+
+        self.page.slug_en = 'titel'
+        self.page.save()
+        self.assertLookups(self.page, {('titel', 'de')})
+        self.assertFalse(Page.objects.slug('title').exists())
+
+        # Blog posts may use the same slug as pages
+        post = BlogPost.objects.create(title_en='Title', title_de='Titel', slug_en='titel', slug_de='post',
+                                       text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        self.assertLookups(post, {('titel', 'en'), ('post', 'de')})
+        self.assertEqual(BlogPost.objects.pk_or_slug('titel'), post)
+
+        self.page.delete()
+        self.assertEqual(list(SlugLookup.objects.values_list('slug', flat=True).order_by('slug')),
+                         ['post', 'titel'])
+
+    def test_clean(self):
+        page = Page(title_en='Other', title_de='Anderer', slug_en='titel', slug_de='anderer',
+                    text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        with self.assertRaises(ValidationError) as cm:
+            page.clean()
+        self.assertEqual(list(cm.exception.message_dict), ['slug_en'])
+
+        self.page.clean()  # uses its own slugs
+
+    def test_save_conflict(self):
+        # Saving without full_clean() fails and does not leave a saved object without lookups
+        page = Page(title_en='Other', title_de='Anderer', slug_en='titel', slug_de='anderer',
+                    text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        with self.assertRaises(ValidationError):
+            page.save()
+        self.assertFalse(Page.objects.filter(slug_de='anderer').exists())
+
+        page = Page.objects.create(title_en='Other', title_de='Anderer', slug_en='other', slug_de='anderer',
+                                   text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        page.slug_de = 'title'
+        with self.assertRaises(ValidationError):
+            page.save()
+        self.assertEqual(Page.objects.get(pk=page.pk).slug_de, 'anderer')
+        self.assertLookups(page, {('other', 'en'), ('anderer', 'de')})
+
+    def test_migration(self):
+        migration = importlib.import_module('blog.migrations.0008_slug_lookup')
+        SlugLookup.objects.all().delete()
+        migration.populate_slug_lookups(apps, None)
+        self.assertLookups(self.page, {('titel', 'de'), ('title', 'en')})
+
+        # Conflicting slugs were possible before the lookup table was added
+        other = Page.objects.create(title_en='Other', title_de='Anderer', slug_en='other', slug_de='anderer',
+                                    text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        Page.objects.filter(pk=other.pk).update(slug_de='title')
+        SlugLookup.objects.all().delete()
+        with self.assertRaisesRegex(RuntimeError, r'page %s: Slug "title" \(de\) is already used by page %s\.'
+                                    % (other.pk, self.page.pk)):
+            migration.populate_slug_lookups(apps, None)
+        self.assertFalse(SlugLookup.objects.exists())
+
+    def test_view(self):
+        client = Client(HTTP_ACCEPT_LANGUAGE='en')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/p/titel/')
+        self.assertRedirects(response, '/p/title/', fetch_redirect_response=False)
+        self.assertEqual(len([q for q in queries if 'blog_page' in q['sql']]), 1)
+
+        response = client.get('/p/title/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['object'], self.page)
+
+
+class BlogPostListTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        now = timezone.now()
+        self.posts = []
+        for i in range(25):
+            post = BlogPost.objects.create(
+                title_en='Post %s' % i, title_de='Eintrag %s' % i, slug_en='post-%s' % i,
+                slug_de='eintrag-%s' % i, text_en='<p>Text.</p>', text_de='<p>Text.</p>', sticky=i in (3, 7),
+                publication_date=now - timedelta(days=1))
+            self.posts.append(post)
+
+        # Two posts have the same timestamp, so they are ordered by primary key
+        for i, post in enumerate(self.posts):
+            BlogPost.objects.filter(pk=post.pk).update(created=now - timedelta(hours=i // 2 * 2))
+
+        self.expected = list(BlogPost.objects.blog_order())
+        self.url = reverse('blog:home')
+        self.client = Client(HTTP_ACCEPT_LANGUAGE='en')
+
+    def get(self, **kwargs):
+        response = self.client.get(self.url, kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_pagination(self):
+        self.assertEqual(self.expected[:3], [self.posts[3], self.posts[7], self.posts[1]])
+
+        response = self.get()
+        pages = [list(response.context['object_list'])]
+        self.assertTrue(response.context['is_paginated'])
+        self.assertIsNone(response.context['page_obj'].previous_cursor)
+        self.assertEqual(response.context['post_count'], 25)
+
+        while response.context['page_obj'].has_next:
+            response = self.get(after=response.context['page_obj'].next_cursor)
+            pages.append(list(response.context['object_list']))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), self.expected)
+
+        # ... and all the way back again
+        response = self.get(before=response.context['page_obj'].previous_cursor)
+        self.assertEqual(list(response.context['object_list']), pages[1])
+        response = self.get(before=response.context['page_obj'].previous_cursor)
+        self.assertEqual(list(response.context['object_list']), pages[0])
+        self.assertFalse(response.context['page_obj'].has_previous)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'after': 'foo'}).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {'before': '1_zzzzzzzzzzzzzzzzzz_1'}).status_code, 404)
+
+    def test_published_count(self):
+        self.get()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get()
+        self.assertEqual(response.context['post_count'], 25)
+        self.assertFalse([q for q in queries if 'COUNT' in q['sql']])
+
+        self.posts[0].published = False
+        self.posts[0].save()
+        self.assertEqual(self.get().context['post_count'], 24)
+
+        self.posts[1].delete()
+        self.assertEqual(self.get().context['post_count'], 23)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = Page.objects.create(
+            title_en='Server status', title_de='Serverstatus', slug_en='status', slug_de='status',
+            text_en='<p>All servers of {{ site.BRAND }} are running.</p>',
+            text_de='<p>Alle Server laufen.</p>', published=True)
+        self.client_page = Page.objects.create(
+            title_en='Clients', title_de='Clients', slug_en='clients', slug_de='clients',
+            text_en='<p>Connect to the server with a client. Many clients are available.</p>',
+            text_de='<p>Verbindungen mit einem Client.</p>', published=True)
+
+    def titles(self, query, language='en', **kwargs):
+        return [result.title for result in search_index(query, language, **kwargs)]
+
+    def test_index(self):
+        self.assertEqual(SearchDocument.objects.filter(object_id=self.server.pk).count(), 2)
+        document = SearchDocument.objects.get(object_id=self.server.pk, language='en')
+        self.assertEqual(document.text, 'All servers of example.com are running.')
+        self.assertEqual(document.url, self.server.get_absolute_url())
+
+        self.server.text_en = '<p>Maintenance today.</p>'
+        self.server.save()
+        self.assertEqual(self.titles('maintenance'), ['Server status'])
+        self.assertEqual(self.titles('running'), [])
+
+        self.server.published = False
+        self.server.save()
+        self.assertFalse(SearchDocument.objects.filter(object_id=self.server.pk).exists())
+
+        self.client_page.delete()
+        self.assertFalse(SearchDocument.objects.exists())
+
+    def test_search(self):
+        # Both pages contain "server", but it is in the title of the first one
+        self.assertEqual(self.titles('servers'), ['Server status', 'Clients'])
+        self.assertEqual(self.titles('server clients'), ['Clients', 'Server status'])
+        self.assertEqual(self.titles('the'), [])  # only stopwords
+        self.assertEqual(self.titles('foobar'), [])
+        self.assertEqual(self.titles('servers', limit=1), ['Server status'])
+
+        # Search in the current language by default
+        self.assertEqual(self.titles('Verbindung', 'de'), ['Clients'])
+        with translation.override('de'):
+            self.assertEqual([r.title for r in search_index('verbindung')], ['Clients'])
+        self.assertEqual(self.titles('verbindung'), [])
+
+        result = search_index('connecting', 'en')[0]
+        self.assertEqual(result.snippet, '<mark>Connect</mark> to the server with a client. '
+                                         'Many clients are available.')
+
+    def test_scheduled(self):
+        post = BlogPost.objects.create(
+            title_en='Scheduled', title_de='Geplant', slug_en='scheduled', slug_de='geplant',
+            text_en='<p>New server.</p>', text_de='<p>Neuer Server.</p>', published=True,
+            publication_date=timezone.now() + timedelta(days=1))
+        self.assertNotIn('Scheduled', self.titles('server'))
+        self.assertIn('Scheduled', self.titles('server', now=timezone.now() + timedelta(days=2)))
+
+        post.publication_date = timezone.now() - timedelta(days=1)
+        post.save()
+        self.assertIn('Scheduled', self.titles('server'))
+
+    @override_settings(BLOG_SUMMARY_TASK_SIZE=10)
+    def test_task(self):
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                self.mock_celery() as mocked:
+            self.server.text_en = '<p>Maintenance today.</p>'
+            self.server.save()
+
+        self.assertTaskCall(mocked, update_search_index, 'blog.Page', self.server.pk)
+        self.assertEqual(self.titles('maintenance'), ['Server status'])
+
+    def test_command(self):
+        SearchDocument.objects.all().delete()
+        call_command('update_search_index')
+        self.assertEqual(self.titles('servers'), ['Server status', 'Clients'])
+
+    def test_view(self):
+        client = Client(HTTP_ACCEPT_LANGUAGE='en')
+        response = client.get(reverse('blog:search'), {'q': 'server <b>'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['query'], 'server <b>')
+        self.assertEqual([r.title for r in response.context['results']], ['Server status', 'Clients'])
+        self.assertContains(response, '<mark>servers</mark>')
+        self.assertContains(response, 'server &lt;b&gt;')
+        self.assertNotContains(response, 'server <b>')
+
+        response = client.get(reverse('blog:search'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('results', response.context)
+
+
+@override_settings(BLOG_IMAGE_WIDTHS=[480, 960, 4000], BLOG_IMAGE_FORMATS=['webp'])
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.override = self.settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def create(self, name='screenshot.png', size=(1200, 600), fmt='PNG'):
+        buf = io.BytesIO()
+        PILImage.new('RGB', size, 'red').save(buf, fmt)
+        image = Image(name=name)
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                self.mock_celery() as mocked:
+            image.image.save(name, ContentFile(buf.getvalue()))
+        self.assertTaskCall(mocked, update_image_derivatives, image.pk)
+        return Image.objects.get(pk=image.pk)
+
+    def render(self, template):
+        return Template('{% load blog %}' + template).render(Context({}))
+
+    def test_derivatives(self):
+        image = self.create()
+        self.assertEqual((image.width, image.height), (1200, 600))
+
+        derivatives = {(d.width, d.format): d for d in image.derivatives.all()}
+        self.assertEqual(set(derivatives), {
+            (480, 'png'), (480, 'webp'), (960, 'png'), (960, 'webp'), (1200, 'webp'),
+        })
+        derivative = derivatives[(480, 'webp')]
+        self.assertEqual(derivative.height, 240)
+        self.assertRegex(derivative.file.name, r'^derivatives/screenshot\.[0-9a-f]{16}\.480w\.webp$')
+        with PILImage.open(derivative.file.path) as pil_image:
+            self.assertEqual((pil_image.format, pil_image.size), ('WEBP', (480, 240)))
+
+        # Unchanged derivatives are kept, changed ones are replaced. Unsupported formats are skipped.
+        with self.settings(BLOG_IMAGE_FORMATS=['webp', 'avif']), self.assertLogs('blog.images', 'WARNING'):
+            image.update_derivatives()
+        self.assertEqual(set(image.derivatives.all()), set(derivatives.values()))
+
+        buf = io.BytesIO()
+        PILImage.new('RGB', (600, 300), 'blue').save(buf, 'PNG')
+        image.image.save('other.png', ContentFile(buf.getvalue()), save=False)
+        image.update_derivatives()
+        self.assertEqual({(d.width, d.format) for d in image.derivatives.all()},
+                         {(480, 'png'), (480, 'webp'), (600, 'webp')})
+        self.assertFalse(os.path.exists(derivative.file.path))
+
+        image.delete()
+        self.assertFalse(ImageDerivative.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'derivatives')), [])
+
+    def test_shared_files(self):
+        first = self.create()
+        second = Image.objects.create(name='copy.png', image=first.image.name)
+        second.update_derivatives()
+        self.assertEqual({d.file.name for d in first.derivatives.all()},
+                         {d.file.name for d in second.derivatives.all()})
+
+        # Files are only removed when the last image using them is deleted
+        path = first.derivatives.first().file.path
+        first.delete()
+        self.assertTrue(os.path.exists(path))
+        second.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_no_derivatives(self):
+        svg = Image(name='badge.svg')
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                self.mock_celery():
+            svg.image.save('badge.svg', ContentFile(b'<svg xmlns="http://www.w3.org/2000/svg"/>'))
+        svg = Image.objects.get(pk=svg.pk)
+        self.assertIsNone(svg.width)
+        self.assertFalse(svg.derivatives.exists())
+        self.assertHTMLEqual(self.render('{% image "badge.svg" %}'), '<img src="/media/badge.svg" alt="">')
+
+        gif = self.create('animation.gif', fmt='GIF')
+        self.assertEqual(gif.width, 1200)
+        self.assertFalse(gif.derivatives.exists())
+
+    def test_template_tag(self):
+        image = self.create()
+        urls = {(d.width, d.format): d.file.url for d in image.derivatives.all()}
+        webp = '%s 480w, %s 960w, %s 1200w' % (urls[(480, 'webp')], urls[(960, 'webp')], urls[(1200, 'webp')])
+        png = '%s 480w, %s 960w, /media/screenshot.png 1200w' % (urls[(480, 'png')], urls[(960, 'png')])
+
+        html = self.render('{% image "screenshot.png" alt="Screenshot" class="img-fluid" %}')
+        self.assertHTMLEqual(html, """
+            <picture>
+                <source type="image/webp" srcset="%s" sizes="100vw">
+                <img src="/media/screenshot.png" alt="Screenshot" width="1200" height="600" class="img-fluid"
+                     srcset="%s" sizes="100vw">
+            </picture>""" % (webp, png))
+
+        with self.assertLogs('blog.templatetags.blog', 'ERROR'):
+            self.assertEqual(self.render('{% image "does-not-exist.png" %}'), '')
+
+    def test_command(self):
+        image = self.create()
+        ImageDerivative.objects.all().delete()
+        Image.objects.update(width=None)
+
+        stdout = StringIO()
+        call_command('update_image_derivatives', processes=1, stdout=stdout)
+        self.assertIn('Updated 1 images', stdout.getvalue())
+        self.assertEqual(image.derivatives.count(), 5)
+
+
+class BadgeHandler(BaseHTTPRequestHandler):
+    """A minimal observatory serving the badges in ``server.badges``."""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        host = parse_qs(url.query).get('domain', [''])[0]
+
+        with self.server.lock:
+            self.server.requests.append((host, self.headers.get('If-None-Match')))
+            self.server.active += 1
+            self.server.max_active = max(self.server.active, self.server.max_active)
+        try:
+            time.sleep(self.server.delays.get(host, 0.05))
+            if host not in self.server.badges:
+                self.send_error(404)
+                return
+
+            etag, content = self.server.badges[host]
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/svg+xml')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BadgeDownloadTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BadgeHandler)
+        self.server.badges = {
+            'example.com': ('"a1"', b'<svg>a</svg>'),
+            'example.net': ('"b1"', b'<svg>b</svg>'),
+            'example.org': ('"c1"', b'<svg>c</svg>'),
+        }
+        self.server.delays = {}
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.max_active = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.override = self.settings(
+            MEDIA_ROOT=self.media_root, XMPP_HOSTS={host: {} for host in self.server.badges},
+            OBSERVATORY_URL='http://127.0.0.1:%s/badge.php' % self.server.server_address[1])
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.media_root)
+        super().tearDown()
+
+    def badge(self, host):
+        return Image.objects.get(name='badge_%s.svg' % host.replace('.', '_'))
+
+    def test_download(self):
+        self.assertEqual(download_xmpp_net_badges(), 3)
+        self.assertGreater(self.server.max_active, 1)  # hosts are fetched concurrently
+
+        badge = self.badge('example.com')
+        self.assertEqual(badge.etag, '"a1"')
+        self.assertEqual(badge.sha256, hashlib.sha256(b'<svg>a</svg>').hexdigest())
+        with badge.image.open('rb') as stream:
+            self.assertEqual(stream.read(), b'<svg>a</svg>')
+
+        # Conditional requests for the second run, nothing changed
+        self.server.requests = []
+        with mock.patch('blog.models.Image.save') as save:
+            self.assertEqual(download_xmpp_net_badges(), 0)
+        save.assert_not_called()
+        self.assertEqual(sorted(self.server.requests), [
+            ('example.com', '"a1"'), ('example.net', '"b1"'), ('example.org', '"c1"'),
+        ])
+
+        # The ETag changed but the content didn't, so only the ETag is updated
+        self.server.badges['example.com'] = ('"a2"', b'<svg>a</svg>')
+        self.server.badges['example.net'] = ('"b2"', b'<svg>b2</svg>')
+        self.assertEqual(download_xmpp_net_badges(), 1)
+        self.assertEqual(self.badge('example.com').image.name, badge.image.name)
+        self.assertEqual(self.badge('example.com').etag, '"a2"')
+
+        # The old file of a changed badge is removed
+        net = self.badge('example.net')
+        self.assertEqual(net.etag, '"b2"')
+        with net.image.open('rb') as stream:
+            self.assertEqual(stream.read(), b'<svg>b2</svg>')
+        self.assertEqual(sorted(os.listdir(self.media_root)), sorted(
+            self.badge(host).image.name for host in self.server.badges))
+
+    def test_errors(self):
+        del self.server.badges['example.net']
+        self.server.delays['example.org'] = 1
+
+        with self.assertLogs('blog.tasks', 'ERROR') as logs:
+            self.assertEqual(download_xmpp_net_badges(timeout=0.3), 1)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('example.net: HTTP 404', logs.output[0])
+        self.assertIn('example.org', logs.output[1])
+        self.assertEqual(Image.objects.count(), 1)
+
+        # Existing files without a stored hash are compared as well
+        Image.objects.update(sha256='', etag='')
+        with mock.patch('blog.models.Image.save') as save, self.assertLogs('blog.tasks', 'ERROR'):
+            self.assertEqual(download_xmpp_net_badges(timeout=0.3), 0)
+        save.assert_not_called()
@@ -21,5 +21,6 @@ app_name = 'blog'
 urlpatterns = [
     url(r'^b/(?P<slug>[a-z0-9-_äöüß]+)/$', views.BlogPostView.as_view(), name='blogpost'),
     url(r'^p/(?P<slug>[a-z0-9-_äöüß]+)/$', views.PageView.as_view(), name='page'),
+    url(r'^search/$', views.SearchView.as_view(), name='search'),
     url(r'^$', views.BlogPostListView.as_view(), name='home'),
 ]
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+
+from django import template
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory
+from django.utils import translation
+from django.utils.http import base36_to_int
+from django.utils.http import int_to_base36
+
+from .links import collect_links
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+TEMPLATE_PREFIX = '{% load blog core icons %}'
+"""Prefix added to any text from the database before compiling it as template."""
+
+
+def get_fallback_request(path='/', host=None):
+    """Get a request for rendering texts outside of a request, e.g. when computing summaries.
+
+    The request is for an anonymous user on the default site (``DEFAULT_XMPP_HOST``) in the currently
+    active language, so template tags that depend on the request behave as if the default site was
+    viewed by an anonymous user with an unknown operating system. Pass ``host`` to get a request for the
+    site serving that host instead.
+    """
+    from core.middleware import HomepageMiddleware
+
+    if host is None:
+        request = RequestFactory().get(path)
+    else:
+        request = RequestFactory().get(path, HTTP_HOST=host)
+    request.user = AnonymousUser()
+    request.LANGUAGE_CODE = translation.get_language() or settings.LANGUAGE_CODE
+    HomepageMiddleware(lambda r: None)(request)
+    return request
+
+
+def compile_template(text):
+    """Compile a text from the database as template.
+
+    The ``blog_links`` attribute of the returned template contains all links to pages and blog posts, see
+    :py:func:`~blog.links.collect_links`.
+    """
+    compiled = template.Template('%s%s' % (TEMPLATE_PREFIX, text))
+    compiled.blog_links = collect_links(compiled.nodelist)
+    return compiled
+
+
+class TemplateCache(object):
+    """A thread-safe cache for compiled templates, the least recently used template is evicted first.
+
+    Compiled templates do not hold any state while rendering, so the same template can be rendered by
+    multiple threads at once. The ``BLOG_TEMPLATE_CACHE_SIZE`` setting is read on every access, so it
+    can be changed at runtime. If it is ``0``, templates are never cached.
+
+    >>> cache = TemplateCache()
+    >>> t = cache.get(('page', 1), 'foo')
+    >>> cache.get(('page', 1), 'foo') is t
+    True
+    >>> cache.get(('page', 1), 'bar') is t  # text was modified but not saved
+    False
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.templates)
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.hits = self.misses = 0
+
+    def get(self, key, text):
+        """Get the compiled template for ``text``.
+
+        The text is stored alongside the compiled template, if it doesn't match, the template is compiled
+        again. This way, unsaved modifications are never rendered from a stale template.
+        """
+        size = settings.BLOG_TEMPLATE_CACHE_SIZE
+        if size <= 0:
+            return compile_template(text)
+
+        with self.lock:
+            cached = self.templates.get(key)
+            if cached is not None and cached[0] == text:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        # Compile outside of the lock, so that other threads don't have to wait.
+        compiled = compile_template(text)
+
+        with self.lock:
+            self.templates[key] = (text, compiled)
+            self.templates.move_to_end(key)
+            while len(self.templates) > size:
+                self.templates.popitem(last=False)
+        return compiled
+
+
+template_cache = TemplateCache()
+
+
+def make_cursor(post):
+    """Get a cursor for the position of a blog post in the blog.
+
+    The position is defined by :py:func:`~blog.querysets.BlogPostQuerySet.blog_order`, so the cursor
+    encodes ``sticky``, ``created`` (in microseconds since the epoch) and the primary key.
+
+    >>> from blog.models import BlogPost
+    >>> make_cursor(BlogPost(pk=3, sticky=True, created=datetime(2020, 1, 1, tzinfo=dt_timezone.utc)))
+    '1_fjao7w6io0_3'
+    """
+    created = (post.created - EPOCH) // timedelta(microseconds=1)
+    return '%s_%s_%s' % (int(post.sticky), int_to_base36(created), int_to_base36(post.pk))
+
+
+def parse_cursor(cursor):
+    """Parse a cursor created by :py:func:`make_cursor`.
+
+    Returns a tuple of ``sticky``, ``created`` and the primary key or ``None`` if the cursor is invalid.
+
+    >>> parse_cursor('1_fjao7w6io0_3')
+    (True, datetime.datetime(2020, 1, 1, 0, 0, tzinfo=datetime.timezone.utc), 3)
+    >>> parse_cursor('foo') is None
+    True
+    """
+    parts = cursor.split('_')
+    if len(parts) != 3 or parts[0] not in ('0', '1'):
+        return None
+
+    try:
+        created = EPOCH + timedelta(microseconds=base36_to_int(parts[1]))
+        pk = base36_to_int(parts[2])
+    except (ValueError, OverflowError):
+        return None
+    return parts[0] == '1', created, pk
+
+
+class KeysetPage(object):
+    """A page of blog posts, paginated by cursors instead of page numbers.
+
+    Unlike with page numbers, the database does not have to skip over all previous pages, so every page is
+    as fast as the first page.
+
+    Parameters
+    ----------
+
+    queryset : :py:class:`~blog.querysets.BlogPostQuerySet`
+        The blog posts to paginate, ordered by :py:func:`~blog.querysets.BlogPostQuerySet.blog_order`.
+    page_size : int
+        Number of blog posts on a page.
+    after : str, optional
+        Cursor of the post before the page, as returned by ``next_cursor``.
+    before : str, optional
+        Cursor of the post after the page, as returned by ``previous_cursor``.
+    """
+
+    def __init__(self, queryset, page_size, after=None, before=None):
+        if before is not None:
+            # Get the posts before the cursor in reverse order
+            object_list = list(queryset.before(*before).reverse()[:page_size + 1])
+            self.has_previous = len(object_list) > page_size
+            self.has_next = True
+            self.object_list = object_list[:page_size][::-1]
+        else:
+            if after is not None:
+                queryset = queryset.after(*after)
+            object_list = list(queryset[:page_size + 1])
+            self.has_previous = after is not None
+            self.has_next = len(object_list) > page_size
+            self.object_list = object_list[:page_size]
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return make_cursor(self.object_list[0])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return make_cursor(self.object_list[-1])
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
@@ -16,7 +16,10 @@
 import logging
 
 from django.conf import settings
+from django.http import Http404
 from django.utils import timezone
+from django.utils.translation import gettext as _
+from django.views.generic.base import TemplateView
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 
@@ -25,6 +28,9 @@ from core.views import TranslateSlugViewMixin
 
 from .models import BlogPost
 from .models import Page
+from .search import search
+from .utils import KeysetPage
+from .utils import parse_cursor
 
 log = logging.getLogger(__name__)
 _BLACKLIST = getattr(settings, 'SPAM_BLACKLIST', set())
@@ -69,8 +75,31 @@ class BlogPostListView(HomepageViewMixin, BlogPostMixin, ListView):
     queryset = BlogPost.objects.select_related('author').blog_order()
     paginate_by = 10
 
+    def get_post_count(self, queryset):
+        if self.request.user.has_perm('blog.blogpost_change'):
+            return queryset.count()
+        return BlogPost.objects.published_count()
+
+    def get_cursor(self, name):
+        value = self.request.GET.get(name)
+        if value is None:
+            return None
+
+        cursor = parse_cursor(value)
+        if cursor is None:
+            raise Http404(_('Invalid page.'))
+        return cursor
+
+    def paginate_queryset(self, queryset, page_size):
+        """Paginate by cursors (see :py:class:`~blog.utils.KeysetPage`) instead of page numbers."""
+
+        page = KeysetPage(queryset, page_size, after=self.get_cursor('after'),
+                          before=self.get_cursor('before'))
+        return None, page, page.object_list, page.has_other_pages()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['post_count'] = self.get_post_count(self.object_list)
         if context['object_list']:
             newest = max(context['object_list'], key=lambda o: o.updated)
             context['updated'] = newest.updated
@@ -85,3 +114,16 @@ class BlogPostView(TranslateSlugViewMixin, BasePageMixin, BlogPostMixin, DetailV
     static_context = {
         'og_type': 'article',
     }
+
+
+class SearchView(HomepageViewMixin, TemplateView):
+    template_name = 'blog/search.html'
+    max_query_length = 200
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()[:self.max_query_length]
+        context['query'] = query
+        if query:
+            context['results'] = search(query)
+        return context
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.base import BaseHandler
+from django.db import close_old_connections
+
+
+class ThreadPoolASGIHandler(ASGIHandler):
+    """ASGI handler that runs views in a bounded thread pool.
+
+    Views of this project are synchronous and many of them wait for the XMPP backend. Djangos default
+    handler runs all synchronous code in a single thread, so one slow backend call blocks all other
+    requests handled by the same worker. This handler runs every request in a pool of ``ASGI_THREADS``
+    threads instead, so a single worker process can wait for many backend calls at once.
+    """
+
+    def __init__(self, threads=None):
+        super().__init__()
+        if threads is None:
+            threads = settings.ASGI_THREADS
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    def get_sync_response(self, request):
+        # Database connections are per thread, so they have to be handled here and not in the
+        # request_started/request_finished signals, which are sent by a different thread.
+        close_old_connections()
+        try:
+            return BaseHandler.get_response(self, request)
+        finally:
+            close_old_connections()
+
+    async def get_response(self, request):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.get_sync_response, request)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+HEADER = struct.Struct('<4sQI')
+"""File header: magic bytes, number of bits and number of hash functions."""
+
+MAGIC = b'HPBF'
+
+
+def get_positions(item, bits, hashes):
+    """Get the bit positions for the given item (using double hashing).
+
+    >>> get_positions('user@example.com', 1000, 3) == get_positions('user@example.com', 1000, 3)
+    True
+    >>> len(get_positions('user@example.com', 1000, 3))
+    3
+    """
+    digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+    h1, h2 = struct.unpack('<QQ', digest)
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class BloomFilter(object):
+    """A Bloom filter stored in a memory-mapped file.
+
+    A Bloom filter can tell that an item is definitely *not* in a set, false positives are possible. Because
+    the file is memory-mapped, the filter is shared by all processes using the same file and items added by
+    one process are immediately visible to all others. :py:func:`~core.bloom.BloomFilter.create` replaces
+    the file atomically, processes using the filter notice this and map the new file.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the file, the file does not have to exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._mmap = None
+        self._inode = None
+        self.bits = self.hashes = None
+
+    @classmethod
+    def create(cls, path, items, capacity, error_rate=0.01):
+        """Create a new filter containing ``items``.
+
+        Parameters
+        ----------
+
+        path : str
+            Path to the file, an existing file is replaced.
+        items : iterable of str
+            The items the filter should contain.
+        capacity : int
+            The number of items the filter is sized for. A filter with more items than that has more false
+            positives than ``error_rate``.
+        error_rate : float, optional
+            Desired probability of false positives.
+        """
+        capacity = max(capacity, 1)
+        bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        hashes = max(int(round(bits / capacity * math.log(2))), 1)
+
+        data = bytearray((bits + 7) // 8)
+        for item in items:
+            for pos in get_positions(item, bits, hashes):
+                data[pos >> 3] |= 1 << (pos & 7)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as stream:
+            stream.write(HEADER.pack(MAGIC, bits, hashes))
+            stream.write(data)
+        os.replace(temp_path, path)
+
+        return cls(path)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = self._inode = None
+
+    def _map(self):
+        """Map the file (again if it was replaced), returns ``False`` if it does not exist."""
+
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self.close()
+            return False
+
+        if inode != self._inode:
+            self.close()
+            with open(self.path, 'r+b') as stream:
+                self._mmap = mmap.mmap(stream.fileno(), 0)
+            magic, self.bits, self.hashes = HEADER.unpack_from(self._mmap)
+            if magic != MAGIC:
+                self.close()
+                raise ValueError('%s: Not a Bloom filter.' % self.path)
+            self._inode = inode
+        return True
+
+    def __contains__(self, item):
+        """``False`` if the item is definitely not in the filter.
+
+        If the file does not exist, this always returns ``True``, so callers fall back to checking the
+        authoritative source.
+        """
+        with self.lock:
+            if self._map() is False:
+                return True
+
+            for pos in get_positions(item, self.bits, self.hashes):
+                if not self._mmap[HEADER.size + (pos >> 3)] & (1 << (pos & 7)):
+                    return False
+            return True
+
+    def add(self, item):
+        """Add an item to the filter. Does nothing if the file does not exist."""
+
+        with self.lock:
+            if self._map() is False:
+                return
+
+            # Lock the file so that concurrent writers don't overwrite each others bits.
+            with open(self.path, 'rb') as stream:
+                fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+                try:
+                    for pos in get_positions(item, self.bits, self.hashes):
+                        offset = HEADER.size + (pos >> 3)
+                        self._mmap[offset] |= 1 << (pos & 7)
+                finally:
+                    fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
@@ -16,6 +16,8 @@
 from django.template.response import TemplateResponse
 from django.utils.translation import gettext_lazy as _
 
+from xmpp_backends.base import BackendConnectionError
+
 
 class HomepageException(Exception):
     """Base class for all custom exceptions from this homepage."""
@@ -72,3 +74,12 @@ class HttpResponseException(HomepageException):
 class TemporaryError(HttpResponseException):
     status = 503
     title = _('Temporary error')
+
+
+class BackendUnavailable(HomepageException, BackendConnectionError):
+    """Raised instead of calling the XMPP backend if it failed too often recently.
+
+    This is a subclass of :py:class:`~xmpp_backends.base.BackendConnectionError`, so it is handled
+    just like any other backend error by :py:class:`~core.middleware.HomepageMiddleware`.
+    """
+    pass
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+from django.conf import settings
+
+from gpgliblib.django import GpgEmailMessage
+
+from .stats import LatencyStats
+
+log = logging.getLogger(__name__)
+
+
+class GpgStats(LatencyStats):
+    """Timings of GPG operations, view them with the ``gpg_stats`` management command."""
+
+    cache_prefix = 'gpg-stats'
+
+
+stats = GpgStats()
+
+
+class TimedGpgEmailMessage(GpgEmailMessage):
+    """A :py:class:`~gpgliblib.django.GpgEmailMessage` that records how long signing and encryption takes."""
+
+    def encrypt_message(self, message):
+        start = time.monotonic()
+        try:
+            return super().encrypt_message(message)
+        finally:
+            duration = time.monotonic() - start
+            log.debug('Encrypted message to %s recipient(s) in %.3fs', len(self.gpg_recipients), duration)
+            stats.observe('sign_encrypt' if self.signed else 'encrypt', duration)
+
+    def sign_message(self, message, **kwargs):
+        start = time.monotonic()
+        try:
+            return super().sign_message(message, **kwargs)
+        finally:
+            duration = time.monotonic() - start
+            log.debug('Signed message in %.3fs', duration)
+            stats.observe('sign', duration)
+
+    def prepare(self):
+        """Sign and encrypt the message now and reuse the result when it is sent.
+
+        Call this while the GPG backend is still usable, so that the keyring does not have to stay
+        locked while the message is sent (which may take a while with retries).
+        """
+        self._prepared = self.message()
+
+    def message(self):
+        prepared = getattr(self, '_prepared', None)
+        if prepared is not None:
+            return prepared
+        return super().message()
+
+
+class KeyringPool(object):
+    """A bounded pool of persistent GPG keyrings on disk.
+
+    Every keyring is identified by a list of strings, usually the fingerprints of the keys it contains. A
+    keyring is created (and keys are imported) only the first time it is requested, later requests for the
+    same list of strings reuse the existing keyring. If the pool grows larger than ``size`` keyrings, the
+    least recently used keyrings are removed.
+
+    Keyrings are protected by file locks, so multiple processes (e.g. Celery workers) can share the same
+    pool. A keyring is locked for as long as it is used.
+
+    Parameters
+    ----------
+
+    path : str
+        The directory where keyrings are stored. Keyrings may contain private keys, so the directory
+        must only be accessible by the user running the homepage and Celery workers. It is created with
+        mode ``0700`` if it does not exist.
+    size : int, optional
+        The maximum number of keyrings to keep.
+    """
+
+    lock_stripes = 256
+    """Number of lock files used, keyrings with the same hash prefix share a lock."""
+
+    def __init__(self, path, size=100):
+        self.path = path
+        self.size = size
+
+    def get_name(self, parts):
+        """Get the directory name for the given identifiers.
+
+        >>> pool = KeyringPool('/tmp/pool')
+        >>> pool.get_name(['b', 'a']) == pool.get_name(['a', 'b'])
+        True
+        """
+        return hashlib.sha256('\n'.join(sorted(parts)).encode('utf-8')).hexdigest()
+
+    def get_lock_path(self, name):
+        stripe = int(name[:8], 16) % self.lock_stripes
+        return os.path.join(self.path, 'locks', '%03d.lock' % stripe)
+
+    @contextmanager
+    def lock(self, name, blocking=True):
+        """Context manager holding an exclusive lock for the keyring with the given name.
+
+        If ``blocking=False``, the context manager yields ``False`` if the lock is currently held by someone
+        else.
+        """
+        flags = fcntl.LOCK_EX
+        if blocking is False:
+            flags |= fcntl.LOCK_NB
+
+        fd = os.open(self.get_lock_path(name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, flags)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def keyrings(self):
+        """Get a list of ``(mtime, name)`` tuples of all keyrings in the pool."""
+        keyrings = []
+        for name in os.listdir(self.path):
+            if name == 'locks':
+                continue
+
+            try:
+                keyrings.append((os.stat(os.path.join(self.path, name)).st_mtime, name))
+            except FileNotFoundError:  # removed by a different process in the meantime
+                continue
+        return keyrings
+
+    def evict(self):
+        """Remove the least recently used keyrings until the pool is within its configured size.
+
+        Keyrings that are currently in use are skipped.
+        """
+        keyrings = sorted(self.keyrings())
+        for mtime, name in keyrings[:max(len(keyrings) - self.size, 0)]:
+            with self.lock(name, blocking=False) as locked:
+                if locked is True:
+                    log.debug('Evicting GPG keyring %s', name)
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    @contextmanager
+    def keyring(self, backend, parts, init, **kwargs):
+        """Context manager yielding a GPG backend using a keyring from the pool.
+
+        Parameters
+        ----------
+
+        backend : :py:class:`~gpgliblib.base.GpgBackendBase`
+            The GPG backend to use.
+        parts : list of str
+            The identifiers for this keyring.
+        init : callable
+            Called with the backend as only argument if the keyring was newly created. Use this function to
+            import keys into the keyring.
+        **kwargs
+            Passed to :py:func:`~gpgliblib.base.GpgBackendBase.settings`.
+        """
+        # The pool contains copies of private keys, so it must only be readable by the current user
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.join(self.path, 'locks'), mode=0o700, exist_ok=True)
+        name = self.get_name(parts)
+        home = os.path.join(self.path, name)
+        marker = os.path.join(home, '.complete')
+        created = False
+
+        with self.lock(name):
+            if os.path.exists(marker):
+                os.utime(home)  # mark as recently used
+            else:
+                # Remove any leftovers of a keyring that was not fully initialized.
+                shutil.rmtree(home, ignore_errors=True)
+                os.mkdir(home, mode=0o700)
+
+                try:
+                    with backend.settings(home=home, **kwargs) as temp_backend:
+                        init(temp_backend)
+                except Exception:
+                    shutil.rmtree(home, ignore_errors=True)
+                    raise
+
+                open(marker, 'w').close()
+                created = True
+
+            with backend.settings(home=home, **kwargs) as pool_backend:
+                yield pool_backend
+
+        if created is True:
+            self.evict()
+
+
+def get_keyring_pool():
+    """Get the pool configured by the ``GPG_KEYRING_CACHE_DIR`` setting or ``None`` if it is disabled."""
+
+    if not settings.GPG_KEYRING_CACHE_DIR:
+        return None
+    return KeyringPool(settings.GPG_KEYRING_CACHE_DIR, size=settings.GPG_KEYRING_CACHE_SIZE)
+
+
+class KeyFetcher(object):
+    """Fetch many GPG keys from HKP keyservers concurrently.
+
+    Keys are fetched by a bounded pool of threads, each thread uses its own HTTP session, so connections
+    to the keyserver are reused. To be polite to keyservers, two requests to the same host are at least
+    ``delay`` seconds apart, no matter how many threads are used.
+
+    Parameters
+    ----------
+
+    keyserver : str, optional
+        URL of the keyserver, the default is the ``GPG_KEYSERVER`` setting.
+    workers : int, optional
+        Number of keys fetched concurrently, the default is the ``GPG_KEY_REFRESH_WORKERS`` setting.
+    delay : float, optional
+        Minimum time in seconds between two requests to the same host, the default is the
+        ``GPG_KEY_REFRESH_DELAY`` setting.
+    timeout : float, optional
+        Timeout for a single request.
+    """
+
+    def __init__(self, keyserver=None, workers=None, delay=None, timeout=10):
+        if keyserver is None:
+            keyserver = settings.GPG_KEYSERVER
+        if workers is None:
+            workers = settings.GPG_KEY_REFRESH_WORKERS
+        if delay is None:
+            delay = settings.GPG_KEY_REFRESH_DELAY
+
+        self.keyserver = keyserver.rstrip('/')
+        self.host = urlsplit(self.keyserver).netloc
+        self.workers = workers
+        self.delay = delay
+        self.timeout = timeout
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.next_request = {}  # maps hosts to when the next request may be sent
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def wait(self, host):
+        """Wait until the next request to ``host`` may be sent."""
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + self.delay
+
+        if start > now:
+            time.sleep(start - now)
+
+    def fetch(self, fingerprint):
+        """Fetch a single key, returns the ASCII armored key as bytes."""
+
+        self.wait(self.host)
+        response = self.session.get('%s/pks/lookup' % self.keyserver, timeout=self.timeout, params={
+            'search': '0x%s' % fingerprint,
+            'options': 'mr',
+            'op': 'get',
+        })
+        response.raise_for_status()
+        return response.content.strip()
+
+    def fetch_many(self, fingerprints):
+        """Fetch multiple keys.
+
+        Returns a dictionary mapping each fingerprint to either the key (as bytes) or the exception raised
+        when fetching it.
+        """
+
+        fingerprints = sorted(set(fingerprints))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {fp: executor.submit(self.fetch, fp) for fp in fingerprints}
+
+        keys = {}
+        for fp, future in futures.items():
+            try:
+                keys[fp] = future.result()
+            except Exception as e:
+                keys[fp] = e
+        return keys
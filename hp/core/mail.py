@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import logging
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+log = logging.getLogger(__name__)
+
+
+class Mailer(object):
+    """Send emails over a shared connection, with a per-domain throttle and retries.
+
+    Use this class as context manager to send multiple emails over the same connection to the mail
+    server::
+
+        with Mailer() as mailer:
+            for msg in messages:
+                mailer.send(msg)
+
+    The connection is opened when the first email is sent. If not used as a context manager, every
+    call to :py:func:`~core.mail.Mailer.send` opens its own connection and errors are never retried.
+
+    Parameters
+    ----------
+
+    connection : optional
+        The email backend to use, the default is returned by Djangos ``get_connection()``.
+    throttle : dict, optional
+        Minimum time in seconds between two emails to the same domain, the default is the
+        ``EMAIL_THROTTLE`` setting.
+    retries : int, optional
+        How often sending an email is retried, the default is the ``EMAIL_RETRIES`` setting.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled with every retry. The default is the
+        ``EMAIL_RETRY_BACKOFF`` setting.
+    """
+
+    def __init__(self, connection=None, throttle=None, retries=None, backoff=None):
+        if connection is None:
+            connection = get_connection()
+        if throttle is None:
+            throttle = settings.EMAIL_THROTTLE
+        if retries is None:
+            retries = settings.EMAIL_RETRIES
+        if backoff is None:
+            backoff = settings.EMAIL_RETRY_BACKOFF
+
+        self.connection = connection
+        self.throttle = throttle
+        self.retries = retries
+        self.backoff = backoff
+        self.batch = False
+        self.opened = False
+        self.last_sent = {}  # maps domains to when the last email was sent
+        self.sent = 0
+
+    def __enter__(self):
+        self.batch = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.batch = False
+        if self.opened:
+            self.close()
+
+    def is_temporary(self, error, connecting=False):
+        """Return ``True`` if sending the email might succeed later.
+
+        Errors other than a temporary (4xx) reply of the mail server are only considered temporary while
+        connecting: If the connection is lost after the message was sent, the server might have accepted it
+        already and retrying would send it twice.
+        """
+
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, msg in error.recipients.values())
+        return connecting and isinstance(error, OSError)
+
+    def connect(self, reconnect=False):
+        if reconnect and self.opened:  # the connection might be broken
+            self.close()
+        if not self.opened:
+            self.connection.open()
+            self.opened = True
+
+    def close(self):
+        self.opened = False
+        self.connection.close()
+
+    def wait(self, message):
+        """Wait until the throttle allows sending the message to all recipient domains."""
+
+        domains = set(r.rsplit('@', 1)[-1].lower() for r in message.recipients())
+        now = time.monotonic()
+
+        wait = 0
+        for domain in domains:
+            interval = self.throttle.get(domain, self.throttle.get('*', 0))
+            if interval and domain in self.last_sent:
+                wait = max(wait, self.last_sent[domain] + interval - now)
+
+        if wait > 0:
+            log.debug('Throttling email to %s for %.2f seconds.', ', '.join(sorted(domains)), wait)
+            time.sleep(wait)
+
+        now = time.monotonic()
+        for domain in domains:
+            self.last_sent[domain] = now
+
+    def send(self, message):
+        """Send a single email message.
+
+        Temporary errors are only retried if the mailer is used as a context manager, so that sending a
+        single email never sleeps in the calling thread.
+        """
+
+        message.connection = self.connection
+        self.wait(message)
+        retries = self.retries if self.batch else 0
+
+        for attempt in range(retries + 1):
+            connecting = True
+            try:
+                self.connect(reconnect=attempt > 0)
+                connecting = False
+
+                sent = self.connection.send_messages([message])
+                self.sent += sent or 0
+                return sent
+            except Exception as e:
+                if attempt >= retries or not self.is_temporary(e, connecting=connecting):
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                log.warning('Sending email failed (%s), retrying in %.1f seconds.', e, delay)
+                time.sleep(delay)
+            finally:
+                if not self.batch and self.opened:
+                    self.close()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...utils import absolutify_html
+from ...utils import absolutify_html_dom
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'tests', 'testdata',
+                           'absolutify', 'input')
+
+
+class Command(BaseCommand):
+    help = "Benchmark making links in HTML absolute (as done for RSS/Atom feeds)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--count', type=int, default=200, metavar='N',
+            help='How often to process every document (default: %(default)s).')
+        parser.add_argument(
+            'paths', nargs='*', metavar='PATH',
+            help='HTML files to use, the default are the files used in the test suite.')
+
+    def handle(self, count, paths, **options):
+        if not paths:
+            paths = [os.path.join(CORPUS_PATH, name) for name in sorted(os.listdir(CORPUS_PATH))]
+
+        documents = []
+        for path in paths:
+            with open(path, encoding='utf-8') as stream:
+                documents.append(stream.read())
+
+        results = {}
+        for label, func in [('html5lib', absolutify_html_dom), ('streaming', absolutify_html)]:
+            start = time.monotonic()
+            for i in range(count):
+                for html in documents:
+                    func(html, 'https://example.com')
+            results[label] = time.monotonic() - start
+
+            calls = count * len(documents)
+            self.stdout.write('%s: %s calls in %.2fs, mean %.3fms' % (
+                label, calls, results[label], results[label] / calls * 1000))
+
+        self.stdout.write('Speedup: %.1fx' % (results['html5lib'] / results['streaming']))
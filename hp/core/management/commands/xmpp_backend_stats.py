@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from ...stats import LATENCY_BUCKETS
+from ...stats import LatencyHistogram
+from ...xmpp import stats
+
+
+class Command(BaseCommand):
+    help = "Show latency histograms of XMPP backend calls (requires core.xmpp.InstrumentedBackend)."
+    stats = stats
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--buckets', action='store_true', default=False,
+            help='Also show the raw bucket counts.')
+        parser.add_argument(
+            '--reset', action='store_true', default=False,
+            help='Reset all collected statistics after displaying them.')
+
+    def handle(self, *args, **options):
+        histograms = self.stats.load()
+        if not histograms:
+            self.stdout.write('No statistics collected yet.')
+            return
+
+        self.stdout.write('%-20s %8s %10s %8s %8s %8s' % ('method', 'calls', 'mean', 'p50', 'p95', 'p99'))
+        for method, hist in histograms.items():
+            self.stdout.write('%-20s %8s %8.1fms %8s %8s %8s' % (
+                method, hist.count, hist.mean, hist.format_percentile(50), hist.format_percentile(95),
+                hist.format_percentile(99)))
+
+            if options['buckets']:
+                bounds = [LatencyHistogram.format_bound(b) for b in LATENCY_BUCKETS + (None, )]
+                for bound, count in zip(bounds, hist.counts):
+                    self.stdout.write('    %-10s %s' % (bound, count))
+
+        if options['reset']:
+            self.stats.reset()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Latency statistics shared by the XMPP backend, GPG operations and benchmarks."""
+
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in milliseconds) of the latency histogram buckets. The last bucket counts anything
+# slower than the last bound.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram(object):
+    """A simple fixed-bucket histogram of call latencies in milliseconds.
+
+    >>> h = LatencyHistogram()
+    >>> for ms in [3, 7, 7, 40, 800]:
+    ...     h.observe(ms)
+    >>> h.count
+    5
+    >>> h.percentile(50), h.percentile(95)
+    (10, 1000)
+    >>> h.format_percentile(50), h.format_percentile(95)
+    ('<=10ms', '<=1000ms')
+
+    Buckets are too coarse for benchmarks, so with ``keep_samples=True``, all observed values are kept and
+    percentiles are exact:
+
+    >>> h = LatencyHistogram(keep_samples=True)
+    >>> for ms in [3, 7, 7, 40, 800]:
+    ...     h.observe(ms)
+    >>> h.percentile(50), h.percentile(95)
+    (7, 800)
+    >>> h.format_percentile(50)
+    '7.00ms'
+    """
+
+    def __init__(self, counts=None, total=0, keep_samples=False):
+        if counts is None:
+            counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.counts = counts
+        self.total = total
+        self.samples = [] if keep_samples else None
+
+    def observe(self, ms):
+        self.counts[bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.total += ms
+        if self.samples is not None:
+            self.samples.append(ms)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """Get the upper bound of the bucket the given percentile falls into.
+
+        Returns ``None`` if the percentile is in the last (unbounded) bucket. If samples are kept, the exact
+        value (using the nearest-rank method) is returned instead.
+        """
+        if self.samples:
+            samples = sorted(self.samples)
+            return samples[max(math.ceil(len(samples) * percent / 100) - 1, 0)]
+
+        threshold = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+    @staticmethod
+    def format_bound(bound):
+        """Format a bucket bound, ``None`` is the last (unbounded) bucket."""
+        if bound is None:
+            return '>%sms' % LATENCY_BUCKETS[-1]
+        return '<=%sms' % bound
+
+    def format_percentile(self, percent):
+        """Format the given percentile for display, see :py:func:`~core.stats.LatencyHistogram.percentile`."""
+        if self.samples:
+            return '%.2fms' % self.percentile(percent)
+        return self.format_bound(self.percentile(percent))
+
+
+class LatencyStats(object):
+    """Per-process latency histograms for named operations.
+
+    Histograms are collected in memory and merged into the cache every ``flush_interval`` seconds,
+    so the data of all web and Celery workers can be viewed in one place. Subclasses set
+    ``cache_prefix`` to keep their data apart.
+    """
+
+    cache_prefix = None
+    flush_interval = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.last_flush = time.monotonic()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].observe(seconds * 1000)
+            flush = time.monotonic() - self.last_flush > self.flush_interval
+
+        if flush:
+            self.flush()
+
+    def _keys(self, name):
+        # one key for every bucket plus one for the total time
+        return ['%s:%s:%s' % (self.cache_prefix, name, i) for i in range(len(LATENCY_BUCKETS) + 2)]
+
+    def flush(self):
+        """Merge the histograms collected by this process into the cache."""
+
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            self.last_flush = time.monotonic()
+
+        if not histograms:
+            return
+
+        try:
+            names_key = '%s:methods' % self.cache_prefix
+            cache.set(names_key, cache.get(names_key, set()) | set(histograms), None)
+
+            for name, hist in histograms.items():
+                values = hist.counts + [int(hist.total)]
+                for key, value in zip(self._keys(name), values):
+                    if value and not cache.add(key, value, None):
+                        cache.incr(key, value)
+        except Exception as e:  # statistics must never break an actual request
+            log.exception(e)
+
+    def load(self):
+        """Load the histograms of all processes from the cache."""
+
+        histograms = {}
+        for name in sorted(cache.get('%s:methods' % self.cache_prefix, set())):
+            keys = self._keys(name)
+            values = cache.get_many(keys)
+            values = [values.get(k, 0) for k in keys]
+            histograms[name] = LatencyHistogram(counts=values[:-1], total=values[-1])
+        return histograms
+
+    def reset(self):
+        """Reset statistics in the cache and of this process."""
+
+        with self.lock:
+            self.histograms = {}
+
+        names_key = '%s:methods' % self.cache_prefix
+        for name in cache.get(names_key, set()):
+            cache.delete_many(self._keys(name))
+        cache.delete(names_key)
@@ -26,9 +26,7 @@ from django.core.mail import EmailMessage
 from django.utils import timezone
 from django.utils import translation
 
-from gpgliblib.django import GpgEmailMessage
-from xmpp_http_upload.models import Upload
-
+from .gpg import TimedGpgEmailMessage
 from .models import Address
 from .models import AddressActivity
 from .models import CachedMessage
@@ -111,34 +109,47 @@ def send_contact_email(hostname, subject, message, recipient=None, user_pk=None,
         recipient_list.append(user.email)
         reply_to = [user.email, host['CONTACT_ADDRESS']]
         recv_fps = list(user.gpg_keys.valid().values_list('fingerprint', flat=True))
-        headers['X-Homepage-Logged-In-User'] = user
+        headers['X-Homepage-Logged-In-User'] = str(user)  # headers are passed to Celery tasks
 
     # If we have a GPG fingerprint for the user AND we have fingerprints for the contact addresses,
     # we use GPG.
     if recv_fps and host.get('CONTACT_GPG_FINGERPRINTS'):
-        contact_fps = load_contact_keys(hostname)
-        recv_fps += contact_fps.keys()
-        sign_fp = host.get('GPG_FINGERPRINT')
-
-        with user.gpg_keyring(default_trust=True, hostname=hostname) as backend:
-            for contact_key in contact_fps.values():
-                backend.import_key(contact_key)
-
-            msg = GpgEmailMessage(
-                subject, message, from_email, recipient_list, reply_to=reply_to, headers=headers,
-                gpg_backend=backend, gpg_recipients=recv_fps, gpg_signer=sign_fp)
-
-            # Attach the users public key(s) as "key.asc" so we can reply encrypted.
-            attachment = ''.join(user.gpg_keys.valid().values_list('key', flat=True))
-            msg.attach('key.asc', attachment, 'text/gpg-key')
-
-            msg.send()
+        args = (hostname, user_pk, subject, message, recipient_list, reply_to, headers)
+        if settings.GPG_QUEUE:
+            # Signing and encryption is slow, so it is done by dedicated workers.
+            send_gpg_contact_email.apply_async(args, queue=settings.GPG_QUEUE)
+        else:
+            send_gpg_contact_email(*args)
     else:
         email = EmailMessage(subject, message, from_email=from_email, to=recipient_list, reply_to=reply_to,
                              headers=headers)
         email.send()
 
 
+@shared_task
+def send_gpg_contact_email(hostname, user_pk, subject, message, recipient_list, reply_to, headers):
+    """Send a signed and encrypted contact email, called by :py:func:`~core.tasks.send_contact_email`."""
+
+    host = settings.XMPP_HOSTS[hostname]
+    from_email = host.get('DEFAULT_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
+    user = User.objects.get(pk=user_pk)
+
+    contact_fps = load_contact_keys(hostname)
+    recv_fps = list(user.gpg_keys.valid().values_list('fingerprint', flat=True)) + list(contact_fps)
+    sign_fp = host.get('GPG_FINGERPRINT')
+
+    with user.gpg_keyring(default_trust=True, hostname=hostname, extra_keys=contact_fps) as backend:
+        msg = TimedGpgEmailMessage(
+            subject, message, from_email, recipient_list, reply_to=reply_to, headers=headers,
+            gpg_backend=backend, gpg_recipients=recv_fps, gpg_signer=sign_fp)
+
+        # Attach the users public key(s) as "key.asc" so we can reply encrypted.
+        attachment = ''.join(user.gpg_keys.valid().values_list('key', flat=True))
+        msg.attach('key.asc', attachment, 'text/gpg-key')
+
+        msg.send()
+
+
 @shared_task
 def cleanup():
     """Remove various accumulating data from the core app."""
@@ -147,6 +158,3 @@ def cleanup():
     AddressActivity.objects.filter(timestamp__lt=expired).delete()
     Address.objects.inactive().delete()
     CachedMessage.objects.filter(created__lt=expired).delete()
-
-    # Cleanup XEP-0363 uploads
-    Upload.objects.cleanup()
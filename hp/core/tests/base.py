@@ -56,8 +56,8 @@ class HomepageTestCaseMixin(object):
 
     @contextmanager
     def mock_celery(self):
-        def run(self, args, kwargs):
-            return self.run(*args, **kwargs)
+        def run(self, args=None, kwargs=None, **options):
+            return self.run(*(args or ()), **(kwargs or {}))
 
         with mock.patch('celery.app.task.Task.apply_async', side_effect=run, autospec=True) as mocked:
             yield mocked
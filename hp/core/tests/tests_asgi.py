@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from django.conf.urls import url
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponse
+from django.test import override_settings
+from django.urls import reverse
+
+from xmpp_backends.django import xmpp_backend
+
+from ..asgi import ThreadPoolASGIHandler
+from .base import TestCase
+
+BACKEND_DELAY = 0.2
+
+
+def slow_backend_view(request):
+    exists = xmpp_backend.user_exists('user', 'example.com')
+    return HttpResponse(str(exists))
+
+
+urlpatterns = [
+    url(r'^slow/$', slow_backend_view),
+]
+
+
+async def request(app, path, method='GET', body=b'', headers=None):
+    """Send a single request to the ASGI application."""
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'host', b'testserver')] + (headers or []),
+        'client': ('127.0.0.1', 12345),
+        'server': ('testserver', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+
+async def get(app, path):
+    return await request(app, path)
+
+
+async def check_user(app, username):
+    """POST to :py:class:`~account.views.UserAvailableView`, like the registration form does."""
+
+    token = b'a' * 64
+    headers = [
+        (b'content-type', b'application/x-www-form-urlencoded'),
+        (b'cookie', b'csrftoken=' + token),
+        (b'x-csrftoken', token),
+    ]
+    body = ('username=%s&domain=example.com' % username).encode('utf-8')
+    return await request(app, reverse('account:api-check-user'), 'POST', body, headers)
+
+
+class ASGITestCaseMixin(object):
+    def setUp(self):
+        super().setUp()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def record_slow_call(self):
+        """Stand-in for a slow backend call that records how many calls are active at once."""
+
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(BACKEND_DELAY)
+        with self.lock:
+            self.active -= 1
+
+    def get_app(self, threads):
+        app = ThreadPoolASGIHandler(threads=threads)
+        self.addCleanup(app.executor.shutdown)
+        return app
+
+    def run_requests(self, app, func, requests):
+        # Use a separate event loop and close it afterwards. asyncio.run() would replace the default
+        # event loop of the main thread (created by Django) without closing it.
+        async def gather():
+            return await asyncio.gather(*[func(app) for i in range(requests)])
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(gather())
+        finally:
+            loop.close()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ThreadPoolASGIHandlerTestCase(ASGITestCaseMixin, TestCase):
+    def slow_user_exists(self, node, domain):
+        self.record_slow_call()
+        return True
+
+    def slow_backend(self):
+        return mock.patch('%s.xmpp_backend' % __name__, **{'user_exists.side_effect': self.slow_user_exists})
+
+    def load_test(self, app, requests):
+        return self.run_requests(app, lambda app: get(app, '/slow/'), requests)
+
+    def test_concurrency(self):
+        app = self.get_app(threads=10)
+
+        start = time.monotonic()
+        with self.slow_backend():
+            responses = self.load_test(app, 10)
+        duration = time.monotonic() - start
+
+        self.assertEqual(responses, [(200, b'True')] * 10)
+        self.assertEqual(self.max_active, 10)
+        self.assertLess(duration, BACKEND_DELAY * 5)
+
+    def test_bounded(self):
+        app = self.get_app(threads=2)
+        with self.slow_backend():
+            responses = self.load_test(app, 4)
+
+        self.assertEqual(len(responses), 4)
+        self.assertEqual(self.max_active, 2)
+
+
+class UserAvailableViewTestCase(ASGITestCaseMixin, TestCase):
+    """Compare the handler with Djangos stock ASGIHandler for a real view of this project."""
+
+    def slow_filter(self):
+        # A username filter whose lookup blocks like a call to a slow backend
+        username_filter = mock.MagicMock()
+        username_filter.__contains__.side_effect = lambda jid: self.record_slow_call()
+        return mock.patch('account.views.get_username_filter', return_value=username_filter)
+
+    def load_test(self, app, requests):
+        self.active = self.max_active = 0
+        start = time.monotonic()
+        with self.slow_filter():
+            responses = self.run_requests(app, lambda app: check_user(app, 'new'), requests)
+        return responses, time.monotonic() - start
+
+    def test_stock_handler(self):
+        stock_responses, stock_duration = self.load_test(ASGIHandler(), 4)
+        self.assertEqual(stock_responses, [(200, b'')] * 4)
+        self.assertEqual(self.max_active, 1)  # all views run in the same thread
+
+        responses, duration = self.load_test(self.get_app(threads=4), 4)
+        self.assertEqual(responses, [(200, b'')] * 4)
+        self.assertEqual(self.max_active, 4)
+        self.assertLess(duration, stock_duration / 2)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import doctest
+import os
+import tempfile
+
+from .. import bloom
+from ..bloom import BloomFilter
+from .base import TestCase
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(bloom))
+    return tests
+
+
+class BloomFilterTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.bloom')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_basic(self):
+        items = ['user%s@example.com' % i for i in range(1000)]
+        bf = BloomFilter.create(self.path, items, capacity=1000)
+        self.addCleanup(bf.close)
+
+        for item in items:
+            self.assertIn(item, bf)
+
+        false_positives = len([i for i in range(10000) if 'other%s@example.com' % i in bf])
+        self.assertLess(false_positives, 300)  # 1% expected
+
+    def test_missing(self):
+        bf = BloomFilter(self.path)
+        self.addCleanup(bf.close)
+        self.assertIn('anything', bf)  # unknown -> must be checked elsewhere
+        bf.add('anything')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_shared(self):
+        BloomFilter.create(self.path, ['a'], capacity=10)
+        first = BloomFilter(self.path)
+        second = BloomFilter(self.path)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.assertIn('a', first)
+        self.assertNotIn('b', second)
+
+        # Items added via one instance are visible in the other, because they share the mapped file
+        first.add('b')
+        self.assertIn('b', second)
+
+        # Replacing the file is noticed by existing instances
+        BloomFilter.create(self.path, ['c'], capacity=10)
+        self.assertNotIn('a', first)
+        self.assertIn('c', second)
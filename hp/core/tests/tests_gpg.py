@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import doctest
+import os
+import tempfile
+from contextlib import contextmanager
+from unittest import mock
+
+from django.test import override_settings
+
+from .. import gpg
+from .. import utils
+from ..gpg import KeyringPool
+from ..gpg import TimedGpgEmailMessage
+from .base import TestCase
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(gpg))
+    return tests
+
+
+class FakeBackend(object):
+    """Minimal backend that stores imported keys in a file in its home directory."""
+
+    def __init__(self, home=None):
+        self.home = home
+
+    @contextmanager
+    def settings(self, home=None, **kwargs):
+        yield FakeBackend(home=home)
+
+    def import_key(self, key):
+        with open(os.path.join(self.home, 'keys'), 'a') as stream:
+            stream.write('%s\n' % key)
+
+    def list_keys(self):
+        with open(os.path.join(self.home, 'keys')) as stream:
+            return stream.read().split()
+
+
+class KeyringPoolTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pool = KeyringPool(self.tmpdir.name, size=2)
+        self.backend = FakeBackend()
+        self.inits = []
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def init(self, *keys):
+        def func(backend):
+            self.inits.append(keys)
+            for key in keys:
+                backend.import_key(key)
+        return func
+
+    def use(self, *keys):
+        with self.pool.keyring(self.backend, keys, self.init(*keys)) as backend:
+            return backend.list_keys()
+
+    def test_reuse(self):
+        self.assertEqual(self.use('a', 'b'), ['a', 'b'])
+        self.assertEqual(self.use('a', 'b'), ['a', 'b'])
+        self.assertEqual(self.use('a'), ['a'])
+        self.assertEqual(self.inits, [('a', 'b'), ('a', )])
+
+    def test_failed_init(self):
+        def fail(backend):
+            backend.import_key('a')
+            raise ValueError('import failed')
+
+        with self.assertRaises(ValueError):
+            with self.pool.keyring(self.backend, ['a'], fail):
+                pass
+        self.assertEqual(self.pool.keyrings(), [])
+
+        # Next use initializes the keyring properly
+        self.assertEqual(self.use('a'), ['a'])
+        self.assertEqual(self.inits, [('a', )])
+
+    def test_evict(self):
+        self.use('a')
+        self.use('b')
+        os.utime(os.path.join(self.tmpdir.name, self.pool.get_name(['a'])), (0, 0))
+        self.use('c')
+
+        names = sorted(n for m, n in self.pool.keyrings())
+        self.assertEqual(names, sorted([self.pool.get_name(['b']), self.pool.get_name(['c'])]))
+
+        # Keyrings that are currently in use are not evicted
+        with self.pool.keyring(self.backend, ['b'], self.init('b')):
+            os.utime(os.path.join(self.tmpdir.name, self.pool.get_name(['b'])), (0, 0))
+            self.use('d')
+        self.assertEqual(len(self.pool.keyrings()), 3)
+
+    def test_locked(self):
+        name = self.pool.get_name(['a'])
+        self.use('a')
+        with self.pool.lock(name) as locked:
+            self.assertTrue(locked)
+
+            # flock() locks are per open file, so a second lock fails even in the same process
+            with self.pool.lock(name, blocking=False) as locked:
+                self.assertFalse(locked)
+
+
+class TimedGpgEmailMessageTestCase(TestCase):
+    @mock.patch('gpgliblib.django.GpgEmailMessage.sign_message', side_effect=lambda m, **kw: m)
+    @mock.patch('gpgliblib.django.GpgEmailMessage.encrypt_message', side_effect=lambda m: m)
+    def test_stats(self, encrypt, sign):
+        gpg.stats.reset()
+        TimedGpgEmailMessage('subject', 'text', 'from@example.com', ['to@example.com'],
+                             gpg_recipients=['A' * 40], gpg_signer='B' * 40).message()
+        TimedGpgEmailMessage('subject', 'text', 'from@example.com', ['to@example.com'],
+                             gpg_signer='B' * 40).message()
+        gpg.stats.flush()
+
+        histograms = gpg.stats.load()
+        self.assertEqual(histograms['sign_encrypt'].count, 1)
+        self.assertEqual(histograms['sign'].count, 1)
+
+    @mock.patch('gpgliblib.django.GpgEmailMessage.sign_message', side_effect=lambda m, **kw: m)
+    @mock.patch('gpgliblib.django.GpgEmailMessage.encrypt_message', side_effect=lambda m: m)
+    def test_prepare(self, encrypt, sign):
+        msg = TimedGpgEmailMessage('subject', 'text', 'from@example.com', ['to@example.com'],
+                                   gpg_recipients=['A' * 40], gpg_signer='B' * 40)
+        msg.prepare()
+        self.assertIs(msg.message(), msg.message())
+        encrypt.assert_called_once()
+
+
+class KeyFileCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        utils._key_file_cache.clear()
+
+        self.fp = 'A' * 40
+        self.write('%s.key' % self.fp, b'private')
+        self.write('%s.pub' % self.fp, b'public')
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+        utils._key_file_cache.clear()
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def load(self):
+        hosts = {'example.com': {'GPG_FINGERPRINT': self.fp, 'CONTACT_GPG_FINGERPRINTS': [self.fp]}}
+        with override_settings(GPG_KEYDIR=self.tmpdir.name, XMPP_HOSTS=hosts):
+            return utils.load_private_key('example.com'), utils.load_contact_keys('example.com')
+
+    def test_cache(self):
+        self.assertEqual(self.load(), ((self.fp, b'private', b'public'), {self.fp: b'public'}))
+
+        # Files are not checked again within the recheck interval
+        self.write('%s.key' % self.fp, b'changed', mtime=0)
+        self.assertEqual(self.load()[0], (self.fp, b'private', b'public'))
+
+        # After the interval, changed files are read again
+        with mock.patch('core.utils.KEY_FILE_RECHECK', 0):
+            self.assertEqual(self.load()[0], (self.fp, b'changed', b'public'))
+
+    def test_unchanged(self):
+        self.load()
+        with mock.patch('core.utils.KEY_FILE_RECHECK', 0), mock.patch('builtins.open') as mocked:
+            self.assertEqual(self.load()[0], (self.fp, b'private', b'public'))
+        mocked.assert_not_called()
+
+    def test_preload(self):
+        hosts = {'example.com': {'GPG_FINGERPRINT': self.fp}, 'example.net': {'GPG_FINGERPRINT': 'B' * 40}}
+        with override_settings(GPG_KEYDIR=self.tmpdir.name, XMPP_HOSTS=hosts), \
+                self.assertLogs('core.utils', 'ERROR'):
+            utils.preload_keys()
+
+        self.assertEqual(sorted(utils._key_file_cache), [
+            os.path.join(self.tmpdir.name, '%s.key' % self.fp),
+            os.path.join(self.tmpdir.name, '%s.pub' % self.fp),
+        ])
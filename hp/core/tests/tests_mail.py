@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import smtplib
+import socket
+from unittest import mock
+
+from aiosmtpd.controller import Controller
+
+from django.core.mail import EmailMessage
+from django.core.mail import get_connection
+
+from ..mail import Mailer
+from .base import TestCase
+
+
+class Handler(object):
+    """aiosmtpd handler that records received emails and can simulate errors."""
+
+    def __init__(self):
+        self.sessions = set()
+        self.received = []
+        self.responses = []  # responses to return instead of accepting an email
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        if self.responses:
+            return self.responses.pop(0)
+
+        self.received.append(envelope.rcpt_tos)
+        return '250 OK'
+
+
+class MailerTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # find a free port
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        self.handler = Handler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        self.connection = get_connection('django.core.mail.backends.smtp.EmailBackend',
+                                         host='127.0.0.1', port=port)
+
+    def tearDown(self):
+        self.controller.stop()
+        super().tearDown()
+
+    def message(self, to='user@example.com'):
+        return EmailMessage('subject', 'body', 'from@example.com', [to])
+
+    def test_batch(self):
+        with Mailer(connection=self.connection) as mailer:
+            for i in range(10):
+                mailer.send(self.message())
+
+        self.assertEqual(mailer.sent, 10)
+        self.assertEqual(len(self.handler.received), 10)
+        self.assertEqual(len(self.handler.sessions), 1)
+
+    def test_no_batch(self):
+        mailer = Mailer(connection=self.connection)
+        for i in range(3):
+            mailer.send(self.message())
+
+        self.assertEqual(len(self.handler.received), 3)
+        self.assertEqual(len(self.handler.sessions), 3)
+
+    @mock.patch('core.mail.time.sleep')
+    def test_retry(self, sleep):
+        self.handler.responses = ['451 Try again later', '451 Try again later']
+
+        with self.assertLogs('core.mail', 'WARNING'), \
+                Mailer(connection=self.connection, retries=2, backoff=1) as mailer:
+            mailer.send(self.message())
+        self.assertEqual(self.handler.received, [['user@example.com']])
+        self.assertEqual(sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+        # Fail if there are too many temporary errors
+        self.handler.responses = ['451 Try again later'] * 3
+        with self.assertRaises(smtplib.SMTPDataError), self.assertLogs('core.mail', 'WARNING'), \
+                Mailer(connection=self.connection, retries=2) as mailer:
+            mailer.send(self.message())
+        self.assertEqual(len(self.handler.received), 1)
+
+    @mock.patch('core.mail.time.sleep')
+    def test_no_batch_retry(self, sleep):
+        self.handler.responses = ['451 Try again later']
+
+        # Single emails are not retried, so the calling thread never sleeps
+        with self.assertRaises(smtplib.SMTPDataError):
+            Mailer(connection=self.connection, retries=2).send(self.message())
+        sleep.assert_not_called()
+        self.assertEqual(self.handler.received, [])
+
+    @mock.patch('core.mail.time.sleep')
+    def test_connect_retry(self, sleep):
+        errors = [ConnectionRefusedError()]
+        open_connection = self.connection.open
+
+        def connect():
+            if errors:
+                raise errors.pop()
+            return open_connection()
+
+        with mock.patch.object(self.connection, 'open', side_effect=connect), \
+                self.assertLogs('core.mail', 'WARNING'), \
+                Mailer(connection=self.connection, retries=2, backoff=1) as mailer:
+            mailer.send(self.message())
+
+        self.assertEqual(self.handler.received, [['user@example.com']])
+        self.assertEqual(sleep.call_args_list, [mock.call(1)])
+
+    @mock.patch('core.mail.time.sleep')
+    def test_disconnect(self, sleep):
+        # The message might already have been accepted if the connection is lost while sending
+        disconnected = smtplib.SMTPServerDisconnected()
+        with mock.patch.object(self.connection, 'send_messages', side_effect=disconnected), \
+                self.assertRaises(smtplib.SMTPServerDisconnected), \
+                Mailer(connection=self.connection, retries=2) as mailer:
+            mailer.send(self.message())
+        sleep.assert_not_called()
+
+    @mock.patch('core.mail.time.sleep')
+    def test_permanent_error(self, sleep):
+        self.handler.responses = ['550 Go away']
+
+        with self.assertRaises(smtplib.SMTPDataError), Mailer(connection=self.connection) as mailer:
+            mailer.send(self.message())
+        sleep.assert_not_called()
+
+        # The connection can still be used afterwards
+        with Mailer(connection=self.connection) as mailer:
+            mailer.send(self.message())
+        self.assertEqual(len(self.handler.received), 1)
+
+    @mock.patch('core.mail.time.sleep')
+    def test_throttle(self, sleep):
+        with Mailer(connection=self.connection, throttle={'example.com': 10}) as mailer:
+            mailer.send(self.message())
+            mailer.send(self.message('user@example.net'))
+            sleep.assert_not_called()
+
+            mailer.send(self.message())
+            self.assertEqual(sleep.call_count, 1)
+            self.assertGreater(sleep.call_args[0][0], 9)
+
+        self.assertEqual(len(self.handler.received), 3)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import doctest
+
+from .. import stats
+from ..stats import LatencyStats
+from .base import TestCase
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(stats))
+    return tests
+
+
+class FooStats(LatencyStats):
+    cache_prefix = 'foo-stats'
+
+
+class BarStats(LatencyStats):
+    cache_prefix = 'bar-stats'
+
+
+class LatencyStatsTestCase(TestCase):
+    def test_prefix(self):
+        foo, bar = FooStats(), BarStats()
+        foo.reset()
+        bar.reset()
+
+        foo.observe('op', 0.003)
+        foo.observe('op', 0.04)
+        bar.observe('other', 2)
+        foo.flush()
+        bar.flush()
+
+        histograms = foo.load()
+        self.assertEqual(list(histograms), ['op'])
+        self.assertEqual(histograms['op'].count, 2)
+        self.assertEqual(histograms['op'].percentile(50), 5)
+        self.assertEqual(list(bar.load()), ['other'])
+
+        foo.reset()
+        self.assertEqual(foo.load(), {})
+        self.assertEqual(list(bar.load()), ['other'])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
+
+import os
+from io import StringIO
+
+from django.core.management import call_command
+
+from ..utils import absolutify_html
+from ..utils import absolutify_html_dom
+from .base import TestCase
+
+testdata_path = os.path.join(os.path.dirname(__file__), 'testdata', 'absolutify')
+BASE_URL = 'https://example.com'
+
+
+def get_corpus():
+    for name in sorted(os.listdir(os.path.join(testdata_path, 'input'))):
+        with open(os.path.join(testdata_path, 'input', name), encoding='utf-8') as stream:
+            yield name, stream.read()
+
+
+class AbsolutifyHtmlTestCase(TestCase):
+    def test_golden(self):
+        # To update expected output after an intended change, write the output of absolutify_html() for
+        # every file in "input" to "expected" and review the diff.
+        for name, html in get_corpus():
+            with self.subTest(name=name):
+                with open(os.path.join(testdata_path, 'expected', name), encoding='utf-8') as stream:
+                    self.assertEqual(absolutify_html(html, BASE_URL), stream.read())
+
+    def test_equivalent(self):
+        # The output is normalized by html5lib, so output parsed by html5lib has to be identical
+        for name, html in get_corpus():
+            with self.subTest(name=name):
+                self.assertEqual(absolutify_html_dom(absolutify_html(html, BASE_URL), BASE_URL),
+                                 absolutify_html_dom(html, BASE_URL))
+
+    def test_unchanged(self):
+        html = '<p>Text with <strong>no links</strong> &amp copy</p>'
+        self.assertIs(absolutify_html(html, BASE_URL), html)
+
+        # Only targeted attributes are changed
+        self.assertEqual(absolutify_html('<a name="top" data-href="/foo">top</a>', BASE_URL),
+                         '<a name="top" data-href="/foo">top</a>')
+        self.assertEqual(absolutify_html('<area href="/foo"><abbr title="/foo">x</abbr>', BASE_URL),
+                         '<area href="/foo"><abbr title="/foo">x</abbr>')
+
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command('benchmark_absolutify', count=2, stdout=stdout)
+        self.assertIn('html5lib', stdout.getvalue())
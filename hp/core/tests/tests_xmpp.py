@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import doctest
+
+from xmpp_backends.base import BackendConnectionError
+from xmpp_backends.base import UserNotFound
+from xmpp_backends.base import XmppBackendBase
+
+from .. import xmpp
+from ..exceptions import BackendUnavailable
+from ..xmpp import InstrumentedBackend
+from .base import TestCase
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(xmpp))
+    return tests
+
+
+class FlakyBackend(XmppBackendBase):
+    """Backend that raises connection errors while ``fail`` is ``True``."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = False
+        self.calls = 0
+
+    def check_password(self, username, domain, password):
+        self.calls += 1
+        if self.fail:
+            raise BackendConnectionError('connection refused')
+        return True
+
+    def get_last_activity(self, username, domain):
+        self.calls += 1
+        raise UserNotFound(username, domain)
+
+
+class InstrumentedBackendTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        xmpp._breakers.clear()
+        self.backend = InstrumentedBackend('core.tests.tests_xmpp.FlakyBackend', failure_threshold=2,
+                                           reset_timeout=3600)
+
+    def test_circuit_breaker(self):
+        self.assertTrue(self.backend.check_password('user', 'example.com', 'pwd'))
+
+        self.backend.backend.fail = True
+        for i in range(2):
+            with self.assertRaises(BackendConnectionError):
+                self.backend.check_password('user', 'example.com', 'pwd')
+        self.assertTrue(self.backend.breaker.is_open)
+        self.assertEqual(self.backend.backend.calls, 3)
+
+        # The backend is no longer called, the exception is still a backend error
+        with self.assertRaises(BackendUnavailable):
+            self.backend.check_password('user', 'example.com', 'pwd')
+        self.assertEqual(self.backend.backend.calls, 3)
+
+        # After the timeout, one call is let through and closes the circuit again
+        self.backend.backend.fail = False
+        self.backend.breaker.reset_timeout = 0
+        self.assertTrue(self.backend.check_password('user', 'example.com', 'pwd'))
+        self.assertFalse(self.backend.breaker.is_open)
+
+    def test_logical_errors(self):
+        # Errors other than connection errors do not open the circuit
+        for i in range(3):
+            with self.assertRaises(UserNotFound):
+                self.backend.get_last_activity('user', 'example.com')
+        self.assertFalse(self.backend.breaker.is_open)
+
+    def test_stats(self):
+        xmpp.stats.reset()
+        self.backend.check_password('user', 'example.com', 'pwd')
+        self.backend.check_password('user', 'example.com', 'pwd')
+        xmpp.stats.flush()
+
+        histograms = xmpp.stats.load()
+        self.assertEqual(histograms['check_password'].count, 2)
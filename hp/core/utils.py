@@ -17,7 +17,10 @@ import logging
 import os
 import re
 import textwrap
+import time
 from contextlib import contextmanager
+from html import escape
+from html import unescape
 from urllib.parse import urljoin
 
 import dns.resolver
@@ -71,16 +74,40 @@ def format_timedelta(delta):
         return _('Now')
 
 
+#: Cache for key files, maps paths to a tuple of (last check, mtime, content)
+_key_file_cache = {}
+
+#: How often (in seconds) key files in the cache are checked for modifications.
+KEY_FILE_RECHECK = 60
+
+
+def read_key_file(path):
+    """Read a key file, using an in-process cache.
+
+    Once read, a file is not read again unless its modification time changes. The modification time is
+    checked at most every :py:data:`KEY_FILE_RECHECK` seconds.
+    """
+    now = time.monotonic()
+    cached = _key_file_cache.get(path)
+    if cached is not None and now - cached[0] < KEY_FILE_RECHECK:
+        return cached[2]
+
+    mtime = os.stat(path).st_mtime
+    if cached is not None and cached[1] == mtime:
+        _key_file_cache[path] = (now, mtime, cached[2])
+        return cached[2]
+
+    with open(path, 'rb') as stream:
+        key = stream.read()
+    _key_file_cache[path] = (now, mtime, key)
+    return key
+
+
 def load_private_key(hostname):
     fp = settings.XMPP_HOSTS[hostname].get('GPG_FINGERPRINT')
     if fp:
-        path = os.path.join(settings.GPG_KEYDIR, '%s.key' % fp)
-        with open(path, 'rb') as stream:
-            key = stream.read()
-
-        path = os.path.join(settings.GPG_KEYDIR, '%s.pub' % fp)
-        with open(path, 'rb') as stream:
-            pub = stream.read()
+        key = read_key_file(os.path.join(settings.GPG_KEYDIR, '%s.key' % fp))
+        pub = read_key_file(os.path.join(settings.GPG_KEYDIR, '%s.pub' % fp))
         return fp, key, pub
     return None, None, None
 
@@ -90,13 +117,22 @@ def load_contact_keys(hostname):
     fingerprints = settings.XMPP_HOSTS[hostname].get('CONTACT_GPG_FINGERPRINTS', [])
 
     for fp in fingerprints:
-        path = os.path.join(settings.GPG_KEYDIR, '%s.pub' % fp)
-        with open(path, 'rb') as stream:
-            keys[fp] = stream.read()
+        keys[fp] = read_key_file(os.path.join(settings.GPG_KEYDIR, '%s.pub' % fp))
 
     return keys
 
 
+def preload_keys():
+    """Load the keys of all hosts configured in ``XMPP_HOSTS`` into the in-process cache."""
+
+    for hostname in settings.XMPP_HOSTS:
+        try:
+            load_private_key(hostname)
+            load_contact_keys(hostname)
+        except OSError as e:
+            log.error('%s: Could not load GPG keys: %s', hostname, e)
+
+
 def check_dnsbl(ip):
     """Check the given IP for DNSBL listings.
 
@@ -152,10 +188,59 @@ def canonical_link(path, host=None):
     return urljoin(base_url, path)
 
 
+ABSOLUTIFY_ATTRIBUTES = {
+    'a': 'href',
+    'img': 'src',
+    'link': 'href',
+    'script': 'src',
+}
+"""Elements and their attributes that are made absolute by :py:func:`~core.utils.absolutify_html`."""
+
+_TAG_ATTRS = r"""(?:[^\s/>=]+(?=[\s/>=])(?:\s*=\s*(?:"[^"]*"|'[^']*'|(?!["'])[^\s>]*(?=[\s>])))?|[\s/])*"""
+_ABSOLUTIFY_TOKEN_RE = re.compile(r"""
+    <!--.*?(?:--!?>|\Z)  # comments
+    # Elements with raw text (the content is not parsed as HTML)
+  | (?P<raw_start><(?P<raw>script|style|textarea|title|xmp|iframe|noembed|noframes)(?=[\s/>]){attrs}>)
+    .*?(?:</(?P=raw)\s*>|\Z)
+  | <(?P<tag>a|img|link)(?=[\s/>]){attrs}>
+  | <[a-z][^\s/>]*{attrs}>  # any other tag, so that attribute values are not parsed as HTML
+""".format(attrs=_TAG_ATTRS), re.DOTALL | re.IGNORECASE | re.VERBOSE)
+_ABSOLUTIFY_ATTR_RE = re.compile(r"""([^\s/>=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?""")
+_ABSOLUTIFY_TAG_RE = re.compile(r'<(?:%s)[\s/>]' % '|'.join(ABSOLUTIFY_ATTRIBUTES), re.IGNORECASE)
+
+
+def _absolutify_tag(start_tag, tag, base_url):
+    attr = ABSOLUTIFY_ATTRIBUTES.get(tag.lower())
+    if attr is None:
+        return start_tag
+
+    # Only the first attribute with a given name is used
+    offset = len(tag) + 1
+    for match in _ABSOLUTIFY_ATTR_RE.finditer(start_tag, offset, len(start_tag) - 1):
+        if match.group(1).lower() != attr:
+            continue
+
+        value = match.group(2) or ''
+        if value[:1] in ('"', "'"):
+            value = value[1:-1]
+        value = unescape(value)
+        if not value:
+            return start_tag
+
+        # Change relative URLs even if they consist only of a fragment identifier, because Google Reader
+        # changes href=#foo to href=http://site/#foo
+        replacement = '%s="%s"' % (match.group(1), escape(urljoin(base_url, value)))
+        return start_tag[:match.start()] + replacement + start_tag[match.end():]
+    return start_tag
+
+
 def absolutify_html(html, base_url):
     """Make relative links in the given html absolute.
 
-    This code is copied from `here <http://garethrees.org/2009/10/09/feed/>`_.
+    The HTML is processed by a streaming tokenizer that only recognizes comments, tags and the content of
+    elements like ``<script>`` (which is not parsed as HTML). Only start tags of the elements listed in
+    :py:data:`~core.utils.ABSOLUTIFY_ATTRIBUTES` are modified, everything else is returned as it is, so the
+    output is equivalent to the output of :py:func:`~core.utils.absolutify_html_dom`.
 
     Examle::
 
@@ -163,25 +248,39 @@ def absolutify_html(html, base_url):
         '<a href="https://example.com/foobar">test</a>'
         >>> absolutify_html('<a href="https://example.net/foobar">test</a>', 'https://example.com')
         '<a href="https://example.net/foobar">test</a>'
+        >>> absolutify_html('<p>Foo &amp; <img src=bar.png alt="Bar" /></p>', 'https://example.com/')
+        '<p>Foo &amp; <img src="https://example.com/bar.png" alt="Bar" /></p>'
     """
 
-    attributes = [
-        ('a', 'href'),
-        ('img', 'src'),
-        ('link', 'href'),
-        ('script', 'src')
-    ]
+    # Most summaries do not contain any links at all
+    if not _ABSOLUTIFY_TAG_RE.search(html):
+        return html
+
+    def replace(match):
+        if match.group('tag'):
+            return _absolutify_tag(match.group(0), match.group('tag'), base_url)
+        elif match.group('raw'):
+            start_tag = match.group('raw_start')
+            return _absolutify_tag(start_tag, match.group('raw'), base_url) + match.group(0)[len(start_tag):]
+        return match.group(0)
+
+    return _ABSOLUTIFY_TOKEN_RE.sub(replace, html)
 
+
+def absolutify_html_dom(html, base_url):
+    """Reference implementation of :py:func:`~core.utils.absolutify_html` using a html5lib DOM tree.
+
+    This is much slower, but the output is normalized HTML. It is only used to verify that both functions
+    are equivalent in tests and ``manage.py benchmark_absolutify``. The code is copied from
+    `here <http://garethrees.org/2009/10/09/feed/>`_.
+    """
     # Parse SRC as HTML.
     tree_builder = html5lib.treebuilders.getTreeBuilder('dom')
     parser = html5lib.html5parser.HTMLParser(tree=tree_builder)
     dom = parser.parse(html)
 
-    # Change all relative URLs to absolute URLs by resolving them relative to
-    # BASE_URL. Note that we need to do this even for URLs that consist only of
-    # a fragment identifier, because Google Reader changes href=#foo to
-    # href=http://site/#foo
-    for tag, attr in attributes:
+    # Change all relative URLs to absolute URLs by resolving them relative to BASE_URL.
+    for tag, attr in ABSOLUTIFY_ATTRIBUTES.items():
         for e in dom.getElementsByTagName(tag):
             u = e.getAttribute(attr)
             if u:
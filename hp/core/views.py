@@ -18,7 +18,6 @@ import logging
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Q
 from django.http import Http404
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
@@ -97,6 +96,8 @@ class TranslateSlugViewMixin(object):
 
        * There is a ``slug`` kwarg in the URL config
        * The model has a translated slug field (like core.BlogPost and core.Page)
+       * The queryset has a ``slug()`` method that filters for a slug in any language (like
+         :py:class:`~blog.querysets.BasePageQuerySet`).
        * The model has a ``get_absolute_url()`` method.
 
     Background: By default, get_object() would filter for the slug field, the translated
@@ -131,11 +132,7 @@ class TranslateSlugViewMixin(object):
         slug = self.kwargs.get(self.slug_url_kwarg)
 
         # filter for slugs in all languages
-        filter = Q()
-        for lang, _name in settings.LANGUAGES:
-            filter |= Q(**{'slug_%s' % lang: slug})
-
-        queryset = queryset.filter(filter)
+        queryset = queryset.slug(slug)
 
         try:
             # Get the single item from the filtered queryset
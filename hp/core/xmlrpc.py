@@ -27,3 +27,28 @@ class FastFailTransport(client.Transport):
         # override the timeout
         conn.timeout = 10
         return conn
+
+
+class KeepAliveTransport(client.Transport):
+    """Transport that keeps its HTTP/1.1 connection open between requests.
+
+    The stock transport already reuses the last connection, but it only sets a socket timeout if
+    you subclass it (see :py:class:`FastFailTransport`). This transport takes the timeout as
+    parameter and sets it on the socket of every new connection.
+
+    Note that transports are not thread-safe, every thread must use its own instance.
+    """
+
+    def __init__(self, *args, timeout=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+
+class KeepAliveSafeTransport(KeepAliveTransport, client.SafeTransport):
+    """HTTPS variant of the :py:class:`KeepAliveTransport`."""
+    pass
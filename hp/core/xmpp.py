@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Client layer around the XMPP backend.
+
+The classes in this module are configured in the ``XMPP_BACKENDS`` setting, so every call to
+``xmpp_backends.django.xmpp_backend`` (including the authentication backend) goes through them::
+
+    XMPP_BACKENDS = {
+        'default': {
+            'BACKEND': 'core.xmpp.InstrumentedBackend',
+            'backend': 'xmpp_backends.ejabberd_xmlrpc.EjabberdXMLRPCBackend',
+            # ... any parameters for the wrapped backend
+            'uri': 'https://...',
+        },
+    }
+"""
+
+import logging
+import random
+import threading
+import time
+from functools import wraps
+from importlib import import_module
+
+import requests
+
+from xmpp_backends.base import BackendConnectionError
+from xmpp_backends.base import BackendError
+from xmpp_backends.dummy import DummyBackend
+from xmpp_backends.ejabberd_rest import EjabberdRestBackend
+from xmpp_backends.ejabberd_xmlrpc import EjabberdXMLRPCBackend
+
+from .exceptions import BackendUnavailable
+from .stats import LatencyStats
+from .xmlrpc import KeepAliveSafeTransport
+from .xmlrpc import KeepAliveTransport
+
+log = logging.getLogger(__name__)
+
+
+class BackendStats(LatencyStats):
+    """Per-process latency histograms for every backend method.
+
+    Statistics can be viewed with the ``xmpp_backend_stats`` management command.
+    """
+
+    cache_prefix = 'xmpp-backend-stats'
+
+
+stats = BackendStats()
+
+
+class CircuitBreaker(object):
+    """Fail fast if the backend is unreachable.
+
+    After ``threshold`` consecutive connection errors, the circuit "opens" and every call raises
+    :py:class:`~core.exceptions.BackendUnavailable` without contacting the backend. After
+    ``reset_timeout`` seconds, a single call is let through again: If it succeeds, the circuit is
+    closed again, otherwise it stays open for another ``reset_timeout`` seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def before_call(self):
+        with self.lock:
+            if self.opened is None:
+                return
+
+            if time.monotonic() - self.opened < self.reset_timeout:
+                raise BackendUnavailable('XMPP backend failed %s times, failing fast.' % self.failures)
+
+            # Let this call through, but keep failing any other calls until we know the result.
+            self.opened = time.monotonic()
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                log.info('XMPP backend is reachable again.')
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    log.error('XMPP backend failed %s times, failing fast for %s seconds.',
+                              self.failures, self.reset_timeout)
+                self.opened = time.monotonic()
+
+
+# Circuit breakers are shared by all threads of a process
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(key, threshold, reset_timeout):
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(threshold=threshold, reset_timeout=reset_timeout)
+        return _breakers[key]
+
+
+class PooledEjabberdRestBackend(EjabberdRestBackend):
+    """Variant of the REST backend that keeps its connections open.
+
+    The upstream implementation uses :py:func:`requests.post`, which opens a new connection (and
+    does a new TLS handshake) for every call. This class uses a persistent
+    :py:class:`requests.Session` instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+
+    def post(self, cmd, allowed_status=None, **payload):
+        if allowed_status is None:
+            allowed_status = [200]
+
+        uri = '%s%s' % (self.uri, cmd)
+        try:
+            response = self.session.post(uri, json=payload, headers=self.headers, **self.kwargs)
+        except requests.exceptions.RequestException as e:
+            raise BackendConnectionError(e)
+
+        if response.status_code not in allowed_status:
+            raise BackendError('HTTP %s: %s' % (response.status_code, response.content))
+        return response
+
+
+class InstrumentedBackend(object):
+    """XMPP backend that wraps the backend that actually talks to the XMPP server.
+
+    The ``xmpp_backends`` library creates one backend instance per thread, so every worker thread
+    gets its own persistent connection (a keep-alive transport for XMLRPC, a
+    :py:class:`requests.Session` for the REST API). Every call is timed (see
+    :py:class:`BackendStats`) and guarded by a per-process :py:class:`CircuitBreaker`.
+
+    Parameters
+    ----------
+
+    backend : str
+        Import path of the wrapped backend class.
+    timeout : int, optional
+        Socket timeout in seconds for XMLRPC and REST backends.
+    failure_threshold : int, optional
+        Number of consecutive connection errors until the circuit breaker opens.
+    reset_timeout : int, optional
+        Seconds until the circuit breaker tries to contact the backend again.
+    **kwargs
+        Passed to the constructor of the wrapped backend.
+    """
+
+    def __init__(self, backend, timeout=10, failure_threshold=5, reset_timeout=30, **kwargs):
+        mod_path, cls_name = backend.rsplit('.', 1)
+        backend_cls = getattr(import_module(mod_path), cls_name)
+
+        if issubclass(backend_cls, EjabberdXMLRPCBackend) and kwargs.get('transport') is None:
+            if kwargs.get('uri', '').startswith('https://'):
+                kwargs['transport'] = KeepAliveSafeTransport(timeout=timeout)
+            else:
+                kwargs['transport'] = KeepAliveTransport(timeout=timeout)
+        elif issubclass(backend_cls, EjabberdRestBackend):
+            if backend_cls is EjabberdRestBackend:
+                backend_cls = PooledEjabberdRestBackend
+            kwargs.setdefault('timeout', timeout)
+
+        self.backend = backend_cls(**kwargs)
+        self.breaker = get_breaker((backend, kwargs.get('uri')), failure_threshold, reset_timeout)
+
+    def _instrument(self, name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.breaker.before_call()
+            start = time.perf_counter()
+
+            try:
+                result = func(*args, **kwargs)
+            except (BackendConnectionError, OSError):
+                self.breaker.failure()
+                raise
+            except Exception:
+                # Any other exception (e.g. UserNotFound) means that the backend is reachable.
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+            finally:
+                stats.observe(name, time.perf_counter() - start)
+
+            return result
+        return wrapper
+
+    def __getattr__(self, name):
+        value = getattr(self.backend, name)
+        if name.startswith('_') or not callable(value):
+            return value
+
+        wrapped = self._instrument(name, value)
+        self.__dict__[name] = wrapped  # only wrap once
+        return wrapped
+
+
+class LoadTestBackend(DummyBackend):
+    """A stand-in backend for load tests.
+
+    This is the :py:class:`~xmpp_backends.dummy.DummyBackend` (which stores users in Django's
+    cache) with configurable latency and connection errors, so load tests can simulate a slow or
+    unreliable XMPP server without running one::
+
+        XMPP_BACKENDS = {
+            'default': {
+                'BACKEND': 'core.xmpp.InstrumentedBackend',
+                'backend': 'core.xmpp.LoadTestBackend',
+                'domains': ['example.com'],
+                'latency': 0.2,
+                'jitter': 0.05,
+                'failure_rate': 0.01,
+            },
+        }
+
+    Parameters
+    ----------
+
+    domains : list of str
+        Domains served by this backend.
+    latency : float, optional
+        Seconds every call takes.
+    jitter : float, optional
+        The latency varies randomly by up to this many seconds.
+    failure_rate : float, optional
+        Share of calls (between 0 and 1) that raise a
+        :py:class:`~xmpp_backends.base.BackendConnectionError`.
+    """
+
+    def __init__(self, domains, latency=0.05, jitter=0.0, failure_rate=0.0):
+        super().__init__(domains)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def simulate(self):
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise BackendConnectionError('Simulated connection error.')
+
+    def user_exists(self, username, domain):
+        self.simulate()
+        return super().user_exists(username, domain)
+
+    def user_sessions(self, username, domain):
+        self.simulate()
+        return super().user_sessions(username, domain)
+
+    def stop_user_session(self, username, domain, resource, reason=''):
+        self.simulate()
+        return super().stop_user_session(username, domain, resource, reason=reason)
+
+    def create_user(self, username, domain, password, email=None):
+        self.simulate()
+        return super().create_user(username, domain, password, email=email)
+
+    def check_password(self, username, domain, password):
+        self.simulate()
+        return super().check_password(username, domain, password)
+
+    def set_password(self, username, domain, password):
+        self.simulate()
+        return super().set_password(username, domain, password)
+
+    def get_last_activity(self, username, domain):
+        self.simulate()
+        return super().get_last_activity(username, domain)
+
+    def set_last_activity(self, username, domain, status='', timestamp=None):
+        self.simulate()
+        return super().set_last_activity(username, domain, status=status, timestamp=timestamp)
+
+    def all_users(self, domain):
+        self.simulate()
+        return super().all_users(domain)
+
+    def remove_user(self, username, domain):
+        self.simulate()
+        return super().remove_user(username, domain)
@@ -1,3 +1,178 @@
-from django.test import TestCase  # NOQA
+# -*- coding: utf-8 -*-
+#
+# This file is part of the jabber.at homepage (https://github.com/jabber-at/hp).
+#
+# This project is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This project is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this project. If
+# not, see <http://www.gnu.org/licenses/>.
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock
+
+from lxml import etree
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from blog.models import BlogPost
+from blog.models import Page
+from core.tests.base import TestCase
+
+from .views import FeedMixin
+
+User = get_user_model()
+
+
+class FeedTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.author = User.objects.create(username='user@example.com', email='user@example.com')
+        self.posts = [BlogPost.objects.create(
+            author=self.author, title_en='Post %s' % i, title_de='Eintrag %s' % i, slug_en='post-%s' % i,
+            slug_de='eintrag-%s' % i,
+            text_en='<p>Text <a href="/p/foo/">%s</a>.</p>' % i, text_de='<p>Text %s.</p>' % i,
+            publication_date=timezone.now() - timedelta(days=1)) for i in range(3)]
+        self.client = Client()
+
+    def get(self, name, language='en', data=None, **headers):
+        return self.client.get(reverse('feed:%s' % name, kwargs={'language': language}), data, **headers)
+
+    def render_field(self):
+        return mock.patch.object(FeedMixin, 'render_field', side_effect=FeedMixin.render_field, autospec=True)
+
+    def test_atom(self):
+        response = self.get('atom')
+        self.assertEqual(response.status_code, 200)
+        root = etree.fromstring(response.content)
+        ns = {'atom': FeedMixin.atom_ns}
+        self.assertEqual(root.xpath('atom:entry/atom:title/text()', namespaces=ns),
+                         ['Post 2', 'Post 1', 'Post 0'])
+        content = root.xpath('atom:entry/atom:content/text()', namespaces=ns)[0]
+        self.assertIn('<a href="https://example.com/p/foo/">2</a>', content)
+
+    def test_rss(self):
+        response = self.get('rss2', 'de')
+        self.assertEqual(response.status_code, 200)
+        root = etree.fromstring(response.content)
+        self.assertEqual(root.xpath('channel/item/title/text()'), ['Eintrag 2', 'Eintrag 1', 'Eintrag 0'])
+
+    def test_conditional_get(self):
+        for name in ['atom', 'rss2']:
+            response = self.get(name)
+            etag = response['ETag']
+            self.assertTrue(etag.startswith('"'))
+            self.assertEqual(response['Last-Modified'], self.get(name)['Last-Modified'])
+
+            with self.render_field() as render_field:
+                response = self.get(name, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+                self.assertEqual(response['ETag'], etag)
+
+                response = self.get(name, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                self.assertEqual(response.status_code, 304)
+            render_field.assert_not_called()
+
+        # Feeds in different languages have different ETags
+        self.assertNotEqual(self.get('atom')['ETag'], self.get('atom', 'de')['ETag'])
+
+    def test_changes(self):
+        etag = self.get('atom')['ETag']
+
+        # Updated post
+        self.posts[0].text_en = '<p>New text.</p>'
+        self.posts[0].save()
+        response = self.get('atom', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'New text.', response.content)
+        etag = response['ETag']
+
+        # Unpublished post, even though no remaining post was updated
+        BlogPost.objects.filter(pk=self.posts[1].pk).update(published=False)
+        response = self.get('atom', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'Post 1', response.content)
+
+    def test_linked_page(self):
+        page = Page.objects.create(title_en='Old title', title_de='Alter Titel', slug_en='linked',
+                                   slug_de='verlinkt', text_en='<p>Text.</p>', text_de='<p>Text.</p>')
+        self.posts[1].text_en = '<p>See {% page "linked" %}.</p>'
+        self.posts[1].save()
+
+        response = self.get('atom')
+        self.assertIn(b'Old title', response.content)
+
+        page.title_en = 'New title'
+        page.save()
+        response = self.get('atom', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'New title', response.content)
+        self.assertNotIn(b'Old title', response.content)
+
+    def test_scheduled_post(self):
+        # A post scheduled for publication earlier is published after the last update of any other post
+        now = timezone.now()
+        BlogPost.objects.update(updated=now - timedelta(days=1))
+        last_modified = self.get('rss2')['Last-Modified']
+
+        post = BlogPost.objects.create(
+            author=self.author, title_en='Scheduled', title_de='Geplant', slug_en='scheduled',
+            slug_de='geplant', text_en='<p>Text.</p>', text_de='<p>Text.</p>',
+            publication_date=now + timedelta(days=1))
+        BlogPost.objects.filter(pk=post.pk).update(updated=now - timedelta(days=2),
+                                                   publication_date=now - timedelta(minutes=1))
+
+        response = self.get('rss2', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Scheduled', response.content)
+
+    def test_fragment_cache(self):
+        with self.render_field() as render_field:
+            self.get('atom')
+        self.assertEqual(render_field.call_count, 6)  # content and summary of three posts
+
+        # The RSS feed only uses summaries, which are already cached
+        with self.render_field() as render_field:
+            self.get('atom')
+            self.get('rss2')
+        render_field.assert_not_called()
+
+        # Only the updated post is rendered again
+        self.posts[0].text_en = '<p>New text.</p>'
+        self.posts[0].save()
+        with self.render_field() as render_field:
+            self.get('atom')
+        self.assertEqual(render_field.call_count, 2)
+        self.assertEqual({c[0][3] for c in render_field.call_args_list}, {self.posts[0]})
+
+    def test_neutral_request(self):
+        # Fragments are shared by all clients, so they are rendered without any client-specific data
+        self.client.force_login(self.author)
+        with self.render_field() as render_field:
+            self.get('atom', data={'os': 'android'}, HTTP_USER_AGENT='Mozilla/5.0 (Linux; Android 10)')
+
+        self.assertEqual(render_field.call_count, 6)
+        for call in render_field.call_args_list:
+            request, post = call[0][1], call[0][3]
+            self.assertTrue(request.user.is_anonymous)
+            self.assertEqual(request.path, post.get_absolute_url())
+            self.assertEqual(request.GET, {})
+            self.assertEqual(request.os, 'any')
+            self.assertEqual(request.get_host(), 'testserver')
+
+        # Fragments are cached without a timeout, as the key changes when a post is updated
+        with mock.patch('feed.views.cache.set_many') as set_many:
+            cache.clear()
+            self.get('rss2')
+        self.assertIsNone(set_many.call_args[0][1])
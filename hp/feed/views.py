@@ -13,28 +13,34 @@
 # You should have received a copy of the GNU General Public License along with this project. If
 # not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+
 from lxml import etree
 from strict_rfc3339 import timestamp_to_rfc3339_utcoffset
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import timezone
 from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.cache import quote_etag
 from django.utils.http import http_date
 from django.utils.translation import gettext as _
 from django.views.generic.base import View
 from django.views.generic.list import MultipleObjectMixin
 
 from blog.models import BlogPost
+from blog.utils import get_fallback_request
 from core.utils import absolutify_html
 
 
 class FeedMixin(MultipleObjectMixin):
-    queryset = BlogPost.objects.published().blog_order()
     content_type = 'application/xml'
     atom_ns = 'http://www.w3.org/2005/Atom'
+    max_items = 15
 
     def sub(self, root, tag, text=None, **attrs):
         e = etree.SubElement(root, tag, **attrs)
@@ -42,18 +48,102 @@ class FeedMixin(MultipleObjectMixin):
             e.text = text
         return e
 
+    def get_queryset(self):
+        # NOTE: Not a class attribute, as published() filters by the current time
+        return BlogPost.objects.published().blog_order()
+
     def get_content_type(self):
         return self.content_type
 
     def get_feed_title(self, request):
         return _('%s - Recent updates') % request.site['BRAND']
 
+    def get_etag(self, request, language, versions):
+        """Get the ETag of the feed.
+
+        The ETag changes whenever a post is added to, removed from or updated in the feed. Posts are also
+        marked as updated if a page or blog post they link to changes.
+        """
+        data = '%s|%s|%s|%s|%s' % (
+            type(self).__name__, language, request.build_absolute_uri(), request.site['BRAND'],
+            ','.join('%s:%s' % (pk, updated.timestamp()) for pk, updated, published in versions))
+        return quote_etag(hashlib.sha256(data.encode('utf-8')).hexdigest()[:32])
+
+    def get_fragment_key(self, request, language, field, post):
+        # The brand is hashed, as it may contain characters not allowed in cache keys
+        site = hashlib.md5(request.site['BRAND'].encode('utf-8')).hexdigest()[:8]
+        updated = int(post.updated.timestamp() * 1000000)
+        return 'feed_%s_%s_%s_%s_%s' % (field, site, language, post.pk, updated)
+
+    def render_field(self, request, field, post, base_url):
+        """Render the content or summary of a post.
+
+        Fragments are shared by all clients, so ``request`` should be a neutral request for the current
+        site as returned by :py:func:`~blog.utils.get_fallback_request`.
+        """
+        if field == 'content':
+            html = post.render_from_request(request)
+        else:
+            html = post.get_html_summary(request)
+        return absolutify_html(html, base_url)
+
+    def get_fragments(self, request, language, posts, fields, base_url):
+        """Get the rendered content and/or summary of the given posts with absolute links.
+
+        Rendering is slow, so fragments are cached for each post, field and language. The cache key
+        includes the time the post was last updated, so fragments are never outdated and are cached
+        without a timeout. Fragments are rendered with a request for an anonymous user on the current
+        site, so they do not depend on the user, operating system or query string of the current request.
+
+        Returns a dictionary mapping the primary key and field of every post to the rendered HTML.
+        """
+        keys = {(post.pk, field): self.get_fragment_key(request, language, field, post)
+                for post in posts for field in fields}
+        cached = cache.get_many(keys.values())
+        fragments = {}
+        missing = {}
+
+        for post in posts:
+            render_request = None
+            for field in fields:
+                key = keys[(post.pk, field)]
+                if key in cached:
+                    fragments[(post.pk, field)] = cached[key]
+                    continue
+
+                if render_request is None:
+                    render_request = get_fallback_request(post.get_absolute_url(), host=request.get_host())
+                fragments[(post.pk, field)] = missing[key] = self.render_field(
+                    render_request, field, post, base_url)
+
+        if missing:
+            cache.set_many(missing, None)
+        return fragments
+
     def get(self, request, language):
         ctype = self.get_content_type()
-
-        with translation.override(language):
-            items = self.serialize_items(request, language, self.get_queryset()[:15])
-            return HttpResponse(etree.tostring(items), ctype, charset='utf-8')
+        queryset = self.get_queryset()[:self.max_items]
+
+        # Check if the client already has the current version before rendering anything.
+        versions = list(queryset.values_list('pk', 'updated', 'publication_date'))
+        etag = self.get_etag(request, language, versions)
+        if versions:
+            # A scheduled post appears in the feed at its publication date, which may be after it was updated
+            last_modified = max(max(updated, published) for pk, updated, published in versions)
+            last_modified = int(last_modified.timestamp())
+        else:
+            last_modified = None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            with translation.override(language):
+                items = self.serialize_items(request, language, queryset)
+                response = HttpResponse(etree.tostring(items), ctype, charset='utf-8')
+
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
 
 
 class AtomFeed(FeedMixin, View):
@@ -89,10 +179,11 @@ class AtomFeed(FeedMixin, View):
         self.sub(root, 'logo', static('feed/atom.png'))
         self.sub(root, 'rights', '© 2010-%s, jabber.at' % updated.year)
 
+        fragments = self.get_fragments(request, language, queryset, ['content', 'summary'], base_url)
         for post in queryset:
             canonical_url = post.get_canonical_url()
-            content = absolutify_html(post.render_from_request(request), base_url)
-            summary = absolutify_html(post.get_html_summary(request), base_url)
+            content = fragments[(post.pk, 'content')]
+            summary = fragments[(post.pk, 'summary')]
 
             entry = self.sub(root, 'entry')
             self.sub(entry, 'id', canonical_url)
@@ -137,7 +228,13 @@ class RSS2Feed(FeedMixin, View):
         self.sub(channel, 'link', feed_url)
         self.sub(channel, 'description', _('Follow recent updates for %s') % request.site['BRAND'])
         self.sub(channel, 'language', language)
-        self.sub(channel, 'lastBuildDate', http_date())
+
+        # Use the last time a post was updated, so the feed does not change with every request
+        try:
+            updated = max([q.updated for q in queryset])
+        except ValueError:
+            updated = timezone.now()
+        self.sub(channel, 'lastBuildDate', http_date(updated.timestamp()))
 
         skipHours = self.sub(channel, 'skipHours')
         for i in range(0, 7):
@@ -155,9 +252,10 @@ class RSS2Feed(FeedMixin, View):
         self.sub(channel, '{%s}link' % self.atom_ns, rel='self', type='application/rss+xml',
                  href=href)
 
+        fragments = self.get_fragments(request, language, queryset, ['summary'], base_url)
         for post in queryset:
             canonical_url = post.get_canonical_url()
-            content = absolutify_html(post.get_html_summary(request), base_url)
+            content = fragments[(post.pk, 'summary')]
 
             item = self.sub(channel, 'item')
             self.sub(item, 'title', post.title.current)
@@ -0,0 +1,20 @@
+"""
+ASGI config for hp project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. Use any ASGI server to
+run it, e.g. ``uvicorn hp.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+
+from core.asgi import ThreadPoolASGIHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hp.settings")
+django.setup(set_prefix=False)
+
+application = ThreadPoolASGIHandler()
@@ -16,6 +16,7 @@
 import os
 
 from celery import Celery
+from celery.signals import worker_process_init
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hp.settings')
@@ -28,3 +29,11 @@ app = Celery('hp')
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_process_init.connect
+def preload_keys(**kwargs):
+    """Load GPG keys when a worker process starts, so sending encrypted emails does not read from disk."""
+
+    from core.utils import preload_keys
+    preload_keys()
@@ -111,6 +111,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'hp.wsgi.application'
 
+# Number of threads used to run views when running hp.asgi.application with an ASGI server.
+ASGI_THREADS = 20
+
 
 # Database
 # https://docs.djangoproject.com/en/1.9/ref/settings/#databases
@@ -367,12 +370,29 @@ MESSAGE_TAGS = {
 ACCOUNT_EXPIRES_DAYS = None
 ACCOUNT_EXPIRES_NOTIFICATION_DAYS = None
 
+# Expiration notices are sent in chunks of this many users, at most ACCOUNT_EXPIRES_NOTIFICATION_RATE
+# notices per minute.
+ACCOUNT_EXPIRES_NOTIFICATION_CHUNK_SIZE = 50
+ACCOUNT_EXPIRES_NOTIFICATION_RATE = 100
+
 ADMIN_URL = '/admin/'
 
+# Resized derivatives of images uploaded via admin are generated for these widths in the format of the
+# original image and in these additional formats.
+BLOG_IMAGE_FORMATS = ['webp']
+BLOG_IMAGE_WIDTHS = [480, 960, 1440]
+
 # Custom media root directory for Images uploaded via admin
 BLOG_MEDIA_ROOT = None
 BLOG_MEDIA_URL = None
 
+# Summaries of pages/blog posts with a text longer than this many characters are computed in a Celery
+# task instead of when saving the object.
+BLOG_SUMMARY_TASK_SIZE = 10000
+
+# Maximum number of compiled page/blog post templates cached in every process.
+BLOG_TEMPLATE_CACHE_SIZE = 500
+
 # pages
 CLIENTS_PAGE = None
 FAQ_PAGE = None
@@ -383,9 +403,31 @@ CONTACT_MUC = None
 DEFAULT_XMPP_HOST = None
 DEFAULT_FROM_EMAIL = None
 
+# Minimum time in seconds between two emails to the same domain when sending many emails at once, the
+# special key '*' applies to all domains not listed explicitly.
+EMAIL_THROTTLE = {}
+
+# How often sending an email is retried on temporary errors and how long to wait before the first retry
+# (doubled for every further retry).
+EMAIL_RETRIES = 3
+EMAIL_RETRY_BACKOFF = 1
+
 # How long confirmation emails remain valid
 USER_CONFIRMATION_TIMEOUT = timedelta(hours=48)
 
+# Updates of the last activity in the XMPP backend are delayed by this long, multiple updates for the same
+# user within this window result in a single call to the backend.
+LAST_ACTIVITY_UPDATE_WINDOW = timedelta(minutes=1)
+
+# The list of current sessions of a user is cached for this long. After that, the cached list is still
+# displayed for up to USER_SESSIONS_CACHE_STALE, but refreshed in the background.
+USER_SESSIONS_CACHE_TTL = timedelta(seconds=15)
+USER_SESSIONS_CACHE_STALE = timedelta(minutes=5)
+
+# Directory for Bloom filters of existing usernames, used to quickly check if a username is available
+# during registration. Set to None to always query the database.
+USERNAME_FILTER_DIR = os.path.join(ROOT_DIR, 'username-filters')
+
 LOG_FORMAT = '[%(asctime).19s %(levelname)-8s] %(message)s'  # .19s = only first 19 chars
 LIBRARY_LOG_LEVEL = 'WARN'
 LOG_LEVEL = 'INFO'
@@ -484,6 +526,25 @@ GPG_BACKENDS = {
 
 # Directory where public/private keys are stored for signing.
 GPG_KEYDIR = os.path.join(BASE_DIR, 'gpg-keys')
+
+# Directory where persistent keyrings are cached, None means that temporary keyrings are always used.
+GPG_KEYRING_CACHE_DIR = None
+
+# Maximum number of cached keyrings.
+GPG_KEYRING_CACHE_SIZE = 1000
+
+# Celery queue used for signing and encrypting emails, None means emails are encrypted inline.
+GPG_QUEUE = None
+
+# Keys are refreshed from GPG_KEYSERVER if they were not refreshed for GPG_KEY_REFRESH_AGE, keys that
+# expire within GPG_KEY_REFRESH_EXPIRES are refreshed daily.
+GPG_KEY_REFRESH_AGE = timedelta(days=7)
+GPG_KEY_REFRESH_EXPIRES = timedelta(days=14)
+
+# Number of keys fetched concurrently and minimum time in seconds between two requests to the same
+# keyserver when refreshing keys.
+GPG_KEY_REFRESH_WORKERS = 4
+GPG_KEY_REFRESH_DELAY = 0.5
 MAX_UPLOAD_SIZE = 1024 * 1024 * 2
 
 ###################
@@ -503,10 +564,22 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'account.tasks.cleanup',
         'schedule': crontab(hour=3, minute=5),
     },
+    'account cleanup uploads': {
+        'task': 'account.tasks.cleanup_uploads',
+        'schedule': crontab(hour=3, minute=10),
+    },
     'account last activity': {
         'task': 'account.tasks.update_last_activity',
         'schedule': crontab(minute=12),
     },
+    'account rebuild username filters': {
+        'task': 'account.tasks.rebuild_username_filters',
+        'schedule': crontab(minute=42),
+    },
+    'account refresh gpg keys': {
+        'task': 'account.tasks.refresh_gpg_keys',
+        'schedule': crontab(hour=4, minute=20),
+    },
     'download_xmpp_net_badges': {
         'task': 'blog.tasks.download_xmpp_net_badges',
         'schedule': crontab(hour=9, minute=35),
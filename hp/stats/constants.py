@@ -24,3 +24,5 @@ STAT_DELETE_ACCOUNT = 7
 STAT_DELETE_ACCOUNT_CONFIRMED = 8
 STAT_FAILED_LOGIN = 9
 STAT_RESEND_CONFIRMATION = 10
+STAT_UPLOADS_DELETED = 11
+STAT_UPLOADS_FREED = 12  # in KiB